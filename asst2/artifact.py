@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+#
+# artifact.py
+#
+# Compact binary file of the strategy and EV tables of a rule set. The file
+# has a fixed layout (header, table directory, label tables, dense cell
+# arrays), so it can be memory-mapped: every process loading it reads the
+# cells from the same physical pages, through read-only Table views.
+#
+# Layout, little endian, every block aligned to ALIGN bytes:
+#   header     HEADER: magic, version, number of tables, advantage,
+#              offset and length of the rules (JSON)
+#   directory  one ENTRY per table: name, unit, cell type, label and string
+#              widths, shape, offsets of its labels, strings and cells
+#   blocks     fixed width ASCII labels and strings, float64 cells of float
+#              tables, int32 string indices (-1 for None) of str tables
+#
+# usage: artifact.py FILE
+#
+
+import os
+import sys
+import json
+import mmap
+import struct
+import tempfile
+from collections.abc import Mapping
+import numpy as np
+from easybj import *
+from table import Table, DENSE_DTYPE
+
+
+
+###################
+##   CONSTANTS   ##
+###################
+
+MAGIC = b"EZBJTBL\0"
+VERSION = 1 # layout of artifact files
+ALIGN = 64 # alignment of every block
+HEADER = struct.Struct("<8sIIdQQ")
+ENTRY = struct.Struct("<16s4sBBHIIIQQQQ")
+CELLTYPES = [float, str] # cell type code of ENTRY
+TABLES = ['initial', 'stand', 'hit', 'double', 'split', 'optimal', 'strategy']
+RESULTS = TABLES + ['resplit', 'advantage'] # keys of an Artifact
+
+
+
+###########################
+##   UTILITY FUNCTIONS   ##
+###########################
+
+def aligned(offset):
+    """ Returns offset rounded up to ALIGN """
+    return -(-offset // ALIGN) * ALIGN
+
+def labels_block(labels, width):
+    """ Returns labels as ASCII strings of width bytes, NUL padded """
+    return np.array([str(label).encode('ascii') for label in labels],
+                    dtype='S%d'%width).tobytes()
+
+def label_width(labels):
+    """ Returns width in bytes of the longest label, at least 1 """
+    return max([len(str(label)) for label in labels] + [1])
+
+def read_labels(buffer, width, count, offset):
+    """ Returns tuple of count labels of width bytes at offset, the padding
+        removed """
+    array = np.frombuffer(buffer, dtype='S%d'%width, count=count, offset=offset)
+    return tuple(label.decode('ascii') for label in array.tolist())
+
+
+
+################
+##   WRITER   ##
+################
+
+def write_artifact(path, result):
+    """ Write the tables and advantage of a calculate() result, and the rules
+        they were computed with, to path, atomically """
+    rules = result.calc.rules
+    tables = [(name, result[name]) for name in TABLES]
+    tables += [('resplit%d'%i, table) for i, table in enumerate(result['resplit'])]
+    fields = rules._asdict()
+    fields['weights'] = list(rules.weights) if rules.weights is not None else None
+    blocks = [json.dumps(fields).encode()]
+
+    # block contents of each table: labels, strings and cells
+    entries = []
+    for name, table in tables:
+        if not table.dense:
+            raise ValueError("table %s must be dense"%name)
+        width = label_width(table.ylabels + table.xlabels)
+        strings = table.strings if table.celltype is str else []
+        swidth = label_width(strings)
+        data = np.ascontiguousarray(table.data, dtype=DENSE_DTYPE[table.celltype])
+        entries.append((name, table, width, swidth, len(strings)))
+        blocks += [labels_block(table.ylabels, width), labels_block(table.xlabels, width),
+                   labels_block(strings, swidth), data.tobytes()]
+
+    # offsets of the blocks, after the header and directory
+    offset = aligned(HEADER.size + ENTRY.size * len(tables))
+    offsets = []
+    for block in blocks:
+        offsets.append(offset)
+        offset = aligned(offset + len(block))
+
+    buffer = bytearray(offset)
+    HEADER.pack_into(buffer, 0, MAGIC, VERSION, len(tables),
+                     result['advantage'], offsets[0], len(blocks[0]))
+    for i, (name, table, width, swidth, nstrings) in enumerate(entries):
+        y, x, s, d = offsets[1 + 4*i: 5 + 4*i]
+        ENTRY.pack_into(buffer, HEADER.size + ENTRY.size*i, name.encode(),
+                        table.unit.encode(), CELLTYPES.index(table.celltype),
+                        width, swidth, len(table.ylabels), len(table.xlabels),
+                        nstrings, y, x, s, d)
+    for start, block in zip(offsets, blocks):
+        buffer[start:start + len(block)] = block
+
+    directory = os.path.dirname(path) or "."
+    fd, temp = tempfile.mkstemp(suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(buffer)
+        os.replace(temp, path)
+    except BaseException:
+        os.remove(temp)
+        raise
+
+
+
+################
+##   LOADER   ##
+################
+
+def is_artifact(path):
+    """ Returns whether path is an artifact file """
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+class Artifact(Mapping):
+    """ Memory-mapped artifact file, a read-only calculate() style dictionary
+        of RESULTS. Tables are views of the mapped file: nothing is copied
+        and writing a cell raises ValueError. close() the artifact, or use
+        it as a context manager, once its tables are no longer used. """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, ntables, advantage, offset, length = \
+                HEADER.unpack_from(self.map, 0)
+        except struct.error:
+            raise ValueError("%s is not an artifact file"%path)
+        if magic != MAGIC:
+            raise ValueError("%s is not an artifact file"%path)
+        if version != VERSION:
+            raise ValueError("%s has version %d, expected %d"%(path, version, VERSION))
+        fields = json.loads(self.map[offset:offset + length])
+        if fields['weights'] is not None:
+            fields['weights'] = tuple(fields['weights'])
+        self.rules = Rules(**fields)
+        self.advantage = advantage
+
+        self.tables = {}
+        for i in range(ntables):
+            name, unit, kind, width, swidth, nrows, ncols, nstrings, y, x, s, d = \
+                ENTRY.unpack_from(self.map, HEADER.size + ENTRY.size*i)
+            celltype = CELLTYPES[kind]
+            ylabels = read_labels(self.map, width, nrows, y)
+            xlabels = read_labels(self.map, width, ncols, x)
+            strings = read_labels(self.map, swidth, nstrings, s)
+            data = np.frombuffer(self.map, dtype=DENSE_DTYPE[celltype],
+                                 count=nrows*ncols, offset=d).reshape(nrows, ncols)
+            self.tables[name.rstrip(b"\0").decode()] = Table.from_buffer(
+                celltype, xlabels, ylabels, data, strings, unit.rstrip(b"\0").decode())
+        self.resplit = [self.tables['resplit%d'%i]
+                        for i in range(sum(name.startswith('resplit')
+                                           for name in self.tables))]
+
+    def __getitem__(self, name):
+        if name == 'advantage': return self.advantage
+        if name == 'resplit': return self.resplit
+        if name not in TABLES: raise KeyError(name)
+        return self.tables[name]
+
+    def __iter__(self):
+        return iter(RESULTS)
+
+    def __len__(self):
+        return len(RESULTS)
+
+    def close(self):
+        """ Unmap the file. Raises BufferError while a table or array taken
+            from the artifact is still referenced """
+        self.tables, self.resplit = {}, []
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    write_artifact(sys.argv[1], calculate())
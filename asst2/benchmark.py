@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+#
+# benchmark.py
+#
+# Time calculate() and each calculator stage over several scenarios, and
+# compare the medians against a stored baseline. A fixed pure Python
+# workload is timed along each scenario, and the baseline is scaled by how
+# much faster or slower it ran than when the baseline was saved, so the
+# stored times carry over to other machines (and to slower phases of a
+# shared one). Save the baseline again (--save) after a change that is
+# meant to alter the timings.
+#
+# usage: benchmark.py [-n REPEAT] [--threshold 0.25] [--save] [scenario ...]
+#
+
+import os
+import sys
+import json
+import time
+import argparse
+from collections import defaultdict
+import numpy as np
+import easybj
+import vectorized
+import composition
+from easybj import Rules, MAX_SPLITS, CACHE_ENV
+from metrics import Metrics
+
+
+
+###################
+##   CONSTANTS   ##
+###################
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "benchmark_baseline.json")
+PERCENTILES = (10, 50, 90)
+THRESHOLD = 0.25 # allowed relative slowdown of a median
+MIN_DELTA = 0.002 # slowdowns below this many seconds are noise
+REFERENCE = "reference" # measure of reference_work, scaling the baseline
+
+# weights of a single deck after a small cards heavy round
+DEPLETED = (4, 1, 2, 1, 2, 2, 3, 4, 4, 16)
+
+
+
+###################
+##   SCENARIOS   ##
+###################
+
+def run_easybj(rules):
+    def run(metrics):
+        result = easybj.calculate(rules, metrics=metrics)
+        for name in result: result[name] # compute every stage
+    return run
+
+def run_vectorized(rules):
+    def run(metrics):
+        with metrics.stage("vectorized"):
+            vectorized.calculate(rules)
+    return run
+
+def run_composition(decks):
+    def run(metrics):
+        with metrics.stage("composition"):
+            composition.calculate(composition.make_shoe(decks))
+    return run
+
+# name: (run(metrics), repetitions)
+SCENARIOS = {
+    "default" : (run_easybj(Rules()), 20),
+    "s17_6to5" : (run_easybj(Rules(dealer_hits_soft=False, blackjack_pays=1.2,
+                                   surrender=False)), 20),
+    "deep_resplits" : (run_easybj(Rules(max_splits=MAX_SPLITS)), 20),
+    "weighted_shoe" : (run_easybj(Rules(weights=DEPLETED)), 20),
+    "vectorized" : (run_vectorized(Rules()), 50),
+    "finite_shoe" : (run_composition(1), 3),
+}
+
+
+
+###########################
+##   UTILITY FUNCTIONS   ##
+###########################
+
+def reference_work(n=20000):
+    """ Fixed workload of float arithmetic and dictionary lookups, like the
+        calculators' recursions, timing the speed of the machine """
+    total, memo = 0., {}
+    for i in range(n):
+        memo[i % 997] = total = total * 0.5 + memo.get(i % 991, 1.)
+    return total
+
+def measure(name, repeat=None):
+    """ Returns {measure: [seconds, ...]} of scenario name, where measure is
+        'calculate' for the whole run, or a stage recorded in Metrics """
+    run, default_repeat = SCENARIOS[name]
+    samples = defaultdict(list)
+    for _ in range(repeat or default_repeat):
+        easybj._dealer_matrix.cache_clear() # time the dealer solve every run
+        metrics = Metrics()
+        start = time.perf_counter()
+        run(metrics)
+        samples["calculate"].append(time.perf_counter() - start)
+        for stage, record in metrics.stages.items():
+            samples[stage].append(record["wall"])
+        start = time.perf_counter()
+        reference_work()
+        samples[REFERENCE].append(time.perf_counter() - start)
+    return samples
+
+def summarize(samples):
+    """ Returns {measure: {"p10": ..., "p50": ..., "p90": ...}} """
+    return {measure: {"p%d"%p: float(v) for p, v in
+                      zip(PERCENTILES, np.percentile(times, PERCENTILES))}
+            for measure, times in samples.items()}
+
+def speed_scale(measures, expected):
+    """ Returns ratio of the reference_work medians of a scenario's measures
+        and of its baseline, 1 when either has none """
+    if REFERENCE not in measures or REFERENCE not in expected: return 1.
+    return measures[REFERENCE]["p50"] / expected[REFERENCE]["p50"]
+
+def compare(summary, baseline, threshold=THRESHOLD, min_delta=MIN_DELTA):
+    """ Returns messages for every median slower than its baseline, scaled
+        by speed_scale, by more than threshold (relative) and min_delta
+        (seconds) """
+    regressions = []
+    for scenario, measures in summary.items():
+        expected = baseline.get(scenario, {})
+        scale = speed_scale(measures, expected)
+        for measure, stats in measures.items():
+            expect = expected.get(measure)
+            if expect is None or measure == REFERENCE: continue
+            median, base = stats["p50"], expect["p50"] * scale
+            if median > base * (1 + threshold) and median - base > min_delta:
+                regressions.append("%s %s: median %.4fs, baseline %.4fs scaled "
+                                   "by %.2f (+%.0f%%)"%(scenario, measure, median,
+                                                        base, scale,
+                                                        100 * (median / base - 1)))
+    return regressions
+
+def print_summary(summary, baseline):
+    print("%-14s %-28s %9s %9s %9s %9s" % ("SCENARIO", "MEASURE", "P10",
+                                         "MEDIAN", "P90", "BASELINE"))
+    for scenario, measures in summary.items():
+        for measure, stats in measures.items():
+            base = baseline.get(scenario, {}).get(measure)
+            print("%-14s %-28s %9.4f %9.4f %9.4f %9s" % (
+                scenario, measure, stats["p10"], stats["p50"], stats["p90"],
+                "-" if base is None else "%.4f"%base["p50"]))
+
+
+
+##############
+##   MAIN   ##
+##############
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Easy Blackjack benchmarks")
+    parser.add_argument("scenarios", nargs="*",
+                        help="scenarios to run, all by default: " + ", ".join(SCENARIOS))
+    parser.add_argument("-n", "--repeat", type=int,
+                        help="repetitions of each scenario")
+    parser.add_argument("--baseline", default=BASELINE, help="baseline file")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="allowed relative slowdown of a median")
+    parser.add_argument("--min-delta", type=float, default=MIN_DELTA,
+                        help="ignore slowdowns below this many seconds")
+    parser.add_argument("--save", action="store_true",
+                        help="store the results as the new baseline")
+    args = parser.parse_args(argv[1:])
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario %s" % name)
+
+    os.environ.pop(CACHE_ENV, None) # always compute
+    summary = {name: summarize(measure(name, args.repeat))
+               for name in args.scenarios or SCENARIOS}
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_summary(summary, baseline)
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump({**baseline, **summary}, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("baseline saved to %s" % args.baseline)
+        return 0
+
+    regressions = compare(summary, baseline, args.threshold, args.min_delta)
+    for message in regressions:
+        print("REGRESSION: " + message)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
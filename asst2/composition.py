@@ -0,0 +1,346 @@
+#!/usr/bin/python3
+#
+# composition.py
+#
+# Composition-dependent Easy Blackjack calculator for a finite shoe, where
+# every card dealt is removed from the shoe
+#
+
+import functools
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from easybj import *
+from memo import Memo
+from vectorized import (create_optimal_table, calculate_player_advantage,
+                        make_result, outcome_result)
+
+
+
+###################
+##   CONSTANTS   ##
+###################
+
+CACHE_BYTES = 512 * 2**20 # default memory budget for memoized results
+MAX_COUNT = 255 # cards of a rank that fit in a composition key
+PARALLEL_SECONDS = 0.5 # least estimated column work worth a process pool
+ACE = DISTINCT.index("A")
+VALUE = [card_value(card) for card in DISTINCT]
+
+# PAYOFF[dealer score, player score] of standing
+PAYOFF = np.sign(np.subtract.outer(np.arange(NUM_SCORES), np.arange(NUM_SCORES))) * -1.
+PAYOFF[BUST] = 1.
+
+
+
+###########################
+##   UTILITY FUNCTIONS   ##
+###########################
+
+def make_shoe(decks):
+    """ Returns composition of a full shoe, i.e. count of each card in DISTINCT """
+    return tuple(decks * (NUM_FACES if card == "T" else 1) * (52 // NUM_RANKS)
+                 for card in DISTINCT)
+
+def remove(comp, cards):
+    """ Returns composition key with cards (string of DISTINCT) removed """
+    counts = list(comp)
+    for card in cards:
+        counts[DISTINCT.index(card)] -= 1
+    if min(counts) < 0:
+        raise ValueError("not enough cards in shoe to deal %s"%cards)
+    return bytes(counts)
+
+def draw(comp, card):
+    """ Returns composition key after drawing card (index) """
+    return comp[:card] + bytes((comp[card]-1,)) + comp[card+1:]
+
+def hand_cards(code):
+    """ Returns cards dealt for a hand of code, those of code2cards except
+        hard 4: a 2 and a 2, rather than the lone 4 that code2cards keeps
+        apart from the 22 split code """
+    return "22" if code == "4" else code2cards(code)
+
+def dealer_hand(cards):
+    """ Returns dealer hand as (hard total, holds an ace) """
+    return sum(map(card_value, cards)), "A" in cards
+
+# LOG_FALLING[n, k] = log(n * (n-1) * ... * (n-k+1)), very negative if zero
+MAX_DRAWS = 12 # more cards than the dealer can ever draw
+LOG_FALLING = np.concatenate((np.zeros((MAX_COUNT*NUM_CARDS + 1, 1)), np.cumsum(
+    np.log(np.maximum(np.subtract.outer(np.arange(MAX_COUNT*NUM_CARDS + 1.),
+                                        np.arange(MAX_DRAWS)), 1e-300)),
+    axis=1)), axis=1)
+
+@functools.lru_cache(maxsize=None)
+def dealer_draws(hand, stand, hits_soft):
+    """ Returns every multiset of cards the dealer can draw from hand before
+        standing or busting, as a (multiset x (card, count) + size) 0/1 matrix
+        and the columns of it that are used. Its product with log falling
+        factorials of the shoe gives the log probability of drawing one
+        ordering of each multiset. Also returns the number of orderings that
+        reach each multiset and its final score, one-hot. """
+    found = {}
+    def score(total, ace):
+        if total > 21: return BUST
+        return total + 10 if ace and total <= 11 else total
+    def draws(total, ace):
+        value = score(total, ace)
+        return value != BUST and (value < stand or (value == stand and
+                                  hits_soft and ace and total <= 11))
+    def visit(total, ace, drawn):
+        if not draws(total, ace):
+            key = (drawn, score(total, ace))
+            found[key] = found.get(key, 0) + 1
+            return
+        for card in range(NUM_CARDS):
+            counts = drawn[:card] + (drawn[card]+1,) + drawn[card+1:]
+            visit(total + VALUE[card], ace or card == ACE, counts)
+    visit(hand[0], hand[1], (0,) * NUM_CARDS)
+
+    width = MAX_DRAWS + 1
+    select = np.zeros((len(found), (NUM_CARDS + 1) * width))
+    for row, (drawn, _) in enumerate(found):
+        for card, count in enumerate(drawn):
+            select[row, card*width + count] = 1.
+        select[row, NUM_CARDS*width + sum(drawn)] = 1.
+    columns = np.flatnonzero(select.any(axis=0)) # drop counts never drawn
+    orders = np.array(list(found.values()), dtype=float)
+    scores = np.zeros((len(found), NUM_SCORES))
+    scores[np.arange(len(found)), [final for _, final in found]] = 1.
+    return np.ascontiguousarray(select[:, columns]), columns, orders, scores
+
+
+
+##########################
+##   SHOE CALCULATOR    ##
+##########################
+
+class ShoeCalculator:
+    """ Computes the easybj tables for a finite shoe. Each cell deals the
+        player and dealer cards of its codes (see hand_cards) from the shoe,
+        and every later draw removes its card as well. Results are memoized
+        on the remaining composition, so hands that leave the same cards in
+        the shoe are only computed once.
+
+        After a split, each hand is played independently from the cards left
+        once the split cards were dealt. """
+
+    def __init__(self, shoe, rules=DEFAULT_RULES, cache_bytes=CACHE_BYTES):
+        """ shoe: number of cards of each rank in DISTINCT """
+        check_rules(rules)
+        if len(shoe) != NUM_CARDS or not all(0 <= n <= MAX_COUNT for n in shoe):
+            raise ValueError("shoe must have %d counts from 0 to %d"
+                             %(NUM_CARDS, MAX_COUNT))
+        self.shoe = bytes(shoe)
+        self.rules = rules
+        self.cache = Memo("shoe", cache_bytes)
+
+
+    ##########################
+    ##  DEALER AND STANDING ##
+    ##########################
+
+    def dealer_prob(self, comp, dealer):
+        """ Returns probability of each final dealer score, drawing from comp """
+        select, columns, orders, scores = dealer_draws(
+            dealer, self.rules.dealer_stand, self.rules.dealer_hits_soft)
+        counts = np.frombuffer(comp, dtype=np.uint8)
+        logs = np.concatenate((LOG_FALLING[counts].ravel(),
+                               -LOG_FALLING[counts.sum()]))
+        return (orders * np.exp(select @ logs[columns])) @ scores
+
+    def stand_payoffs(self, comp, dealer):
+        """ Returns stand EV of every player score, drawing from comp """
+        key = ("stand", dealer, comp)
+        payoffs = self.cache.lookup(key)
+        if payoffs is None:
+            payoffs = (self.dealer_prob(comp, dealer) @ PAYOFF).tolist()
+            self.cache.store(key, payoffs)
+        return payoffs
+
+    def stand(self, comp, state, dealer):
+        if state == BUST_STATE: return -1.0
+        return self.stand_payoffs(comp, dealer)[SCORE[state]]
+
+
+    ##########################
+    ##  HIT, DOUBLE, SPLIT  ##
+    ##########################
+
+    def hit(self, comp, state, dealer):
+        """ Returns EV of hitting once, then playing optimally """
+        n = sum(comp)
+        payoff = 0.0
+        for card, next_state in enumerate(PLAYER_NEXT[state]):
+            count = comp[card]
+            if not count: continue
+            if next_state == BUST_STATE:
+                payoff -= count/n
+            else:
+                payoff += count/n * self.hit_outcome(draw(comp, card),
+                                                     next_state, dealer)
+        return payoff
+
+    def hit_outcome(self, comp, state, dealer):
+        """ Returns EV of best of stand and hit """
+        if state == TWENTYONE_STATE: return self.stand(comp, state, dealer)
+        if state == BUST_STATE: return -1.0
+
+        key = ("hit", dealer, comp, state)
+        outcome = self.cache.lookup(key)
+        if outcome is None:
+            outcome = max(self.stand(comp, state, dealer),
+                          self.hit(comp, state, dealer))
+            self.cache.store(key, outcome)
+        return outcome
+
+    def double(self, comp, state, dealer):
+        """ Returns EV of doubling """
+        n = sum(comp)
+        payoff = 0.0
+        for card, next_state in enumerate(PLAYER_NEXT[state]):
+            count = comp[card]
+            if not count: continue
+            if next_state == BUST_STATE:
+                payoff -= 2*count/n
+            else:
+                payoff += 2*count/n * self.stand(draw(comp, card), next_state, dealer)
+        return payoff
+
+    def best(self, comp, state, dealer):
+        """ Returns EV of max(stand, hit, double), see get_0split_outcome """
+        if state == BUST_STATE: return -1.0
+        if state == BJ_STATE: state = TWENTYONE_STATE
+        if state == TWENTYONE_STATE: return self.stand(comp, state, dealer)
+        key = ("best", dealer, comp, state)
+        outcome = self.cache.lookup(key)
+        if outcome is None:
+            outcome = max(self.stand(comp, state, dealer),
+                          self.hit(comp, state, dealer))
+            if self.rules.double_after_split:
+                outcome = max(outcome, self.double(comp, state, dealer))
+            self.cache.store(key, outcome)
+        return outcome
+
+    def split(self, comp, card, dealer):
+        """ Returns EVs of splitting card with at most 0, 1, ... max_splits
+            splits, comp no longer holds the two split cards """
+        n = sum(comp)
+        prob = [count/n for count in comp]
+        outcome = []
+        for drawn, next_state in enumerate(PAIR_STATE[card]):
+            if not comp[drawn]:
+                outcome.append(0.)
+            elif card == ACE: # one card each, then stand
+                if next_state == BJ_STATE: next_state = TWENTYONE_STATE
+                outcome.append(self.stand(draw(comp, drawn), NOSPLIT_STATE[next_state], dealer))
+            else:
+                outcome.append(self.best(draw(comp, drawn), next_state, dealer))
+        q, own = prob[card], outcome[card]
+        other = sum(p*f for p, f in zip(prob, outcome)) - q*own
+        can_resplit = card != ACE or self.rules.resplit_aces
+
+        values = [own]
+        for splits in range(1, self.rules.max_splits + 1):
+            values.append(split_payoff(other, q,
+                lambda n: values[n] if can_resplit else own, splits))
+        return values
+
+
+    ##############
+    ##  TABLES  ##
+    ##############
+
+    def create_initial_table(self):
+        """ Returns (state x dealer column + BJ) initial probabilities,
+            dealing two cards to each without replacement """
+        return initial_deal(list(self.shoe), finite=True)
+
+    def create_dealer_table(self):
+        """ Returns {code: {score: probability}} for every dealer code """
+        result = {}
+        for code in DEALER_CODE + DEALER_STAND_CODE[:-1]:
+            cards = hand_cards(code)
+            probs = self.dealer_prob(remove(self.shoe, cards), dealer_hand(cards))
+            result[code] = {score: float(p) for score, p in enumerate(probs) if p > 0.}
+        return result
+
+    def create_tables(self, cols=None):
+        """ Returns (state x dealer column) stand, hit, double, split and
+            resplit EV arrays, NaN outside of the dealer columns cols (all
+            by default) """
+        shape = (NUM_STATES, NUM_DEALER)
+        stand, hit, double, split = [np.full(shape, np.nan) for _ in range(4)]
+        resplit = [np.full(shape, np.nan) for _ in range(self.rules.max_splits)]
+        for col in range(NUM_DEALER) if cols is None else cols:
+            dealer_cards = hand_cards(DEALER_CODE[col])
+            dealer = dealer_hand(dealer_cards)
+            shoe = remove(self.shoe, dealer_cards)
+            for s in STAND_STATE:
+                comp = remove(shoe, hand_cards(STATE_CODE[s]))
+                stand[s, col] = self.stand(comp, s, dealer)
+                if s in NON_SPLIT_STATE:
+                    hit[s, col] = self.hit(comp, s, dealer)
+                    double[s, col] = self.double(comp, s, dealer)
+                resplit[0][s, col] = self.best(comp, s, dealer)
+            for s in SPLIT_STATE:
+                comp = remove(shoe, STATE_CODE[s])
+                values = self.split(comp, SPLIT_CARD[s], dealer)
+                split[s, col] = values[-1]
+                if SPLIT_CARD[s] != ACE or self.rules.resplit_aces:
+                    for splits in range(1, self.rules.max_splits):
+                        resplit[splits][s, col] = values[splits]
+        return stand, hit, double, split, resplit
+
+
+def create_columns(shoe, rules, cache_bytes, cols):
+    """ Returns create_tables(cols) of a new ShoeCalculator, for a worker """
+    return ShoeCalculator(shoe, rules, cache_bytes).create_tables(cols)
+
+def calculate(shoe, rules=DEFAULT_RULES, cache_bytes=CACHE_BYTES, workers=None):
+    """ Returns the easybj.calculate() dictionary for a finite shoe
+        shoe: number of cards of each rank in DISTINCT, e.g. make_shoe(6)
+        cache_bytes: memory budget of memoized results, None for no limit,
+                     given to each worker
+        workers: number of processes sharing the dealer columns of the EV
+                 tables, None or 1 computes them in process. At most one
+                 per CPU is used, after the first column is computed in
+                 process and timed: the pool only starts when the others
+                 are estimated to take PARALLEL_SECONDS or more. Columns
+                 share no memoized values and cost about the same (0.2 to
+                 0.4 s each for 6 decks), so the speedup is then close to
+                 the number of workers
+        The outcome distribution draws later cards with the shoe proportions,
+        so its mean is close to but not exactly the advantage. """
+    calc = ShoeCalculator(shoe, rules, cache_bytes)
+    initial = calc.create_initial_table()
+    dealer = calc.create_dealer_table()
+    workers = parallel_workers(workers)
+    if workers < 2:
+        stand, hit, double, split, resplit = calc.create_tables()
+    else:
+        start = time.perf_counter()
+        stand, hit, double, split, resplit = calc.create_tables([0])
+        rest = range(1, NUM_DEALER)
+        if (time.perf_counter() - start) * len(rest) < PARALLEL_SECONDS:
+            parts, outputs = [rest], [calc.create_tables(rest)]
+        else:
+            parts = column_parts(workers, rest)
+            n = len(parts)
+            with ProcessPoolExecutor(n) as pool:
+                outputs = list(pool.map(create_columns, [shoe] * n, [rules] * n,
+                                        [cache_bytes] * n, parts))
+        for cols, (*arrays, resplits) in zip(parts, outputs):
+            cols = list(cols)
+            for merged, array in zip([stand, hit, double, split] + resplit,
+                                     arrays + resplits):
+                merged[:, cols] = array[:, cols]
+    optimal, strategy = create_optimal_table(stand, hit, double, split, rules)
+    advantage = calculate_player_advantage(initial, optimal, rules)
+    scores = np.array([[dealer[code].get(score, 0.) for score in range(NUM_SCORES)]
+                       for code in DEALER_CODE])
+    outcome = outcome_result(rules._replace(weights=tuple(shoe)), initial, scores,
+                             stand, hit, double, strategy)
+    return make_result(rules, initial, dealer, stand, hit, double, resplit,
+                       split, optimal, strategy, advantage, outcome)
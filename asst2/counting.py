@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+#
+# counting.py
+#
+# Effect of removal of each card rank on the player advantage and on the
+# decision margin of every strategy cell, and the true count deviation
+# indices derived from them
+#
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from easybj import *
+from table import Table
+from vectorized import VectorCalculator, action_evs, calculate_player_advantage, \
+                       create_optimal_table, ACTIONS
+from composition import make_shoe
+
+
+
+###################
+##   CONSTANTS   ##
+###################
+
+HI_LO = (-1, 1, 1, 1, 1, 1, 0, 0, 0, -1) # count tag of each card in DISTINCT
+MAX_INDEX = 20 # indices further from zero are reported as None
+COUNTS = range(-MAX_INDEX, MAX_INDEX + 1) # true counts evaluated by scan_indices
+
+
+
+###########################
+##   UTILITY FUNCTIONS   ##
+###########################
+
+def evaluate(weights, rules=DEFAULT_RULES):
+    """ Returns (advantage, action EVs) for card weights, see action_evs """
+    rules = rules._replace(weights=tuple(weights))
+    calc = VectorCalculator(rules)
+    initial = calc.create_initial_table()
+    stand = calc.create_stand_table(calc.create_dealer_table())
+    hit, _ = calc.create_hit_table(stand)
+    double = calc.create_double_table(stand)
+    split, _ = calc.create_split_table(stand, hit, double)
+    optimal, _ = create_optimal_table(stand, hit, double, split, rules)
+    return (calculate_player_advantage(initial, optimal, rules),
+            action_evs(stand, hit, double, split, rules))
+
+def evaluate_batch(batch, rules=DEFAULT_RULES):
+    return [evaluate(weights, rules) for weights in batch]
+
+def count_shift(tags=HI_LO):
+    """ Returns change in each card count per deck that raises the true count
+        by one: cards tagged +1 are removed and cards tagged -1 added, half
+        of the count each, in proportion to their share of a deck """
+    deck = np.array(make_shoe(1), dtype=float)
+    tags = np.array(tags, dtype=float)
+    shift = np.zeros(NUM_CARDS)
+    for sign in (1, -1):
+        cards = deck * (tags == sign)
+        shift -= sign * 0.5 * cards / cards.sum()
+    return shift
+
+def margins(evs, best, second):
+    """ Returns EV of action best minus EV of action second, per cell """
+    take = lambda index: np.take_along_axis(evs, index[None], axis=0)[0]
+    return take(best) - take(second)
+
+
+
+#########################
+##   INDEX GENERATOR   ##
+#########################
+
+class CountAnalysis:
+    """ Evaluates compositions of a shoe of decks with the vectorized engine
+        (card weights proportional to the counts left), in batches over a
+        process pool kept for the life of the analysis: close() it, or use
+        the analysis as a context manager. Results are memoized on the
+        composition, so the base shoe and repeated compositions are
+        evaluated only once. Nothing below a whole composition is shared:
+        every table of the engine, from the dealer matrix on, depends on the
+        card weights, so distinct compositions have no sub-result in
+        common. """
+
+    def __init__(self, decks=6, rules=DEFAULT_RULES, workers=None):
+        self.shoe = np.array(make_shoe(decks), dtype=float)
+        self.decks = decks
+        self.rules = rules
+        self.workers = parallel_workers(workers, len(COUNTS)) # largest batch
+        self.memo = {}
+        self.pool = None # started by the first batch worth spreading
+
+        # base strategy, and the next best action of each cell
+        advantage, evs = self.evaluate([self.shoe])[0]
+        self.advantage = advantage
+        self.best = np.argmax(evs, axis=0)
+        rest = evs.copy()
+        np.put_along_axis(rest, self.best[None], -np.inf, axis=0)
+        self.second = np.argmax(rest, axis=0)
+        self.margin = margins(evs, self.best, self.second)
+
+    def evaluate(self, compositions):
+        """ Returns (advantage, action EVs) of each composition """
+        keys = [tuple(np.round(comp, 9)) for comp in compositions]
+        missing = list(dict.fromkeys(key for key in keys if key not in self.memo))
+        if self.workers == 1 or len(missing) < 2:
+            results = evaluate_batch(missing, self.rules)
+        else:
+            size = -(-len(missing) // self.workers)
+            batches = [missing[i:i+size] for i in range(0, len(missing), size)]
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(self.workers)
+            results = [result for batch in self.pool.map(evaluate_batch, batches,
+                                                          [self.rules] * len(batches))
+                       for result in batch]
+        self.memo.update(zip(missing, results))
+        return [self.memo[key] for key in keys]
+
+    def close(self):
+        """ Shut down the worker processes, a later batch starts new ones """
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def effects_of_removal(self):
+        """ Returns (advantage, margin) changes from removing one card of each
+            rank: a vector over DISTINCT and a (card x PLAYER_STATE x dealer
+            column) array """
+        removed = [self.shoe - np.eye(NUM_CARDS)[card] for card in range(NUM_CARDS)]
+        results = self.evaluate(removed)
+        advantage = np.array([adv for adv, _ in results]) - self.advantage
+        margin = np.stack([margins(evs, self.best, self.second) for _, evs in results])
+        return advantage, margin - self.margin
+
+    def linear_indices(self, tags=HI_LO):
+        """ Returns (index, action) arrays over PLAYER_STATE x dealer column:
+            the true count where the margin, extrapolated from the effects of
+            removal, reaches zero and the second best action takes over """
+        _, margin = self.effects_of_removal()
+        removed = -count_shift(tags) * self.decks # cards removed per true count
+        slope = np.tensordot(removed, margin, axes=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            index = -self.margin / slope
+        index[~(np.abs(index) <= MAX_INDEX)] = np.nan
+        return index, self.second
+
+    def scan_indices(self, tags=HI_LO, counts=COUNTS):
+        """ Returns (index, action) arrays over PLAYER_STATE x dealer column:
+            the true count closest to zero whose optimal action differs from
+            the base strategy, from exact evaluation at each count """
+        counts = sorted(counts, key=abs)
+        shift = count_shift(tags) * self.decks
+        comps = [np.maximum(self.shoe + count * shift, 0.) for count in counts]
+        index = np.full(self.best.shape, np.nan)
+        action = np.full(self.best.shape, -1)
+        for count, (_, evs) in zip(counts, self.evaluate(comps)):
+            best = np.argmax(evs, axis=0)
+            new = (best != self.best) & np.isnan(index)
+            index[new], action[new] = count, best[new]
+        return index, action
+
+    def index_tables(self, exact=False, tags=HI_LO):
+        """ Returns (index, action) Tables over PLAYER_CODE x DEALER_CODE,
+            cells without a deviation within MAX_INDEX are empty """
+        index, action = (self.scan_indices if exact else self.linear_indices)(tags)
+        codes = np.array(ACTIONS + [None], dtype=object)[action]
+        codes[np.isnan(index)] = None
+        return (Table.from_numpy(float, DEALER_CODE, PLAYER_CODE, index),
+                Table.from_numpy(str, DEALER_CODE, PLAYER_CODE, codes))
+
+
+if __name__ == "__main__":
+    import sys
+    from main import print_2d_table
+    exact = "--exact" in sys.argv
+    with CountAnalysis(workers=os.cpu_count()) as analysis:
+        advantage, _ = analysis.effects_of_removal()
+        index, action = analysis.index_tables(exact)
+    print("Effect of removal on player advantage:")
+    print(" ".join("%s: %+.4f%%"%(card, 100*eor) for card, eor in zip(DISTINCT, advantage)))
+    print_2d_table("index", index)
+    print_2d_table("deviation", action)
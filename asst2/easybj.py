@@ -6,9 +6,16 @@
 #
 
 from table import Table
-from collections import defaultdict
-import timeit
-import copy
+from metrics import Metrics
+from memo import Memo
+from collections import namedtuple
+from collections.abc import Mapping
+import functools
+import hashlib
+import os
+import tempfile
+import zipfile
+import numpy as np
 
 
 
@@ -36,6 +43,39 @@ BUST = 0 # representation of busted hand
 DISTINCT = ['A','2','3','4','5','6','7','8','9','T'] # distinct card values
 NUM_FACES = 4 # number of cards with 10 points
 NUM_RANKS = 13 # number of ranks in a French deck
+NUM_SCORES = 22 # final scores, from 0 (BUST) to 21
+
+
+
+###############
+##   RULES   ##
+###############
+
+# dealer_stand: lowest total the dealer stands on
+# dealer_hits_soft: dealer hits a soft dealer_stand total, i.e. H17
+# weights: relative weight of each card in DISTINCT, e.g. remaining counts of
+#          a finite shoe, None for probability()
+# blackjack_pays: payout of a player blackjack, e.g. 1.2 for 6:5
+# surrender: player may surrender for half the bet
+# max_splits: number of splits allowed on a hand, 1 for no resplitting
+# double_after_split: player may double a hand after splitting
+# resplit_aces: split aces that draw another ace may be split again
+Rules = namedtuple('Rules', ['dealer_stand', 'dealer_hits_soft', 'weights',
+                             'blackjack_pays', 'surrender', 'max_splits',
+                             'double_after_split', 'resplit_aces'],
+                   defaults=(17, True, None, 1.5, True, 3, True, False))
+
+DEFAULT_RULES = Rules()
+MAX_SPLITS = 7 # most splits the calculators support, i.e. 8 hands
+
+def check_rules(rules):
+    """ Raises ValueError for rules the calculators cannot evaluate """
+    if not 1 <= rules.max_splits <= MAX_SPLITS:
+        raise ValueError("max_splits must be from 1 to %d"%MAX_SPLITS)
+    if rules.weights is not None and (len(rules.weights) != len(DISTINCT) or
+            min(rules.weights) < 0 or sum(rules.weights) <= 0):
+        raise ValueError("weights must give %d non-negative card weights"
+                         %len(DISTINCT))
 
 
 
@@ -43,16 +83,12 @@ NUM_RANKS = 13 # number of ranks in a French deck
 ##   UTILITY FUNCTIONS   ##
 ###########################
 
-PERFORMANCE_DATA = ""
-
 def profile(f):
-    def wrapper(*args, **kwargs):
-        global PERFORMANCE_DATA
-        start_time = timeit.default_timer()
-        result = f(*args, **kwargs)
-        end_time = timeit.default_timer()
-        tdelta = end_time - start_time
-        PERFORMANCE_DATA += "\nINFO: {} ran in {:.3f} seconds.".format(f.__name__, tdelta)
+    """ Record each call of method f as a stage in self.metrics """
+    @functools.wraps(f)
+    def wrapper(self, *args, **kwargs):
+        with self.metrics.stage(f.__name__):
+            return f(self, *args, **kwargs)
     return wrapper
 
 def code2score(code):
@@ -83,6 +119,26 @@ def probability(card):
     """ Returns the probability of receiving this card """
     return (1 if card != 'T' else NUM_FACES) / NUM_RANKS
 
+def card_probabilities(rules=DEFAULT_RULES):
+    """ Returns tuple of the probability of receiving each card in DISTINCT """
+    if rules.weights is None:
+        return tuple(probability(card) for card in DISTINCT)
+    total = sum(rules.weights)
+    return tuple(w / total for w in rules.weights)
+
+def split_payoff(other, q, value, splits):
+    """ Returns EV of splitting a pair when at most splits splits, including
+        this one, may be made. Works on floats or arrays.
+        other: sum of probability * outcome over cards other than the pair's
+        q: probability of drawing the pair's card
+        value(n): EV of a hand that drew the pair's card with n splits left
+
+        If one hand draws the pair's card, it gets every remaining split; if
+        both do, the remaining splits are shared as evenly as possible, the
+        first hand getting the extra one """
+    return (2*other + 2*q*(1-q)*value(splits - 1)
+            + q*q*(value(splits // 2) + value((splits - 1) // 2)))
+
 def card_value(card):
     """ Returns value of card, assuming 'A' == 1 """
     if card == "A": return 1
@@ -103,107 +159,371 @@ def generate_card_pairs():
 ####################
 
 class Hand:
-    """ Represents a Blackjack hand (owned by either player or dealer) """
+    """ Represents a Blackjack hand (owned by either player or dealer).
 
-    def __init__(self, cards, dealer=False):
+        Hands are immutable and interned: a hand is kept as the number of
+        cards of each rank in DISTINCT, so Hand("AT") is Hand("TA"), along
+        with its hard total, soft and pair flags, codes and value. add()
+        returns the hand holding one more card, and the transition is
+        cached, so no hand is built twice. """
+
+    __slots__ = ('counts', 'is_dealer', 'ncards', 'total', 'soft', 'pair',
+                 '_codes', '_value', '_next')
+    _interned = {} # (counts, dealer): Hand
+
+    def __new__(cls, cards=(), dealer=False):
         """ cards: iterable of cards
             dealer: boolean, owner of hand is dealer """
-        self.cards = list(cards)
-        self.is_dealer = dealer
+        counts = [0] * len(DISTINCT)
+        for card in cards:
+            counts[DISTINCT.index(card)] += 1
+        return cls.intern(tuple(counts), bool(dealer))
+
+    @classmethod
+    def intern(cls, counts, dealer=False):
+        """ Returns the hand holding counts cards of each rank """
+        hand = cls._interned.get((counts, dealer))
+        if hand is not None: return hand
+        hand = object.__new__(cls)
+        init = functools.partial(object.__setattr__, hand)
+        init('counts', counts)
+        init('is_dealer', dealer)
+        init('ncards', sum(counts))
+        init('total', sum(n * card_value(card) for card, n in zip(DISTINCT, counts)))
+        # an ace, DISTINCT[0], counted as 11 without busting
+        init('soft', counts[0] > 0 and hand.total <= 11)
+        init('pair', hand.ncards == 2 and 2 in counts)
+        init('_codes', (hand._code(False), hand._code(True)))
+        init('_value', hand._score())
+        init('_next', {})
+        cls._interned[(counts, dealer)] = hand
+        return hand
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Hand is immutable")
+
+    def __reduce__(self):
+        # pickle and copy return the interned hand
+        return (Hand.intern, (self.counts, self.is_dealer))
+
+    def __repr__(self):
+        return "Hand(%r%s)"%("".join(self.cards), ", dealer=True" if self.is_dealer else "")
+
+    @property
+    def cards(self):
+        """ Tuple of the cards of the hand, in DISTINCT order """
+        return tuple(card for card, n in zip(DISTINCT, self.counts) for _ in range(n))
+
+    def add(self, card):
+        """ Returns the hand holding one more card """
+        hand = self._next.get(card)
+        if hand is None:
+            i = DISTINCT.index(card)
+            counts = self.counts[:i] + (self.counts[i] + 1,) + self.counts[i+1:]
+            hand = self._next[card] = Hand.intern(counts, self.is_dealer)
+        return hand
 
     def probability(self):
         """ Returns the probability of receiving the hand as a float """
         p = 1.
-        for c in self.cards:
-            p *= probability(c)
+        for card, n in zip(DISTINCT, self.counts):
+            p *= probability(card) ** n
         return p
 
     def code(self, nosplit=False):
         """ Returns the 'XX' code that represents the hand, '00' if busted
             nosplit: True if hand cannot split """
-        # Note: self.cards may have more than 2 cards
-        value = sum(map(card_value, self.cards))
-        if len(self.cards) == 2:
-            if self.cards[0] == self.cards[1]:
-                if self.cards[0] == "A": return "AA" # special AA
+        return self._codes[bool(nosplit)]
+
+    def value(self):
+        """ Returns score of Hand, 0 if busted """
+        return self._value
+
+    def _code(self, nosplit):
+        # Note: the hand may have more than 2 cards
+        value = self.total
+        if self.ncards == 2:
+            if self.pair:
+                if self.soft: return "AA" # special AA
                 if not nosplit and not self.is_dealer:
-                    return self.cards[0]*2 # split
-            if value == 11 and "A" in self.cards: return "BJ" # blackjack
+                    return DISTINCT[self.counts.index(2)]*2 # split
+            if value == 11 and self.soft: return "BJ" # blackjack
 
         if value > 21: return BUST_CODE # bust
         if value > 11: return str(value) # hard, (A 4 6) -> 21
-        if "A" in self.cards:
+        if self.soft:
             if not self.is_dealer or value <= 7:
                 if value == 11: return "21" # (A 9 A) -> 21
                 return "A" + str(value-1) # soft
             return str(value+10) # dealer cannot hit > A6
         return str(value) # hard
 
-    def value(self):
-        """ Returns score of Hand, 0 if busted """
-        value = sum(map(card_value, self.cards))
-        if "A" in self.cards and value <= 11: return value + 10
-        if value <= 21: return value
+    def _score(self):
+        if self.soft: return self.total + 10
+        if self.total <= 21: return self.total
         return BUST
 
 
 
+############################
+##   HAND STATE MACHINE   ##
+############################
+
+# Every hand code is given a small integer id (its state), and all transitions
+# are computed once at import, so the calculator never builds Hands or strings.
+STATE_CODE = HARD_CODE + ['21'] + SOFT_CODE + SPLIT_CODE[:-1] + ['BJ', BUST_CODE]
+STATE = {code: i for i, code in enumerate(STATE_CODE)}
+NUM_STATES = len(STATE_CODE)
+NUM_CARDS = len(DISTINCT)
+
+BUST_STATE = STATE[BUST_CODE]
+TWENTYONE_STATE = STATE['21']
+BJ_STATE = STATE['BJ']
+
+def next_state(state, card, dealer=False):
+    """ Returns state reached by drawing card (index) from state """
+    code = STATE_CODE[state]
+    if code == BUST_CODE: return BUST_STATE
+    cards = code2cards(code) + DISTINCT[card]
+    return STATE[cards2code(cards, dealer=dealer, nosplit=True)]
+
+def pair_state(card1, card2, dealer=False, nosplit=False):
+    """ Returns state of a two card hand, given as card indices """
+    return STATE[cards2code(DISTINCT[card1]+DISTINCT[card2], dealer=dealer,
+                            nosplit=nosplit)]
+
+# (state x card) -> next state for player, hand can no longer split after a hit
+PLAYER_NEXT = tuple(tuple(next_state(s, c) for c in range(NUM_CARDS))
+                    for s in range(NUM_STATES))
+
+# (card x card) -> state, for split hands receiving their second card
+PAIR_STATE = tuple(tuple(pair_state(i, j, nosplit=True) for j in range(NUM_CARDS))
+                   for i in range(NUM_CARDS))
+PLAYER_PAIR_STATE = tuple(tuple(pair_state(i, j) for j in range(NUM_CARDS))
+                          for i in range(NUM_CARDS)) # initial hands
+
+# score of each state, BUST if busted
+SCORE = tuple(code2score(code) if code != BUST_CODE else BUST
+              for code in STATE_CODE)
+
+# state of hand when it cannot split, e.g. '88' -> '16'
+NOSPLIT_STATE = tuple(STATE[cards2code(code2cards(code), nosplit=True)]
+                      if code in SPLIT_CODE else s
+                      for s, code in enumerate(STATE_CODE))
+
+# card index of split hands, None otherwise
+SPLIT_CARD = tuple(DISTINCT.index(code[0]) if code in SPLIT_CODE else None
+                   for code in STATE_CODE)
+
+DEALER_STATE = tuple(STATE[code] for code in DEALER_CODE)
+DEALER_STAND_STATE = tuple(STATE[code] for code in DEALER_STAND_CODE)
+NUM_DEALER = len(DEALER_CODE)
+
+STAND_STATE = tuple(STATE[code] for code in STAND_CODE)
+NON_SPLIT_STATE = tuple(STATE[code] for code in NON_SPLIT_CODE)
+PLAYER_STATE = tuple(STATE[code] for code in PLAYER_CODE)
+INITIAL_STATE = tuple(STATE[code] for code in INITIAL_CODE)
+SPLIT_STATE = tuple(STATE[code] for code in SPLIT_CODE)
+
+# (card x card) -> dealer column of initial dealer hand, NUM_DEALER for 'BJ'
+DEALER_PAIR_COL = tuple(tuple(NUM_DEALER if pair_state(i, j, dealer=True) == BJ_STATE
+                              else DEALER_STATE.index(pair_state(i, j, dealer=True))
+                              for j in range(NUM_CARDS))
+                        for i in range(NUM_CARDS))
+
+# unordered two card hands (i <= j), the number of each card they hold and
+# their number of orders
+MULTISET = tuple((i, j) for i in range(NUM_CARDS) for j in range(i, NUM_CARDS))
+MULTISET_CARDS = np.array([np.bincount([i, j], minlength=NUM_CARDS) for i, j in MULTISET])
+MULTISET_ORDERS = np.array([1. if i == j else 2. for i, j in MULTISET])
+MULTISET_STATE = np.array([PLAYER_PAIR_STATE[i][j] for i, j in MULTISET])
+MULTISET_COL = np.array([DEALER_PAIR_COL[i][j] for i, j in MULTISET])
+NON_INITIAL_STATE = tuple(s for s in range(NUM_STATES) if s not in INITIAL_STATE)
+PAIR_STATE_INDEX = np.array(PLAYER_PAIR_STATE) # of each ordered pair of cards
+PAIR_COL_INDEX = np.array(DEALER_PAIR_COL)
+
+def initial_deal(weights, finite=False):
+    """ Returns (state x dealer column + BJ) array of initial deal
+        probabilities, NaN outside of INITIAL_STATE.
+        weights: relative weight of each card in DISTINCT
+        finite: weights are card counts, each card dealt is removed
+
+        With weights, the player and dealer hands are independent: the
+        table is the outer product of their two card distributions. In a
+        finite shoe, card removal couples them, so each pair of dealer and
+        player two card multisets is weighed by a product of falling
+        factorials over card ranks instead """
+    weights = np.asarray(weights, dtype=float)
+    if not finite:
+        pair = np.outer(weights, weights) / weights.sum()**2
+        player = np.zeros(NUM_STATES)
+        dealer = np.zeros(NUM_DEALER + 1)
+        np.add.at(player, PAIR_STATE_INDEX, pair)
+        np.add.at(dealer, PAIR_COL_INDEX, pair)
+        initial = np.outer(player, dealer)
+        initial[list(NON_INITIAL_STATE)] = np.nan
+        return initial
+
+    draws = np.arange(4) # falling factorials, count * (count-1) * ...
+    total = np.prod(weights.sum() - draws)
+    powers = np.cumprod(np.c_[np.ones(NUM_CARDS), weights[:, None] - draws], axis=1)
+    cards = MULTISET_CARDS[:, None, :] + MULTISET_CARDS[None, :, :] # dealer x player
+    prob = np.prod(powers[np.arange(NUM_CARDS), cards], axis=-1) / total
+    prob *= np.outer(MULTISET_ORDERS, MULTISET_ORDERS)
+
+    initial = np.zeros((NUM_STATES, NUM_DEALER + 1))
+    np.add.at(initial, (MULTISET_STATE[None, :], MULTISET_COL[:, None]), prob)
+    initial[list(NON_INITIAL_STATE)] = np.nan
+    return initial
+
+def new_grid(ncols=NUM_DEALER):
+    """ Returns (state x dealer column) list of lists, initialized to None """
+    return [[None]*ncols for _ in range(NUM_STATES)]
+
+
+
+#######################
+##   DEALER SOLVER   ##
+#######################
+
+def dealer_matrix(rules=DEFAULT_RULES, codes=DEALER_CODE):
+    """ Returns (len(codes) x NUM_SCORES) array, the probability of each final
+        dealer score (index 0 for BUST) starting from each dealer code """
+    return _dealer_matrix(card_probabilities(rules), rules.dealer_stand,
+                          rules.dealer_hits_soft, tuple(codes))
+
+@functools.lru_cache(maxsize=1024)
+def _dealer_matrix(prob, stand, hits_soft, codes):
+    # A dealer hand is (hard total, holds an ace). The hands the dealer must
+    # hit on are the transient states of an absorbing Markov chain whose
+    # absorbing states are the final scores. Draws only increase the hard
+    # total, so sorting transient states makes I - Q upper triangular.
+    def score(hand):
+        total, ace = hand
+        if total > 21: return BUST
+        return total + 10 if ace and total <= 11 else total
+
+    def draws(hand):
+        total, ace = hand
+        value = score(hand)
+        if value == BUST: return False
+        return value < stand or (value == stand and hits_soft and
+                                 ace and total <= 11)
+
+    transient = [(total, ace) for total in range(1, 22) for ace in (False, True)
+                 if draws((total, ace))]
+    index = {hand: i for i, hand in enumerate(transient)}
+    q = np.zeros((len(transient), len(transient)))
+    r = np.zeros((len(transient), NUM_SCORES))
+    for i, (total, ace) in enumerate(transient):
+        for card, p in zip(DISTINCT, prob):
+            hand = (total + card_value(card), ace or card == "A")
+            if hand in index:
+                q[i, index[hand]] += p
+            else:
+                r[i, score(hand)] += p
+
+    # absorption probabilities B = (I - Q)^-1 R, in a single solve
+    absorbed = np.linalg.solve(np.eye(len(transient)) - q, r)
+
+    result = np.zeros((len(codes), NUM_SCORES))
+    for row, code in enumerate(codes):
+        cards = code2cards(code) if code != BUST_CODE else "TTT"
+        hand = (sum(map(card_value, cards)), "A" in cards)
+        if hand in index:
+            result[row] = absorbed[index[hand]]
+        else:
+            result[row, score(hand)] = 1.
+    result.flags.writeable = False # shared through the cache
+    return result
+
+
+
 ##########################
 ##   CALCULATOR CLASS   ##
 ##########################
 
 class Calculator:
-    """ Singleton class to store all the results. """
-
-    def __init__(self):
-        self.initprob = Table(float, DEALER_CODE + ['BJ'], INITIAL_CODE, unit='%')
-        self.dealprob = defaultdict(lambda: defaultdict(lambda: 0)) # initialize 0
-        self.stand_ev = Table(float, DEALER_CODE, STAND_CODE)
-        self.hit_ev = Table(float, DEALER_CODE, NON_SPLIT_CODE)
-        self.double_ev = Table(float, DEALER_CODE, NON_SPLIT_CODE)
-        self.split_ev = Table(float, DEALER_CODE, SPLIT_CODE)
-        self.optimal_ev = Table(float, DEALER_CODE, PLAYER_CODE)
-        self.strategy = Table(str, DEALER_CODE, PLAYER_CODE)
+    """ Singleton class to store all the results.
+
+        All computation is done on integer states and dealer column indices
+        (position in DEALER_CODE); results are copied into the Tables once
+        each stage completes. """
+
+    def __init__(self, rules=DEFAULT_RULES, metrics=None):
+        check_rules(rules)
+        self.rules = rules
+        self.metrics = Metrics() if metrics is None else metrics
+        self.initprob = Table(float, DEALER_CODE + ['BJ'], INITIAL_CODE, unit='%',
+                              dense=True)
+        self.dealprob = {}
+        self.stand_ev = Table(float, DEALER_CODE, STAND_CODE, dense=True)
+        self.hit_ev = Table(float, DEALER_CODE, NON_SPLIT_CODE, dense=True)
+        self.double_ev = Table(float, DEALER_CODE, NON_SPLIT_CODE, dense=True)
+        self.split_ev = Table(float, DEALER_CODE, SPLIT_CODE, dense=True)
+        self.optimal_ev = Table(float, DEALER_CODE, PLAYER_CODE, dense=True)
+        self.strategy = Table(str, DEALER_CODE, PLAYER_CODE, dense=True)
         self.advantage = 0.
-        self.resplit_ev = [Table(float, DEALER_CODE, STAND_CODE),
-                           Table(float, DEALER_CODE, SPLIT_CODE[:-1]),
-                           Table(float, DEALER_CODE, SPLIT_CODE[:-1])]
+        self.outcome = {} # net outcome of a hand: probability
+        self.variance = 0.
+        # resplit_ev[0] is the best play of a split hand, resplit_ev[n] the
+        # split EV when at most n splits are allowed
+        resplit_code = SPLIT_CODE if rules.resplit_aces else SPLIT_CODE[:-1]
+        self.resplit_ev = [Table(float, DEALER_CODE, STAND_CODE, dense=True)] + \
+                          [Table(float, DEALER_CODE, resplit_code, dense=True)
+                           for _ in range(1, rules.max_splits)]
+
+        # probability of each card, and of each ordered pair of cards
+        self.prob = card_probabilities(rules)
+        self.pairs = [(i, j, self.prob[i]*self.prob[j])
+                      for j in range(NUM_CARDS) for i in range(NUM_CARDS)]
+
+        # working storage, indexed by state (and dealer column)
+        self.init_grid = new_grid(NUM_DEALER + 1) # last column is dealer BJ
+        self.dealer = [None] * NUM_STATES # probabilities of final scores
+        self.stand = new_grid()
+        self.hit = new_grid()
+        self.double = new_grid()
+        self.resplit = [new_grid() for _ in self.resplit_ev]
+        self.middle = Memo('middle', metrics=self.metrics) # get_hit_outcome
+        self.hands = Memo('resplit0', metrics=self.metrics) # get_0split_outcome
+        self.splits = {n: Memo('resplit%d'%n, metrics=self.metrics) # get_split_outcome
+                       for n in range(1, rules.max_splits + 1)} # by splits remaining
+        self.split = new_grid()
+        self.optimal = new_grid()
+        self.action = new_grid()
+
+    @staticmethod
+    def fill_table(table, grid):
+        """ Copy values from grid into table, rows found by hand code """
+        for code in table.ylabels:
+            table.fill_row(code, grid[STATE[code]])
+
+    @staticmethod
+    def fill_grid(grid, table):
+        """ Copy values from table into grid, the inverse of fill_table """
+        for code, values in zip(table.ylabels, table.to_numpy().tolist()):
+            grid[STATE[code]] = values
 
 
     #################################
     ##  INITIAL PROBABILITY TABLE  ##
     #################################
 
-    def create_initial_cell(self, player, dealer):
-        """ Populate cell in initial probability table """
-        table = self.initprob
-        dc = dealer.code()
-        pc = player.code()
-        prob = dealer.probability() * player.probability()
-        if table[pc,dc] is None:
-            table[pc,dc] = prob
-        else:
-            table[pc,dc] += prob
-
     @profile
     def create_initial_table(self):
         """ Initialize probability table """
-        # TODO: refactor so that other table building functions can use it
-        for i in DISTINCT:
-            for j in DISTINCT:
-                for x in DISTINCT:
-                    for y in DISTINCT:
-                        dealer = Hand([i, j], dealer=True)
-                        player = Hand([x, y])
-                        self.create_initial_cell(player, dealer)
+        initial = initial_deal(self.prob)
+        for s in INITIAL_STATE:
+            self.init_grid[s] = initial[s].tolist()
+        self.fill_table(self.initprob, self.init_grid)
 
     @profile
     def verify_initial_table(self):
         """ Verify sum of initial table is close to 1 """
         total = 0.
-        for x in self.initprob.xlabels:
-            for y in self.initprob.ylabels:
-                total += self.initprob[y,x]
+        for row in self.init_grid:
+            total += sum(p for p in row if p is not None)
         assert(isclose(total))
 
 
@@ -214,29 +534,12 @@ class Calculator:
     @profile
     def create_dealer_table(self):
         """ Populate dealer table """
-        table = self.dealprob
-        # Add base cases for recursion termination
-        for code in DEALER_STAND_CODE: table[code][code2score(code)] = 1.0
-        for code in DEALER_CODE: self.get_dealer_prob(code) # memoization
-
-        # Remove bust code
-        del table[BUST_CODE]
-
-    def get_dealer_prob(self, code):
-        """ Returns probabilities of possible dealer outcomes """
-        table = self.dealprob
-        if code in table: return table[code]
-
-        curr_prob = table[code]
-        curr_prob = copy.deepcopy(table[code])
-        for card in DISTINCT: # all possible draws
-            cards = cards2code(code2cards(code)+card, dealer=True)
-            next_prob = self.get_dealer_prob(cards) # assume probs exists
-            for score, prob in next_prob.items():
-                curr_prob[score] += probability(card)*next_prob[score]
-
-        table[code] = curr_prob
-        return curr_prob # return probabilities, for recursion
+        codes = DEALER_CODE + DEALER_STAND_CODE[:-1] # without bust code
+        matrix = dealer_matrix(self.rules, codes)
+        for code, probs in zip(codes, matrix):
+            self.dealer[STATE[code]] = probs.tolist()
+            self.dealprob[code] = {score: p for score, p in
+                                   enumerate(self.dealer[STATE[code]]) if p > 0.}
 
     @profile
     def verify_dealer_table(self):
@@ -254,17 +557,18 @@ class Calculator:
         """ Populate stand EV table """
         # Assuming dealer will ALWAYS hit when not at least hard 17
         # Uses dealer table probabilities
-        table = self.stand_ev
-        for code in STAND_CODE:
-            player_score = code2score(code)
-            for dealer_code in DEALER_CODE:
+        for s in STAND_STATE:
+            player_score = SCORE[s]
+            row = self.stand[s]
+            for col, dealer_state in enumerate(DEALER_STATE):
                 payoff = 0.0
-                for dealer_score, prob in self.dealprob[dealer_code].items():
+                for dealer_score, prob in enumerate(self.dealer[dealer_state]):
                     if dealer_score == BUST or dealer_score < player_score:
                         payoff += prob
                     elif dealer_score > player_score:
                         payoff -= prob
-                table[code, dealer_code] = payoff
+                row[col] = payoff
+        self.fill_table(self.stand_ev, self.stand)
 
 
     ########################
@@ -274,31 +578,31 @@ class Calculator:
     @profile
     def create_hit_table(self):
         """ Populate hit EV table """
-        self.middle = Table(float, DEALER_CODE, NON_SPLIT_CODE)
-        for code in NON_SPLIT_CODE:
-            for dealer_code in DEALER_CODE:
+        for s in NON_SPLIT_STATE:
+            for col in range(NUM_DEALER):
                 payoff = 0.0 # process a single hit first
-                for card in DISTINCT: # all possible draws
-                    next_code = cards2code(code2cards(code)+card, nosplit=True)
-                    payoff += probability(card)*self.get_hit_outcome(next_code, dealer_code)
-                self.hit_ev[code, dealer_code] = payoff
-
-    def get_hit_outcome(self, code, dealer_code):
-        table = self.middle
-        if code == "21": return self.stand_ev["21", dealer_code]
-        if code == BUST_CODE: return -1.0
-
-        outcome = table[code, dealer_code] # memoization
-        if outcome is not None: return outcome
+                for card, next_state in enumerate(PLAYER_NEXT[s]): # all possible draws
+                    payoff += self.prob[card]*self.get_hit_outcome(next_state, col)
+                self.hit[s][col] = payoff
+        self.fill_table(self.hit_ev, self.hit)
+
+    def get_hit_outcome(self, state, col):
+        self.metrics.calls['get_hit_outcome'] += 1
+        if state == TWENTYONE_STATE: return self.stand[state][col]
+        if state == BUST_STATE: return -1.0
+
+        # integer key of (state, col), this is the hot loop
+        key = state * NUM_DEALER + col
+        outcome = self.middle.lookup(key)
+        if outcome is not None: return outcome # memoization
 
         # Hit once, and determine outcome based on optimal outcome
         payoff = 0.0
-        for card in DISTINCT: # all possible draws
-            next_code = cards2code(code2cards(code)+card, nosplit=True)
-            payoff += probability(card)*self.get_hit_outcome(next_code, dealer_code)
+        for card, next_state in enumerate(PLAYER_NEXT[state]): # all possible draws
+            payoff += self.prob[card]*self.get_hit_outcome(next_state, col)
 
-        outcome = max(self.stand_ev[code, dealer_code], payoff)
-        table[code, dealer_code] = outcome
+        outcome = max(self.stand[state][col], payoff)
+        self.middle.store(key, outcome)
         return outcome
 
 
@@ -309,17 +613,17 @@ class Calculator:
     @profile
     def create_double_table(self):
         """ Populate double EV table """
-        for code in NON_SPLIT_CODE:
-            for dealer_code in DEALER_CODE:
+        for s in NON_SPLIT_STATE:
+            for col in range(NUM_DEALER):
                 payoff = 0 # initial hit
-                for card in DISTINCT:  # all possible draws
-                    next_code = cards2code(code2cards(code)+card, nosplit=True)
-                    payoff += probability(card)*self.get_double_outcome(next_code, dealer_code)
-                self.double_ev[code, dealer_code] = payoff
+                for card, next_state in enumerate(PLAYER_NEXT[s]): # all possible draws
+                    payoff += self.prob[card]*self.get_double_outcome(next_state, col)
+                self.double[s][col] = payoff
+        self.fill_table(self.double_ev, self.double)
 
-    def get_double_outcome(self, code, dealer_code):
-        if code == BUST_CODE: return -2.0
-        return 2*self.stand_ev[code, dealer_code]
+    def get_double_outcome(self, state, col):
+        if state == BUST_STATE: return -2.0
+        return 2*self.stand[state][col]
 
 
     ##########################
@@ -329,135 +633,85 @@ class Calculator:
     @profile
     def create_split_table(self):
         """ Populate split EV table, dynamic programming style """
-        for code in STAND_CODE: # only soft and hard codes, as well as 21
-            for dealer_code in DEALER_CODE:
-                self.get_0split_outcome(code, dealer_code)
-        for code in SPLIT_CODE[:-1]: # exclude 'AA'
-            for dealer_code in DEALER_CODE:
-                self.get_1split_outcome(code, dealer_code)
-        for code in SPLIT_CODE[:-1]:
-            for dealer_code in DEALER_CODE:
-                self.get_2split_outcome(code, dealer_code)
-        for code in SPLIT_CODE:
-            for dealer_code in DEALER_CODE:
-                self.split_ev[code, dealer_code] = self.get_3split_outcome(code, dealer_code)
-
-    def get_0split_outcome(self, code, dealer_code):
-        """ Calculate best payout for all cards, i.e. max(stand, hit, double).
-            Accounts for special cases, i.e. BUST_CODE, 'BJ', split codes """
-        if code == BUST_CODE: return -1
-        if code == "BJ": code = "21" # automatic conversion of BJ -> 21
-        if code not in STAND_CODE: code = cards2code(code2cards(code), nosplit=True) # convert all split codes to stand_code
-
-        table = self.resplit_ev[0]
-        outcome = table[code, dealer_code]
+        for s in STAND_STATE: # only soft and hard codes, as well as 21
+            for col in range(NUM_DEALER):
+                self.resplit[0][s][col] = self.get_0split_outcome(s, col)
+        for s in SPLIT_STATE:
+            for col in range(NUM_DEALER):
+                self.split[s][col] = self.get_split_outcome(s, col)
+                if STATE_CODE[s] in self.resplit_ev[-1].ylabels:
+                    for splits in range(1, self.rules.max_splits):
+                        self.resplit[splits][s][col] = \
+                            self.get_split_outcome(s, col, splits)
+
+        for table, grid in zip(self.resplit_ev, self.resplit):
+            self.fill_table(table, grid)
+        self.fill_table(self.split_ev, self.split)
+
+    def get_0split_outcome(self, state, col, das=None):
+        """ Calculate best payout for all cards, i.e. max(stand, hit, double),
+            without double unless das (rules.double_after_split by default).
+            Accounts for special cases, i.e. BUST_STATE, BJ_STATE, split states """
+        self.metrics.calls['get_0split_outcome'] += 1
+        if state == BUST_STATE: return -1
+        if state == BJ_STATE: state = TWENTYONE_STATE # automatic conversion of BJ -> 21
+        state = NOSPLIT_STATE[state] # convert all split states to stand states
+        if das is None: das = self.rules.double_after_split
+
+        # integer key of (state, col, das), as above
+        key = (state * NUM_DEALER + col) * 2 + bool(das)
+        outcome = self.hands.lookup(key)
         if outcome is not None: return outcome # memoization
 
-        if code == "21":
-            payoff = self.stand_ev[code, dealer_code]
+        if state == TWENTYONE_STATE:
+            payoff = self.stand[state][col]
+        elif das:
+            payoff = max(self.stand[state][col],
+                         self.hit[state][col],
+                         self.double[state][col])
         else:
-            payoff = max(self.stand_ev[code, dealer_code],
-                         self.hit_ev[code, dealer_code],
-                         self.double_ev[code, dealer_code])
+            payoff = max(self.stand[state][col], self.hit[state][col])
 
-        table[code, dealer_code] = payoff
+        self.hands.store(key, payoff)
         return payoff
 
-    def get_1split_outcome(self, code, dealer_code):
-        """ Calculate payout for split code except 'AA' for maximum of 1 split,
-            including current split, i.e. no additional splits """
-        table = self.resplit_ev[1]
-        outcome = table[code, dealer_code]
+    def get_0split_outcomes(self, split_card, col, das=None):
+        """ Outcome of a split hand for each card drawn onto split_card,
+            without resplitting. Split aces receive one card and stand """
+        if DISTINCT[split_card] == "A":
+            return [self.stand[TWENTYONE_STATE if s == BJ_STATE else NOSPLIT_STATE[s]][col]
+                    for s in PAIR_STATE[split_card]]
+        return [self.get_0split_outcome(s, col, das) for s in PAIR_STATE[split_card]]
+
+    def get_split_outcome(self, state, col, splits_remaining=None, das=None, rsa=None):
+        """ Calculate payout for split state when at most splits_remaining
+            splits, including this one, may still be made (rules.max_splits
+            by default). das: double after split, rsa: resplit aces, both
+            default to the rules. Memoized on (split card, dealer column,
+            das, rsa) in the memo of splits_remaining, so each depth is
+            computed once and reports its own hit rate """
+        self.metrics.calls['get_split_outcome'] += 1
+        rules = self.rules
+        if splits_remaining is None: splits_remaining = rules.max_splits
+        if das is None: das = rules.double_after_split
+        if rsa is None: rsa = rules.resplit_aces
+
+        split_card = SPLIT_CARD[state]
+        memo, key = self.splits[splits_remaining], (split_card, col, das, rsa)
+        outcome = memo.lookup(key)
         if outcome is not None: return outcome # memoization
 
-        split_card = code[0] # valid since code is SPLIT_CODE
-        payoff = 0.0
-
-        for card1, card2 in generate_card_pairs():
-            total_probability = probability(card1)*probability(card2)
+        outcomes = self.get_0split_outcomes(split_card, col, das)
+        q, own = self.prob[split_card], outcomes[split_card]
+        other = sum(p*f for p, f in zip(self.prob, outcomes)) - q*own
+        can_resplit = DISTINCT[split_card] != "A" or rsa
 
-            next_code1 = cards2code(split_card+card1, nosplit=True)
-            next_code2 = cards2code(split_card+card2, nosplit=True)
-            payoff += total_probability*self.get_0split_outcome(next_code1, dealer_code)
-            payoff += total_probability*self.get_0split_outcome(next_code2, dealer_code)
+        def value(splits): # hand that drew the split card
+            if splits == 0 or not can_resplit: return own
+            return self.get_split_outcome(state, col, splits, das, rsa)
 
-        table[code, dealer_code] = payoff
-        return payoff
-
-    def get_2split_outcome(self, code, dealer_code):
-        """ Calculate payout for split code except 'AA' for maximum of 2 splits,
-            including current split, i.e. 1 more additional split """
-        table = self.resplit_ev[2]
-        outcome = table[code, dealer_code]
-        if outcome is not None: return outcome # memoization
-
-        split_card = code[0] # valid since code is SPLIT_CODE
-        payoff = 0.0
-
-        for card1, card2 in generate_card_pairs():
-            total_probability = probability(card1)*probability(card2)
-
-            # can split once more
-            if split_card in (card1, card2):
-                if card1 != split_card: card1, card2 = card2, card1 # to split with card1 only
-                next_code1 = code
-                next_code2 = cards2code(split_card+card2, nosplit=True)
-                payoff += total_probability*self.get_1split_outcome(next_code1, dealer_code)
-                payoff += total_probability*self.get_0split_outcome(next_code2, dealer_code)
-
-            # no more splits
-            else:
-                next_code1 = cards2code(split_card+card1, nosplit=True)
-                next_code2 = cards2code(split_card+card2, nosplit=True)
-                payoff += total_probability*self.get_0split_outcome(next_code1, dealer_code)
-                payoff += total_probability*self.get_0split_outcome(next_code2, dealer_code)
-
-        table[code, dealer_code] = payoff
-        return payoff
-
-    def get_3split_outcome(self, code, dealer_code):
-        """ Calculate payout for split code including 'AA' for maximum of 3 splits
-            (total of four hands), i.e. 2 more additional splits """
-        table = self.split_ev
-        outcome = table[code, dealer_code]
-        if outcome is not None: return outcome # memoization
-
-        split_card = code[0]
-        payoff = 0.0
-
-        for card1, card2 in generate_card_pairs():
-            total_probability = probability(card1)*probability(card2)
-
-            # special case for 'AA', i.e. no additional actions after split
-            if split_card == "A":
-                next_code1 = cards2code(split_card+card1, nosplit=True)
-                next_code2 = cards2code(split_card+card2, nosplit=True)
-                if next_code1 == "BJ": next_code1 = "21"
-                if next_code2 == "BJ": next_code2 = "21"
-                payoff += total_probability*self.stand_ev[next_code1, dealer_code]
-                payoff += total_probability*self.stand_ev[next_code2, dealer_code]
-
-            # both cards can split
-            elif split_card == card1 == card2:
-                next_code = code
-                payoff += 2*total_probability*self.get_1split_outcome(next_code, dealer_code)
-
-            # only one can split
-            elif split_card in (card1, card2):
-                if split_card != card1: card1, card2 = card2, card1
-                next_code1 = code # can split using card1 only
-                next_code2 = cards2code(split_card+card2, nosplit=True)
-                payoff += total_probability*self.get_2split_outcome(next_code1, dealer_code)
-                payoff += total_probability*self.get_0split_outcome(next_code2, dealer_code)
-
-            # none of the cards can split, same code as for case 'AA' (for more logical ordering)
-            else:
-                next_code1 = cards2code(split_card+card1, nosplit=True)
-                next_code2 = cards2code(split_card+card2, nosplit=True)
-                payoff += total_probability*self.get_0split_outcome(next_code1, dealer_code)
-                payoff += total_probability*self.get_0split_outcome(next_code2, dealer_code)
-
-        table[code, dealer_code] = payoff
+        payoff = split_payoff(other, q, value, splits_remaining)
+        memo.store(key, payoff)
         return payoff
 
 
@@ -468,54 +722,26 @@ class Calculator:
     @profile
     def create_optimal_table(self):
         """ Populate optimal EV table and strategy """
-        for code in PLAYER_CODE:
-            for dealer_code in DEALER_CODE:
-                evs = {"R": -0.5}
-                tables = (self.stand_ev, self.hit_ev, self.double_ev, self.split_ev)
-                actions = ("S", "H", "D", "P")
-                for table, action in zip(tables, actions):
-                    try:
-                        evs[action] = table[code, dealer_code]
-                    except KeyError:
-                        try:
-                            evs[action] = table[cards2code(code, nosplit=True), dealer_code] # stand/hit for split_codes
-                        except:
-                            pass # ignore non-valid accesses, i.e. non-valid action
+        for s in PLAYER_STATE:
+            play = NOSPLIT_STATE[s] # stand/hit/double for split states
+            for col in range(NUM_DEALER):
+                stand_hit = [("S", self.stand[play][col]),
+                             ("H", self.hit[play][col])]
+                evs = [("R", -0.5)] if self.rules.surrender else []
+                evs += stand_hit + [("D", self.double[play][col])]
+                if SPLIT_CARD[s] is not None:
+                    evs.append(("P", self.split[s][col]))
 
                 # best action
-                opt_action, opt_ev = max(evs.items(), key=lambda kv: kv[1])
-                if opt_action in ("D", "P", "R"):
-                    opt_action += max(filter(lambda kv: kv[0] not in ("D", "P", "R"), evs.items()), key=lambda kv: kv[1])[0].lower()
-
-                self.optimal_ev[code, dealer_code] = opt_ev
-                self.strategy[code, dealer_code] = opt_action
-
-    def create_optimal_table(self):
-        """ Populate optimal EV table and strategy """
-        for code in PLAYER_CODE:
-            for dealer_code in DEALER_CODE:
-                evs = {"R": -0.5}
-                tables = (self.stand_ev, self.hit_ev, self.double_ev, self.split_ev)
-                actions = ("S", "H", "D", "P")
-                for table, action in zip(tables, actions):
-                    try:
-                        evs[action] = table[code, dealer_code]
-                    except KeyError:
-                        try:
-                            evs[action] = table[
-                                cards2code(code, nosplit=True), dealer_code]  # stand/hit for split_codes
-                        except:
-                            pass  # ignore non-valid accesses, i.e. non-valid action
-
-                # best action
-                opt_action, opt_ev = max(evs.items(), key=lambda kv: kv[1])
+                opt_action, opt_ev = max(evs, key=lambda kv: kv[1])
                 if opt_action in ("D", "R"):
-                    opt_action += \
-                        max(filter(lambda kv: kv[0] not in ("D", "P", "R"), evs.items()), key=lambda kv: kv[1])[
-                            0].lower()
+                    opt_action += max(stand_hit, key=lambda kv: kv[1])[0].lower()
+
+                self.optimal[s][col] = opt_ev
+                self.action[s][col] = opt_action
 
-                self.optimal_ev[code, dealer_code] = opt_ev
-                self.strategy[code, dealer_code] = opt_action
+        self.fill_table(self.optimal_ev, self.optimal)
+        self.fill_table(self.strategy, self.action)
 
 
     ########################
@@ -524,47 +750,332 @@ class Calculator:
 
     @profile
     def calculate_player_advantage(self):
-        for pc in INITIAL_CODE:
-            for dc in DEALER_CODE + ["BJ"]:
-                if dc == "BJ" and pc == "BJ": continue
-                elif dc != "BJ" and pc == "BJ":
-                    self.advantage += self.initprob[pc, dc] * 1.5
-                elif dc == "BJ" and pc != "BJ":
-                    self.advantage += self.initprob[pc, dc] * -1
+        for s in INITIAL_STATE:
+            row = self.init_grid[s]
+            for col in range(NUM_DEALER + 1):
+                if col == NUM_DEALER and s == BJ_STATE: continue
+                elif col != NUM_DEALER and s == BJ_STATE:
+                    self.advantage += row[col] * self.rules.blackjack_pays
+                elif col == NUM_DEALER and s != BJ_STATE:
+                    self.advantage += row[col] * -1
                 else:
-                    self.advantage += self.initprob[pc, dc]\
-                                    * self.optimal_ev[pc, dc]
+                    self.advantage += row[col] * self.optimal[s][col]
+
+
+    ############################
+    ##  OUTCOME DISTRIBUTION  ##
+    ############################
+
+    @profile
+    def create_outcome_table(self):
+        """ Populate distribution of the net outcome of a hand, and its
+            variance, see vectorized.outcome_distribution """
+        import vectorized # imports this module
+        grid = lambda grid: np.array(grid, dtype=float)
+        dealer = np.array([self.dealer[s] for s in DEALER_STATE])
+        self.outcome, self.variance = vectorized.outcome_result(
+            self.rules, grid(self.init_grid), dealer, grid(self.stand),
+            grid(self.hit), grid(self.double), self.action)
+
+    def result(self):
+        """ Returns dictionary of all tables, see calculate() """
+        return {
+            'initial' : self.initprob,
+            'dealer' : self.dealprob,
+            'stand' : self.stand_ev,
+            'hit' : self.hit_ev,
+            'double' : self.double_ev,
+            'resplit': self.resplit_ev,
+            'split' : self.split_ev,
+            'optimal' : self.optimal_ev,
+            'strategy' : self.strategy,
+            'advantage' : self.advantage,
+            'outcome' : self.outcome,
+            'variance' : self.variance,
+        }
+
+
+
+#####################
+##   LAZY RESULT   ##
+#####################
+
+# result name: (results it depends on, Calculator methods that produce it)
+STAGES = {
+    'initial' : ([], ['create_initial_table', 'verify_initial_table']),
+    'dealer' : ([], ['create_dealer_table', 'verify_dealer_table']),
+    'stand' : (['dealer'], ['create_stand_table']),
+    'hit' : (['stand'], ['create_hit_table']),
+    'double' : (['stand'], ['create_double_table']),
+    'resplit' : (['hit', 'double'], ['create_split_table']),
+    'split' : (['resplit'], []), # filled along with resplit
+    'optimal' : (['split'], ['create_optimal_table']),
+    'strategy' : (['optimal'], []), # filled along with optimal
+    'advantage' : (['initial', 'optimal'], ['calculate_player_advantage']),
+    'outcome' : (['initial', 'optimal'], ['create_outcome_table']),
+    'variance' : (['outcome'], []), # filled along with outcome
+}
+
+class LazyResult(Mapping):
+    """ Result dictionary of calculate() that only runs the stages a result
+        needs when it is first accessed """
+
+    def __init__(self, calc):
+        self.calc = calc
+        self.metrics = calc.metrics
+        self.done = set()
+
+    def run(self, name):
+        """ Run the stage producing name, after its dependencies """
+        if name in self.done: return
+        depends, methods = STAGES[name]
+        for dependency in depends:
+            self.run(dependency)
+        for method in methods:
+            getattr(self.calc, method)()
+        self.done.add(name)
+
+    def __getitem__(self, name):
+        if name not in STAGES:
+            raise KeyError(name)
+        self.run(name)
+        return self.calc.result()[name]
+
+    def __contains__(self, name):
+        return name in STAGES # without computing it
+
+    def __iter__(self):
+        return iter(STAGES)
+
+    def __len__(self):
+        return len(STAGES)
+
+
+
+###################################
+##   INCREMENTAL RECALCULATION   ##
+###################################
+
+# rule: results whose stage reads it, the results depending on them follow.
+# weights are read through the card probabilities, see CARD_STAGES
+RULE_STAGES = {
+    'dealer_stand' : ['dealer'],
+    'dealer_hits_soft' : ['dealer'],
+    'blackjack_pays' : ['advantage', 'outcome'],
+    'surrender' : ['optimal'],
+    'max_splits' : ['resplit', 'outcome'],
+    'double_after_split' : ['resplit', 'outcome'],
+    'resplit_aces' : ['resplit', 'outcome'],
+}
+
+# results whose stage reads the card probabilities, i.e. card_probabilities(),
+# which follow rules.weights, or NUM_FACES and NUM_RANKS without weights
+CARD_STAGES = ['initial', 'dealer', 'hit', 'double', 'resplit', 'outcome']
+
+# result: Calculator attributes holding it
+STAGE_ATTRIBUTES = {
+    'initial' : ['initprob', 'init_grid'],
+    'dealer' : ['dealprob', 'dealer'],
+    'stand' : ['stand_ev', 'stand'],
+    'hit' : ['hit_ev', 'hit'],
+    'double' : ['double_ev', 'double'],
+    'resplit' : ['resplit_ev', 'resplit'],
+    'split' : ['split_ev', 'split'],
+    'optimal' : ['optimal_ev', 'optimal'],
+    'strategy' : ['strategy', 'action'],
+    'advantage' : ['advantage'],
+    'outcome' : ['outcome'],
+    'variance' : ['variance'],
+}
+
+def changed_stages(old, new, old_prob=None):
+    """ Returns set of results that differ between Rules old and new: those
+        read by a stage using a changed rule or card probability, and
+        everything depending on them
+        old_prob: card probabilities the old results were computed with,
+                  card_probabilities(old) by default """
+    changed = set()
+    for field, stages in RULE_STAGES.items():
+        if getattr(old, field) != getattr(new, field):
+            changed.update(stages)
+    if old_prob is None: old_prob = card_probabilities(old)
+    if tuple(old_prob) != card_probabilities(new):
+        changed.update(CARD_STAGES)
+    grew = True
+    while grew:
+        grew = False
+        for name, (depends, _) in STAGES.items():
+            if name not in changed and changed.intersection(depends):
+                changed.add(name)
+                grew = True
+    return changed
+
+def recalculate(previous, rules=DEFAULT_RULES, metrics=None):
+    """ Returns calculate() result for rules from the LazyResult previous
+        of other rules: the results it has already computed that no
+        changed rule affects (see changed_stages) are shared with it, and
+        only the others are computed again, lazily. E.g. after changing
+        surrender, only create_optimal_table and the advantage run """
+    calc = previous.calc
+    result = LazyResult(Calculator(rules, metrics))
+    kept = previous.done - changed_stages(calc.rules, rules, calc.prob)
+    kept.update([name for name, (depends, methods) in STAGES.items()
+                 if not methods and kept.issuperset(depends)]) # filled along
+    for name in kept:
+        for attribute in STAGE_ATTRIBUTES[name]:
+            setattr(result.calc, attribute, getattr(calc, attribute))
+    result.done.update(kept)
+    return result
+
+
+
+##########################
+##   PARALLEL COLUMNS   ##
+##########################
 
-def calculate():
+# (table, grid) attributes of the Calculator holding the values of a single
+# dealer column each
+COLUMN_TABLES = [('stand_ev', 'stand'), ('hit_ev', 'hit'), ('double_ev', 'double'),
+                 ('split_ev', 'split'), ('optimal_ev', 'optimal'),
+                 ('strategy', 'action')]
+
+def parallel_workers(workers, tasks=NUM_DEALER):
+    """ Returns number of processes worth starting for workers, None or 1
+        running in process: at most one per CPU the process may run on, and
+        per task (dealer columns by default). Every entry point taking
+        workers goes through it """
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    return max(1, min(workers or 1, cpus, tasks))
+
+def column_parts(workers, cols=range(NUM_DEALER)):
+    """ Returns dealer columns of cols of each worker, interleaved so that
+        the cheap and costly columns are spread evenly """
+    cols = list(cols)
+    return [cols[i::workers] for i in range(min(workers, len(cols)))]
+
+
+
+######################
+##   RESULT CACHE   ##
+######################
+
+CACHE_ENV = "EASYBJ_CACHE" # environment variable naming a cache directory
+CACHE_VERSION = 2 # layout of saved result files
+CACHE_DEALER_CODE = DEALER_CODE + DEALER_STAND_CODE[:-1]
+CACHE_TABLES = ['initial', 'stand', 'hit', 'double', 'split', 'optimal']
+
+CACHE_SOURCES = ['easybj', 'table', 'memo', 'vectorized'] # compute saved arrays
+
+@functools.lru_cache(maxsize=1)
+def code_version():
+    """ Returns hash of the source of CACHE_SOURCES, so that saved results
+        are ignored once the code changes """
+    digest = hashlib.sha256()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for module in CACHE_SOURCES:
+        with open(os.path.join(directory, module + ".py"), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def result_path(cache_dir, rules=DEFAULT_RULES):
+    """ Returns file holding the result for rules in cache_dir """
+    key = "%d %r %r %s"%(CACHE_VERSION, tuple(rules), card_probabilities(rules),
+                         code_version())
+    name = hashlib.sha256(key.encode()).hexdigest()[:24]
+    return os.path.join(cache_dir, "easybj-%s.npz"%name)
+
+def save_result(path, result):
+    """ Write calculate() result to path as npz, atomically """
+    arrays = {name: result[name].to_numpy() for name in CACHE_TABLES}
+    for i, table in enumerate(result['resplit']):
+        arrays['resplit%d'%i] = table.to_numpy()
+    arrays['strategy'] = np.array([[value or '' for value in row]
+                                   for row in result['strategy'].to_numpy()])
+    arrays['dealer'] = np.array([[result['dealer'][code].get(score, 0.)
+                                  for score in range(NUM_SCORES)]
+                                 for code in CACHE_DEALER_CODE])
+    arrays['advantage'] = np.array(result['advantage'])
+    arrays['outcome'] = np.array(sorted(result['outcome'].items())).reshape(-1, 2)
+    arrays['variance'] = np.array(result['variance'])
+    arrays['version'] = np.array(CACHE_VERSION)
+
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, temp = tempfile.mkstemp(suffix=".npz", dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(temp, path)
+    except BaseException:
+        os.remove(temp)
+        raise
+
+def load_result(path, rules=DEFAULT_RULES, metrics=None):
+    """ Returns calculate() result saved at path, a LazyResult with every
+        stage done, None if it is missing or unreadable """
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            if int(data['version']) != CACHE_VERSION: return None
+            arrays = {name: data[name] for name in data.files}
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        return None
+
+    calc = Calculator(rules, metrics)
+    tables = [calc.initprob, calc.stand_ev, calc.hit_ev, calc.double_ev,
+              calc.split_ev, calc.optimal_ev]
+    for name, table in zip(CACHE_TABLES, tables):
+        table.to_numpy()[:] = arrays[name]
+    for i, table in enumerate(calc.resplit_ev):
+        table.to_numpy()[:] = arrays['resplit%d'%i]
+    for code, values in zip(PLAYER_CODE, arrays['strategy']):
+        calc.strategy.fill_row(code, [value or None for value in values.tolist()])
+    for code, probs in zip(CACHE_DEALER_CODE, arrays['dealer'].tolist()):
+        calc.dealer[STATE[code]] = probs
+        calc.dealprob[code] = {score: p for score, p in enumerate(probs) if p > 0.}
+    calc.advantage = float(arrays['advantage'])
+    calc.outcome = {x: p for x, p in arrays['outcome'].tolist()}
+    calc.variance = float(arrays['variance'])
+
+    # working grids, for recalculate
+    calc.fill_grid(calc.init_grid, calc.initprob)
+    for table, grid in COLUMN_TABLES:
+        calc.fill_grid(getattr(calc, grid), getattr(calc, table))
+    for table, grid in zip(calc.resplit_ev, calc.resplit):
+        calc.fill_grid(grid, table)
+    result = LazyResult(calc)
+    result.done.update(STAGES)
+    return result
+
+
+def calculate(rules=DEFAULT_RULES, cache_dir=None, metrics=None):
     """ Returns a dictionary containing all calculated ev tables and
-        final strategy table """
-
-    calc = Calculator()
-
-    calc.create_initial_table()
-    calc.verify_initial_table()
-    calc.create_dealer_table()
-    calc.verify_dealer_table()
-    calc.create_stand_table()
-    calc.create_hit_table()
-    calc.create_double_table()
-    calc.create_split_table()
-    calc.create_optimal_table()
-    calc.calculate_player_advantage()
-
-
-    return {
-        'initial' : calc.initprob,
-        'dealer' : calc.dealprob,
-        'stand' : calc.stand_ev,
-        'hit' : calc.hit_ev,
-        'double' : calc.double_ev,
-        'resplit': calc.resplit_ev,
-        'split' : calc.split_ev,
-        'optimal' : calc.optimal_ev,
-        'strategy' : calc.strategy,
-        'advantage' : calc.advantage,
-    }
+        final strategy table. Tables are computed when first accessed,
+        see STAGES
+        cache_dir: directory of saved results, defaults to $EASYBJ_CACHE.
+                   Results are loaded from it when present, and saved to
+                   it otherwise
+        metrics: Metrics recording the stages run, see metrics.py
+        Every stage runs in process: a rule set takes about 40 ms, less
+        than starting a process pool. composition.calculate, whose dealer
+        columns take tenths of a second each, shares them among workers """
+    metrics = Metrics() if metrics is None else metrics
+    cache_dir = cache_dir or os.environ.get(CACHE_ENV)
+    if cache_dir:
+        path = result_path(cache_dir, rules)
+        with metrics.stage('load_result'):
+            result = load_result(path, rules, metrics)
+        if result is not None: return result
+
+    result = LazyResult(Calculator(rules, metrics))
+    if cache_dir:
+        try:
+            save_result(path, result) # computes every stage
+        except OSError: # the cache is best-effort
+            pass
+    return result
 
 if __name__ == "__main__":
     result = calculate()
@@ -578,4 +1089,4 @@ if __name__ == "__main__":
     strategy = result["strategy"]
     a = result["advantage"]
 
-    print(PERFORMANCE_DATA)
+    print(result.metrics.report())
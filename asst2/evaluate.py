@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+#
+# evaluate.py
+#
+# Exact player advantage of a fixed, possibly suboptimal strategy. The
+# recursions of the vectorized engine are followed with the action the
+# strategy picks in every state (including fallbacks such as Dh or Rh)
+# instead of the best one.
+#
+# usage: evaluate.py FILE ...
+#
+
+import sys
+import numpy as np
+from easybj import *
+from table import Table
+from vectorized import VectorCalculator, HIT_ORDER, SPLIT_CARDS, ACE, \
+                       calculate_player_advantage
+from simulate import load_strategy, lookup_table, NULL, STAND, HIT, \
+                     DOUBLE, SPLIT, SURRENDER, CAN_DOUBLE, CAN_SPLIT, CAN_SURRENDER
+
+
+
+###################
+##   CONSTANTS   ##
+###################
+
+# strategy row of each two card state, and the hard row of the same points
+# tried when no letter of the row applies
+ROW = np.full(NUM_STATES, -1)
+ROW[list(PLAYER_STATE)] = np.arange(len(PLAYER_STATE))
+ALT_ROW = np.array(SCORE) - 4
+
+
+
+###########################
+##   UTILITY FUNCTIONS   ##
+###########################
+
+def strategy_cells(strategy):
+    """ Returns (PLAYER_CODE x DEALER_CODE) array of upper case strategy
+        strings from a strategy Table (e.g. calculate()["strategy"]), the
+        path of an asst1 strategy file, or an array from load_strategy """
+    if isinstance(strategy, str):
+        cells = load_strategy(strategy)
+    elif isinstance(strategy, Table):
+        cells = strategy.to_numpy()
+    else:
+        cells = np.asarray(strategy, dtype=object)
+    return np.array([[text.upper() if text else None for text in row]
+                     for row in cells], dtype=object)
+
+def choose(table, s, mask):
+    """ Returns action of state s in every dealer column, as played by the
+        simulator: the row, then the alternative row, then stand """
+    cols = np.arange(NUM_DEALER)
+    action = table[ROW[s], cols, mask]
+    action = np.where(action == NULL, table[ALT_ROW[s], cols, mask], action)
+    return np.where(action == NULL, STAND, action)
+
+def pick(action, stand, hit, double, split=np.nan):
+    """ Returns EV of the chosen action in every dealer column """
+    evs = np.zeros((SURRENDER + 1, NUM_DEALER))
+    evs[STAND], evs[HIT], evs[DOUBLE], evs[SPLIT], evs[SURRENDER] = \
+        stand, hit, double, split, -0.5
+    return np.take_along_axis(evs, action[None], axis=0)[0]
+
+
+
+#########################
+##   STRATEGY TABLES   ##
+#########################
+
+def create_hit_table(calc, stand, table):
+    """ Returns hit EVs when every later decision (stand or hit) is taken
+        from the strategy """
+    middle = np.zeros((NUM_STATES, NUM_DEALER))
+    middle[TWENTYONE_STATE] = stand[TWENTYONE_STATE]
+    middle[BUST_STATE] = -1.
+    for s in HIT_ORDER:
+        hit = calc.prob @ middle[list(PLAYER_NEXT[s])]
+        middle[s] = np.where(choose(table, s, 0) == HIT, hit, stand[s])
+
+    hit = np.full((NUM_STATES, NUM_DEALER), np.nan)
+    hit[list(NON_SPLIT_STATE)] = (calc.hit_matrix @ middle)[list(NON_SPLIT_STATE)]
+    return hit
+
+def create_split_table(calc, stand, hit, double, table):
+    """ Returns split EVs of the pair states when split hands follow the
+        strategy, resplits share the splits left as in split_payoff """
+    rules = calc.rules
+    das = CAN_DOUBLE if rules.double_after_split else 0
+    split = np.full((NUM_STATES, NUM_DEALER), np.nan)
+    for k in SPLIT_CARDS:
+        pair = PLAYER_PAIR_STATE[k][k]
+
+        # outcome of a split hand drawing each card, without resplitting
+        outcome = np.zeros((NUM_CARDS, NUM_DEALER))
+        for card, s in enumerate(PLAYER_PAIR_STATE[k]):
+            n = NOSPLIT_STATE[s]
+            if s == BJ_STATE:
+                outcome[card] = stand[TWENTYONE_STATE]
+            elif k == ACE:
+                outcome[card] = stand[n] # split aces stand
+            else:
+                outcome[card] = pick(choose(table, s, das), stand[n], hit[n], double[n])
+        q = calc.prob[k]
+        own = outcome[k]
+        other = calc.prob @ outcome - q*own
+
+        # values[n]: EV of a split hand holding the pair with n splits left
+        values = [own]
+        for splits in range(1, rules.max_splits + 1):
+            ev = split_payoff(other, q, lambda n: values[n], splits)
+            if splits == rules.max_splits: break
+            n = NOSPLIT_STATE[pair]
+            if k != ACE:
+                action = choose(table, pair, das | CAN_SPLIT)
+                values.append(pick(action, stand[n], hit[n], double[n], ev))
+            elif rules.resplit_aces:
+                action = choose(table, pair, CAN_SPLIT)
+                values.append(np.where(action == SPLIT, ev, own))
+            else:
+                values.append(own)
+        split[pair] = ev
+    return split
+
+def create_strategy_table(calc, stand, hit, double, split, table):
+    """ Returns (state x dealer column) EVs of the two card hands """
+    rules = calc.rules
+    first = CAN_DOUBLE | (CAN_SURRENDER if rules.surrender else 0)
+    values = np.full((NUM_STATES, NUM_DEALER), np.nan)
+    for s in PLAYER_STATE:
+        n = NOSPLIT_STATE[s]
+        mask = first | (CAN_SPLIT if s in SPLIT_STATE else 0)
+        values[s] = pick(choose(table, s, mask), stand[n], hit[n], double[n], split[s])
+    return values
+
+
+def evaluate_strategy(strategy, rules=DEFAULT_RULES):
+    """ Returns the exact player advantage of playing strategy, see
+        strategy_cells for the accepted forms """
+    table = lookup_table(strategy_cells(strategy))
+    calc = VectorCalculator(rules)
+    initial = calc.create_initial_table()
+    stand = calc.create_stand_table(calc.create_dealer_table())
+    hit = create_hit_table(calc, stand, table)
+    double = calc.create_double_table(stand)
+    split = create_split_table(calc, stand, hit, double, table)
+    values = create_strategy_table(calc, stand, hit, double, split, table)
+    return calculate_player_advantage(initial, values, rules)
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        print("%s: Player Advantage: %.4g%%" % (path, evaluate_strategy(path) * 100))
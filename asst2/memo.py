@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+#
+# memo.py
+#
+# Memo of the recursive helpers of the calculators: a dictionary keyed on
+# compact state tuples that counts hits and misses, optionally bounded by
+# a memory budget with least recently used entries evicted first
+#
+
+import sys
+from collections import OrderedDict
+
+FLOAT_BYTES = sys.getsizeof(0.)
+
+
+
+####################
+##   MEMO CLASS   ##
+####################
+
+class Memo:
+    """ Memoized values by key, None is never stored.
+
+        name: reported in metrics, which lists the memo's statistics when
+              given (see Metrics.as_dict)
+        max_bytes: approximate memory budget, None for no limit. Sizes are
+                   only tracked when bounded, so unbounded memos stay as
+                   fast as a dict: their store() is the dict's own. """
+
+    def __init__(self, name="memo", max_bytes=None, metrics=None):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.data = OrderedDict() if max_bytes is not None else {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if max_bytes is None:
+            self.store = self.data.__setitem__ # nothing to track
+        if metrics is not None:
+            metrics.memos.append(self)
+
+    @staticmethod
+    def sizeof(key, value):
+        """ Approximate memory held by an entry, counting a float for each
+            element of a list value """
+        size = sys.getsizeof(key) + sys.getsizeof(value)
+        if type(value) is list:
+            size += len(value) * FLOAT_BYTES
+        return size
+
+    def lookup(self, key):
+        """ Returns value of key, None if not memoized """
+        value = self.data.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.max_bytes is not None:
+            self.data.move_to_end(key)
+        return value
+
+    def store(self, key, value):
+        """ Memoize value of key, evicting least recently used values over
+            the memory budget """
+        if self.max_bytes is None:
+            self.data[key] = value
+            return
+        if key in self.data:
+            self.bytes -= self.sizeof(key, self.data.pop(key))
+        self.data[key] = value
+        self.bytes += self.sizeof(key, value)
+        while self.bytes > self.max_bytes and len(self.data) > 1:
+            old_key, old_value = self.data.popitem(last=False)
+            self.bytes -= self.sizeof(old_key, old_value)
+            self.evictions += 1
+
+    def __contains__(self, key):
+        return key in self.data # without counting a hit
+
+    def __len__(self):
+        return len(self.data)
+
+    def snapshot(self):
+        """ Returns {key: value} copy of the memoized values, least recently
+            used first """
+        return dict(self.data)
+
+    def restore(self, snapshot):
+        """ Replace the memoized values by those of a snapshot, within the
+            memory budget """
+        self.data.clear()
+        self.bytes = 0
+        for key, value in snapshot.items():
+            self.store(key, value)
+
+    def stats(self):
+        """ Returns dictionary of the hit, miss and size counters """
+        lookups = self.hits + self.misses
+        stats = {"hits": self.hits, "misses": self.misses,
+                 "hit_rate": self.hits / lookups if lookups else None,
+                 "size": len(self.data), "evictions": self.evictions}
+        if self.max_bytes is not None:
+            stats["bytes"] = self.bytes
+        return stats
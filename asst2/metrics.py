@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+#
+# metrics.py
+#
+# Registry of timings, call counts and memo statistics recorded by the
+# calculator, exportable as JSON
+#
+
+import json
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+try:
+    import resource # not available on Windows
+except ImportError:
+    resource = None
+
+
+
+###########################
+##   UTILITY FUNCTIONS   ##
+###########################
+
+def peak_rss():
+    """ Returns peak resident memory of the process in bytes, None if unknown """
+    if resource is None: return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # kB on Linux
+
+
+
+#######################
+##   METRICS CLASS   ##
+#######################
+
+class Metrics:
+    """ Records, for each stage, wall and CPU time and the number of runs,
+        plus counters for calls of recursive helpers and the statistics of
+        the memos reporting to it.
+
+        trace_memory: also record peak Python allocations of each stage with
+                      tracemalloc, which slows the calculation down """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.stages = {}
+        self.calls = defaultdict(int)
+        self.memos = [] # Memo objects reporting here, see memo.py
+
+    @contextmanager
+    def stage(self, name):
+        """ Time the enclosed block as a run of stage name """
+        tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if tracing: tracemalloc.start()
+        if self.trace_memory: tracemalloc.reset_peak()
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            record = self.stages.setdefault(name, {"runs": 0, "wall": 0., "cpu": 0.})
+            record["runs"] += 1
+            record["wall"] += time.perf_counter() - start_wall
+            record["cpu"] += time.process_time() - start_cpu
+            if self.trace_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                record["peak_bytes"] = max(record.get("peak_bytes", 0), peak)
+            if tracing: tracemalloc.stop()
+
+    def as_dict(self):
+        """ Returns all metrics as plain dictionaries """
+        memo = {m.name: m.stats() for m in self.memos}
+        return {
+            "stages": self.stages,
+            "calls": dict(self.calls),
+            "memo": memo,
+            "peak_rss_bytes": peak_rss(),
+        }
+
+    def to_json(self, indent=None):
+        return json.dumps(self.as_dict(), indent=indent)
+
+    def report(self):
+        """ Returns one line of timings per stage """
+        return "".join("\nINFO: {} ran in {:.3f} seconds.".format(name, record["wall"])
+                       for name, record in self.stages.items())
@@ -1,5 +1,7 @@
+import os
 import unittest
 from easybj import *
+from table import Table
 
 class TestHandMethods(unittest.TestCase):
 
@@ -150,6 +152,771 @@ class TestHandMethods(unittest.TestCase):
         _(self.d_t4a7.value(), BUST)
         _(self.d_t68.value(), BUST)
 
+    def test_flyweight(self):
+        _ = self.assertIs
+
+        _(self.h_at, self.h_ta)
+        _(self.h_a8, self.h_8a)
+        _(Hand("T4").add("A").add("7"), Hand("T4A7"))
+        _(Hand("A").add("A").add("A").add("A"), self.h_aaaa)
+        _(Hand("A", dealer=True).add("6"), self.d_a6)
+        self.assertIsNot(self.h_a6, self.d_a6)
+        self.assertEqual(Hand("4").add("4").code(), "44")
+        self.assertEqual(self.h_t9.total, 19)
+        self.assertTrue(self.h_44a.soft)
+        self.assertFalse(self.h_a84.soft) # hard 13 holding an ace
+        self.assertFalse(Hand("T9A").soft)
+        self.assertEqual(Hand("T9A").value(), 20)
+        self.assertTrue(self.h_55.pair)
+        self.assertFalse(self.h_236.pair)
+        with self.assertRaises(AttributeError):
+            self.h_23.is_dealer = True
+
+    def test_pickle(self):
+        import copy
+        import pickle
+        for hand in (self.h_at, self.d_a6):
+            self.assertIs(pickle.loads(pickle.dumps(hand)), hand)
+            self.assertIs(copy.copy(hand), hand)
+            self.assertIs(copy.deepcopy(hand), hand)
+
+
+class TestTable(unittest.TestCase):
+
+    def test_dense(self):
+        for celltype, values in ((float, [0.5, -1., 2.25]), (str, ["H", "Dh", "S"])):
+            sparse = Table(celltype, "abc", range(3))
+            dense = Table(celltype, "abc", range(3), dense=True)
+            for table in (sparse, dense):
+                for y, value in enumerate(values):
+                    table[y, "abc"[y]] = value
+                del table[1, "b"]
+            for y in range(3):
+                for x in "abc":
+                    self.assertEqual(dense[y, x], sparse[y, x])
+            self.assertIsNone(dense[1, "b"])
+            self.assertEqual(dense[2, "c"], values[2])
+
+    def test_errors(self):
+        table = Table(float, "abc", range(3), dense=True)
+        self.assertRaises(TypeError, table.__getitem__, 1)
+        self.assertRaises(KeyError, table.__getitem__, (1, "a", 2))
+        self.assertRaises(KeyError, table.__getitem__, (3, "a"))
+        self.assertRaises(KeyError, table.__getitem__, (1, "d"))
+        self.assertRaises(TypeError, table.__setitem__, (1, "a"), "x")
+        self.assertRaises(TypeError, Table, int, "abc", range(3), dense=True)
+
+    def test_bulk(self):
+        table = Table(float, "abc", range(2), dense=True)
+        table.fill_row(0, [1., None, 2.])
+        table.fill_column("b", [3., 4.])
+        self.assertEqual(table[0, "b"], 3.)
+        self.assertIsNone(table[1, "a"])
+        table.row(1)[0] = 5. # view into the table
+        self.assertEqual(table[1, "a"], 5.)
+        self.assertEqual(list(table.column("c")[:1]), [2.])
+        self.assertRaises(TypeError, table.fill_row, 0, ["x", 1., 2.])
+        self.assertRaises(ValueError, table.fill_row, 0, [1.])
+
+        copy = Table.from_numpy(float, "abc", range(2), table.to_numpy())
+        negated = copy.apply(lambda v: -v)
+        self.assertEqual(negated[1, "b"], -4.)
+        self.assertIsNone(negated[1, "c"])
+
+        strategy = Table.from_numpy(str, "ab", range(2), [["H", None], ["S", "H"]])
+        self.assertEqual(list(strategy.row(1)), ["S", "H"])
+        self.assertIsNone(strategy[0, "b"])
+
+    def test_argmax(self):
+        first = Table.from_numpy(float, "ab", range(2), [[1., 5.], [None, 0.]])
+        second = Table.from_numpy(float, "ab", [1], [[2., 0.]])
+        values, indices = Table.argmax([first, second], "ab", range(2))
+        self.assertEqual(values.tolist(), [[1., 5.], [2., 0.]])
+        self.assertEqual(indices.tolist(), [[0, 0], [1, 0]])
+
+
+class TestStateMachine(unittest.TestCase):
+
+    def test_player_next(self):
+        _ = self.assertEqual
+
+        _(STATE_CODE[PLAYER_NEXT[STATE["A6"]][DISTINCT.index("5")]], "12")
+        _(STATE_CODE[PLAYER_NEXT[STATE["A9"]][DISTINCT.index("A")]], "21")
+        _(STATE_CODE[PLAYER_NEXT[STATE["20"]][DISTINCT.index("2")]], BUST_CODE)
+        _(STATE_CODE[PLAYER_NEXT[STATE["88"]][DISTINCT.index("2")]], "18")
+        _(PLAYER_NEXT[BUST_STATE], (BUST_STATE,) * NUM_CARDS)
+
+    def test_pairs(self):
+        _ = self.assertEqual
+
+        for i, card1 in enumerate(DISTINCT):
+            for j, card2 in enumerate(DISTINCT):
+                _(STATE_CODE[PLAYER_PAIR_STATE[i][j]], Hand(card1+card2).code())
+                _(STATE_CODE[PAIR_STATE[i][j]],
+                  Hand(card1+card2).code(nosplit=True))
+
+
+class TestDealerSolver(unittest.TestCase):
+
+    def outcome(self, cards, rules):
+        """ Reference dealer outcome probabilities, by recursion """
+        hand = Hand(cards)
+        score = hand.value()
+        soft = "A" in cards and sum(map(card_value, cards)) <= 11
+        if score == BUST or score > rules.dealer_stand or \
+           (score == rules.dealer_stand and not (soft and rules.dealer_hits_soft)):
+            return {score: 1.}
+        probs = {}
+        for card, p in zip(DISTINCT, card_probabilities(rules)):
+            for final, q in self.outcome(cards + card, rules).items():
+                probs[final] = probs.get(final, 0.) + p*q
+        return probs
+
+    def test_rules(self):
+        for rules in (Rules(), Rules(dealer_hits_soft=False),
+                      Rules(dealer_stand=16, weights=(4,)*9 + (1,))):
+            matrix = dealer_matrix(rules, SOFT_CODE[:6] + ["12", "16", "17"])
+            for row, code in zip(matrix, SOFT_CODE[:6] + ["12", "16", "17"]):
+                expect = self.outcome(code2cards(code), rules)
+                for score, p in enumerate(row):
+                    self.assertTrue(isclose(p, expect.get(score, 0.), abs_tol=1e-12))
+
+
+class TestVectorized(unittest.TestCase):
+
+    def test_same_tables(self):
+        for rules in (Rules(), Rules(dealer_hits_soft=False, blackjack_pays=1.2,
+                                     surrender=False, max_splits=2,
+                                     double_after_split=False),
+                      Rules(max_splits=MAX_SPLITS, resplit_aces=True)):
+            self.check_tables(rules)
+
+    def check_tables(self, rules):
+        import vectorized
+        expect = calculate(rules)
+        result = vectorized.calculate(rules)
+        for name in ("initial", "stand", "hit", "double", "split", "optimal"):
+            table = expect[name]
+            for y in table.ylabels:
+                for x in table.xlabels:
+                    self.assertTrue(isclose(result[name][y,x], table[y,x], abs_tol=1e-12))
+        for y in PLAYER_CODE:
+            for x in DEALER_CODE:
+                self.assertEqual(result["strategy"][y,x], expect["strategy"][y,x])
+        self.assertEqual(len(result["resplit"]), rules.max_splits)
+        for table, other in zip(expect["resplit"], result["resplit"]):
+            self.assertEqual(table.ylabels, other.ylabels)
+            for y in table.ylabels:
+                for x in table.xlabels:
+                    self.assertTrue(isclose(other[y,x] or 0., table[y,x] or 0., abs_tol=1e-12))
+        for code in DEALER_CODE:
+            for score, p in expect["dealer"][code].items():
+                self.assertTrue(isclose(result["dealer"][code][score], p))
+        self.assertTrue(isclose(result["advantage"], expect["advantage"]))
+
+
+class TestComposition(unittest.TestCase):
+
+    def outcome(self, comp, total, ace, rules):
+        # brute force dealer draws without replacement
+        value = total + 10 if ace and total <= 11 else total
+        if total > 21: return {BUST: 1.}
+        if value > rules.dealer_stand or (value == rules.dealer_stand and
+                not (rules.dealer_hits_soft and ace and total <= 11)):
+            return {value: 1.}
+        result, n = {}, sum(comp)
+        for card, count in enumerate(comp):
+            if not count: continue
+            rest = comp[:card] + (count-1,) + comp[card+1:]
+            for score, p in self.outcome(rest, total + card_value(DISTINCT[card]),
+                                         ace or DISTINCT[card] == "A", rules).items():
+                result[score] = result.get(score, 0.) + p*count/n
+        return result
+
+    def test_dealer(self):
+        import composition
+        shoe = (3, 2, 1, 2, 2, 1, 2, 1, 2, 6)
+        for rules in (Rules(), Rules(dealer_hits_soft=False)):
+            calc = composition.ShoeCalculator(shoe, rules)
+            for code in ("2", "6", "A", "A6", "16"):
+                cards = code2cards(code)
+                probs = calc.dealer_prob(composition.remove(bytes(shoe), cards),
+                                         composition.dealer_hand(cards))
+                expect = self.outcome(tuple(composition.remove(bytes(shoe), cards)),
+                                      *composition.dealer_hand(cards), rules)
+                for score, p in enumerate(probs):
+                    self.assertTrue(isclose(p, expect.get(score, 0.), abs_tol=1e-12))
+        self.assertRaises(ValueError, composition.remove, bytes(shoe), "666")
+        # hard 4 is dealt as a real hand, 2 and 2
+        self.assertEqual(composition.hand_cards("4"), "22")
+        self.assertEqual(composition.hand_cards("A6"), code2cards("A6"))
+        shoe = composition.make_shoe(1)
+        calc = composition.ShoeCalculator(shoe)
+        expect = self.outcome(tuple(composition.remove(bytes(shoe), "22")), 4, False, Rules())
+        for score, p in calc.create_dealer_table()["4"].items():
+            self.assertTrue(isclose(p, expect[score], abs_tol=1e-12))
+
+    def test_cache(self):
+        from memo import Memo
+        cache = Memo(max_bytes=1000)
+        for i in range(100):
+            cache.store(i, float(i))
+            self.assertEqual(cache.lookup(0), 0.) # keep 0 recently used
+        self.assertTrue(cache.bytes <= 1000)
+        self.assertTrue(cache.evictions > 0)
+        self.assertEqual(cache.lookup(1), None)
+        self.assertEqual(cache.lookup(99), 99.)
+        self.assertEqual(cache.stats()["hits"], 101)
+        self.assertEqual(cache.stats()["misses"], 1)
+        snapshot = cache.snapshot()
+        cache.restore({})
+        self.assertEqual((len(cache), cache.bytes), (0, 0))
+        cache.restore(snapshot)
+        self.assertEqual(cache.snapshot(), snapshot)
+        self.assertTrue(cache.bytes <= 1000)
+        # the calculator's memos evict within a bound as well
+        calc = Calculator()
+        calc.middle = Memo("middle", max_bytes=2000)
+        calc.hands = Memo("resplit0", max_bytes=2000)
+        result = LazyResult(calc)
+        self.assertTrue(isclose(result["advantage"], calculate()["advantage"]))
+        self.assertTrue(calc.middle.evictions > 0)
+        self.assertTrue(calc.hands.evictions > 0)
+        self.assertTrue(calc.middle.bytes <= 2000)
+
+
+class TestSplitSolver(unittest.TestCase):
+
+    def test_depth(self):
+        calc = Calculator(Rules(max_splits=MAX_SPLITS))
+        result = LazyResult(calc)
+        split = result["split"]
+        # one memoized value per card, dealer column and depth, aces once
+        self.assertEqual(sorted(calc.splits), list(range(1, MAX_SPLITS + 1)))
+        self.assertEqual(sum(map(len, calc.splits.values())),
+                         (len(SPLIT_CODE) - 1) * NUM_DEALER * MAX_SPLITS + NUM_DEALER)
+        default = calculate()["split"]
+        self.assertTrue(split["88","6"] > default["88","6"])
+        self.assertEqual(split["AA","6"], default["AA","6"])
+
+        # same calculator evaluates other options from the same stages
+        for col in range(NUM_DEALER):
+            for s in SPLIT_STATE:
+                self.assertTrue(calc.get_split_outcome(s, col, 1) <=
+                                calc.get_split_outcome(s, col, 1, das=True) + 1e-12)
+        aces = calc.get_split_outcome(STATE["AA"], 5, rsa=True)
+        self.assertTrue(aces > split["AA", DEALER_CODE[5]])
+        self.assertRaises(ValueError, Calculator, Rules(max_splits=MAX_SPLITS + 1))
+
+
+class TestCounting(unittest.TestCase):
+
+    def test_counting(self):
+        import counting
+        import numpy as np
+        shift = counting.count_shift()
+        self.assertTrue(isclose(-np.dot(shift, counting.HI_LO), 1.))
+        self.assertTrue(isclose(shift.sum() + 1., 1.))
+
+        from unittest import mock
+        with mock.patch.object(counting, "parallel_workers", lambda workers, tasks: workers):
+            analysis = counting.CountAnalysis(decks=6, workers=2) # a pool even on 1 CPU
+        with analysis:
+            advantage, margin = analysis.effects_of_removal()
+            self.assertTrue(advantage[DISTINCT.index("5")] > 0 > advantage[DISTINCT.index("T")])
+            self.assertEqual(margin.shape, (NUM_CARDS, len(PLAYER_CODE), len(DEALER_CODE)))
+            self.assertEqual(len(analysis.memo), NUM_CARDS + 1)
+            analysis.effects_of_removal() # memoized
+            self.assertEqual(len(analysis.memo), NUM_CARDS + 1)
+
+            index, action = analysis.scan_indices(counts=[0])
+            self.assertTrue(np.isnan(index).all())
+            pool = analysis.pool
+            self.assertIsNotNone(pool)
+            index, action = analysis.index_tables(exact=True)
+            self.assertIs(analysis.pool, pool) # one pool for every batch
+            linear, _ = analysis.index_tables()
+        self.assertIsNone(analysis.pool)
+        for y in PLAYER_CODE:
+            for x in DEALER_CODE:
+                if index[y,x] is not None:
+                    self.assertTrue(abs(index[y,x]) <= counting.MAX_INDEX)
+                    self.assertIn(action[y,x], counting.ACTIONS)
+        # both methods roughly agree on a well known index
+        self.assertTrue(abs(index["16","10"] - linear["16","10"]) < 2)
+
+
+class TestLazyResult(unittest.TestCase):
+
+    def test_lazy(self):
+        result = calculate()
+        self.assertTrue("split" in result)
+        self.assertEqual(result.done, set())
+        result["dealer"]
+        self.assertEqual(result.done, {"dealer"})
+        result["hit"]
+        self.assertEqual(result.done, {"dealer", "stand", "hit"})
+        self.assertTrue(isclose(result["advantage"], calculate()["advantage"]))
+        self.assertEqual(result.done, set(STAGES) - {"strategy", "outcome", "variance"})
+        result["variance"]
+        self.assertEqual(result.done, set(STAGES) - {"strategy"})
+        self.assertEqual(list(result), list(STAGES))
+        self.assertRaises(KeyError, lambda: result["missing"])
+
+    def test_recalculate(self):
+        import json
+        from metrics import Metrics
+        previous = calculate()
+        previous["advantage"]
+        for change in [{"surrender": False}, {"blackjack_pays": 1.2},
+                       {"max_splits": 1}, {"dealer_hits_soft": False},
+                       {"weights": (3, 4, 4, 4, 5, 4, 4, 4, 4, 16)}]:
+            rules = DEFAULT_RULES._replace(**change)
+            metrics = Metrics()
+            result = recalculate(previous, rules, metrics)
+            expect = calculate(rules)
+            self.assertTrue(isclose(result["advantage"], expect["advantage"]))
+            self.assertEqual(result["strategy"].to_numpy().tolist(),
+                             expect["strategy"].to_numpy().tolist())
+            stages = set(json.loads(metrics.to_json())["stages"])
+            if "surrender" in change:
+                self.assertEqual(stages, {"create_optimal_table",
+                                          "calculate_player_advantage"})
+            if "blackjack_pays" in change:
+                self.assertEqual(stages, {"calculate_player_advantage"})
+            if "weights" in change:
+                self.assertIn("create_initial_table", stages)
+                self.assertFalse(isclose(result["advantage"],
+                                         previous["advantage"]))
+        self.assertEqual(changed_stages(DEFAULT_RULES, DEFAULT_RULES), set())
+        # same weights as probability(): nothing to recompute
+        self.assertEqual(changed_stages(
+            DEFAULT_RULES, DEFAULT_RULES._replace(weights=(1,) * 9 + (4,))),
+            set())
+        # NUM_FACES changes the card probabilities without changing the rules
+        import easybj
+        faces, ranks = easybj.NUM_FACES, easybj.NUM_RANKS
+        try:
+            easybj.NUM_FACES, easybj.NUM_RANKS = 3, 12
+            self.assertIn("initial", changed_stages(
+                DEFAULT_RULES, DEFAULT_RULES, previous.calc.prob))
+            metrics = Metrics()
+            result = recalculate(previous, DEFAULT_RULES, metrics)
+            expect = calculate(DEFAULT_RULES)
+            advantage, strategy = result["advantage"], result["strategy"]
+            expect_advantage = expect["advantage"]
+            expect_strategy = expect["strategy"]
+            stages = set(json.loads(metrics.to_json())["stages"])
+        finally:
+            easybj.NUM_FACES, easybj.NUM_RANKS = faces, ranks
+        self.assertIn("create_initial_table", stages)
+        self.assertTrue(isclose(advantage, expect_advantage))
+        self.assertFalse(isclose(advantage, previous["advantage"]))
+        self.assertEqual(strategy.to_numpy().tolist(),
+                         expect_strategy.to_numpy().tolist())
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_metrics(self):
+        import json
+        from metrics import Metrics
+        metrics = Metrics(trace_memory=True)
+        result = calculate(metrics=metrics)
+        result["split"]
+        data = json.loads(metrics.to_json())
+        self.assertEqual(data["stages"]["create_split_table"]["runs"], 1)
+        self.assertTrue(data["stages"]["create_split_table"]["peak_bytes"] > 0)
+        self.assertNotIn("create_optimal_table", data["stages"])
+        calc = result.calc # one miss per memoized value
+        memos = [("middle", calc.middle), ("resplit0", calc.hands)]
+        memos += [("resplit%d"%n, memo) for n, memo in calc.splits.items()]
+        for name, memo in memos:
+            self.assertEqual(data["memo"][name]["misses"], len(memo))
+            self.assertEqual(data["memo"][name]["size"], len(memo))
+        self.assertTrue(data["calls"]["get_hit_outcome"] > data["memo"]["middle"]["misses"])
+        self.assertTrue(data["memo"]["resplit1"]["hits"] > 0) # reused by deeper splits
+
+
+class TestResultCache(unittest.TestCase):
+
+    def test_cache(self):
+        import os, tempfile
+        with tempfile.TemporaryDirectory() as cache_dir:
+            expect = calculate(cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            result = calculate(cache_dir=cache_dir)
+            names = ["initial", "stand", "hit", "double", "split", "optimal", "strategy"]
+            for table, other in zip([expect[name] for name in names] + expect["resplit"],
+                                    [result[name] for name in names] + result["resplit"]):
+                for y in table.ylabels:
+                    for x in table.xlabels:
+                        self.assertEqual(other[y,x], table[y,x])
+            self.assertEqual(result["dealer"], expect["dealer"])
+            self.assertEqual(result["advantage"], expect["advantage"])
+
+            # other rules are saved separately, unreadable files are ignored
+            other = calculate(Rules(blackjack_pays=1.2), cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+            self.assertNotEqual(other["advantage"], expect["advantage"])
+            with open(result_path(cache_dir), 'wb') as f:
+                f.write(b"corrupt")
+            self.assertEqual(calculate(cache_dir=cache_dir)["advantage"], expect["advantage"])
+
+    def test_loaded(self):
+        import os, tempfile
+        with tempfile.TemporaryDirectory() as cache_dir:
+            save_result(result_path(cache_dir), calculate())
+            result = calculate(cache_dir=cache_dir) # loaded
+            self.assertEqual(result.done, set(STAGES))
+            self.assertEqual(set(result.metrics.stages), {"load_result"})
+            rules = Rules(surrender=False)
+            other = recalculate(result, rules)
+            self.assertTrue(isclose(other["advantage"], calculate(rules)["advantage"]))
+            self.assertEqual(other["strategy"].to_numpy().tolist(),
+                             calculate(rules)["strategy"].to_numpy().tolist())
+
+            # the key follows the card probabilities, not only the rules
+            import easybj
+            path = result_path(cache_dir)
+            easybj.NUM_FACES = 3
+            try:
+                self.assertNotEqual(result_path(cache_dir), path)
+            finally:
+                easybj.NUM_FACES = 4
+
+            # an unwritable cache directory is ignored
+            blocked = os.path.join(cache_dir, "file")
+            open(blocked, 'w').close()
+            self.assertTrue(isclose(calculate(cache_dir=blocked)["advantage"],
+                                    result["advantage"]))
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_compare(self):
+        import benchmark
+        summary = benchmark.summarize(benchmark.measure("vectorized", repeat=3))
+        self.assertEqual(set(summary["calculate"]), {"p10", "p50", "p90"})
+        baseline = {"vectorized": {"calculate": {"p50": 1e-6}}}
+        self.assertEqual(len(benchmark.compare({"vectorized": summary}, baseline,
+                                               min_delta=0.)), 1)
+        self.assertEqual(benchmark.compare({"vectorized": summary}, baseline,
+                                           min_delta=1.), [])
+        self.assertEqual(benchmark.compare({"vectorized": summary}, {}), [])
+        # a machine twice as slow on the reference work gets twice the time
+        self.assertIn(benchmark.REFERENCE, summary)
+        slow = {"calculate": {"p50": 0.2}, benchmark.REFERENCE: {"p50": 0.02}}
+        baseline = {"vectorized": {"calculate": {"p50": 0.1},
+                                   benchmark.REFERENCE: {"p50": 0.01}}}
+        self.assertEqual(benchmark.compare({"vectorized": slow}, baseline), [])
+        slow["calculate"]["p50"] = 0.3
+        self.assertEqual(len(benchmark.compare({"vectorized": slow}, baseline)), 1)
+
+
+class TestSweep(unittest.TestCase):
+
+    def test_sweep(self):
+        import sweep
+        variants = sweep.rule_variants(dealer_hits_soft=(True, False),
+                                       surrender=(True, False), max_splits=(1, 3))
+        results = sweep.sweep(variants, workers=2)
+        self.assertEqual(len(results), len(variants))
+        for rules, result in zip(variants, results):
+            expect = calculate(rules)
+            self.assertTrue(isclose(result["advantage"], expect["advantage"]))
+            for y in PLAYER_CODE:
+                for x in DEALER_CODE:
+                    self.assertEqual(result["strategy"][y,x], expect["strategy"][y,x])
+                    if not rules.surrender:
+                        self.assertNotIn("R", result["strategy"][y,x])
+        self.assertRaises(ValueError, sweep.sweep, [Rules(max_splits=0)])
+
+
+class TestSimulate(unittest.TestCase):
+
+    WIZARD = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "..", "..", "tester", "data", "asst1", "wizard.txt")
+
+    def test_lookup(self):
+        import simulate as sim
+        cells = sim.load_strategy(self.WIZARD)
+        self.assertEqual(cells.shape, (len(PLAYER_CODE), len(DEALER_CODE)))
+        row, col = PLAYER_CODE.index("A7"), DEALER_CODE.index("4")
+        self.assertEqual(cells[row, col], "DS")
+        table = sim.lookup_table(cells)
+        self.assertEqual(table[row, col, 0], sim.STAND)
+        self.assertEqual(table[row, col, sim.CAN_DOUBLE], sim.DOUBLE)
+        self.assertEqual(table[PLAYER_CODE.index("88"), col, 0], sim.NULL)
+
+    def test_simulate(self):
+        import simulate as sim
+        balance = sim.simulate(self.WIZARD, 200000, seed=1, workers=1, batch=50000)
+        self.assertEqual(sim.simulate(self.WIZARD, 200000, seed=1, workers=2, batch=50000),
+                         balance)
+        self.assertAlmostEqual(balance / 200000, 0.1024, delta=0.01)
+        self.assertEqual(sim.report(2, 1.5), "Hands Played: 2\nFinal Balance: +$1.50"
+                                             "\nPlayer Advantage: 75%")
+
+    def test_compare(self):
+        import numpy as np
+        import simulate as sim
+        from evaluate import evaluate_strategy
+        shoe = sim.Shoe(np.random.SeedSequence(4), 3)
+        rows = np.array([0, 2])
+        cards = [shoe.draw(rows) for _ in range(sim.SHOE_WIDTH + 2)]
+        shoe.replay()
+        self.assertEqual([shoe.draw(rows).tolist() for _ in cards],
+                         [card.tolist() for card in cards])
+
+        stats, values = sim.RunningStats(), np.random.default_rng(5).normal(size=100)
+        for start in range(0, 100, 30):
+            stats.add(values[start:start + 30])
+        self.assertAlmostEqual(stats.mean, values.mean())
+        self.assertAlmostEqual(stats.variance(), values.var(ddof=1))
+
+        same = sim.compare(self.WIZARD, self.WIZARD, 30000, seed=1, batch=10000)
+        self.assertEqual((same.hands, same.difference), (30000, 0.))
+        result = calculate()
+        optimal = np.array([[text.upper() for text in row]
+                            for row in result["strategy"].to_numpy()], dtype=object)
+        paired = sim.compare(optimal, self.WIZARD, 200000, seed=1)
+        exact = result["advantage"] - evaluate_strategy(self.WIZARD)
+        self.assertLess(paired.hands, 200000)
+        self.assertLess(abs(paired.difference - exact), paired.half_width)
+        self.assertGreater(paired.speedup, 10)
+
+
+class TestEvaluate(unittest.TestCase):
+
+    def test_optimal(self):
+        from evaluate import evaluate_strategy
+        for rules in (Rules(), Rules(max_splits=1, double_after_split=False),
+                      Rules(resplit_aces=True, surrender=False)):
+            result = calculate(rules)
+            self.assertTrue(isclose(evaluate_strategy(result["strategy"], rules),
+                                    result["advantage"]))
+
+    def test_strategy_file(self):
+        from evaluate import evaluate_strategy
+        import simulate as sim
+        advantage = evaluate_strategy(TestSimulate.WIZARD)
+        self.assertLess(advantage, calculate()["advantage"])
+        balance = sim.simulate(TestSimulate.WIZARD, 200000, seed=2, workers=1)
+        self.assertAlmostEqual(balance / 200000, advantage, delta=0.01)
+
+class TestOutcome(unittest.TestCase):
+
+    def test_outcome(self):
+        import vectorized
+        for rules in (Rules(), Rules(dealer_hits_soft=False, blackjack_pays=1.2),
+                      Rules(resplit_aces=True, max_splits=1)):
+            result = calculate(rules)
+            outcome = result["outcome"]
+            mean = sum(x * p for x, p in outcome.items())
+            self.assertTrue(isclose(sum(outcome.values())))
+            self.assertAlmostEqual(mean, result["advantage"], places=12)
+            self.assertIn(rules.blackjack_pays, outcome)
+            other = vectorized.calculate(rules)
+            self.assertAlmostEqual(other["variance"], result["variance"], places=12)
+        self.assertAlmostEqual(calculate()["variance"], 1.5508, places=4)
+
+    def test_bankroll(self):
+        from vectorized import bankroll_distribution
+        result = calculate()
+        bankroll, probs = bankroll_distribution(result["outcome"], 100)
+        mean = probs @ bankroll
+        self.assertTrue(isclose(probs.sum()))
+        self.assertAlmostEqual(mean, 100 * result["advantage"], places=8)
+        self.assertAlmostEqual(probs @ bankroll**2 - mean**2,
+                               100 * result["variance"], places=4)
+
+class TestService(unittest.TestCase):
+
+    def test_service(self):
+        import asyncio
+        from service import StrategyService, StrategyClient
+        service = StrategyService(rule_sets=1)
+        result = calculate()
+        queries = [{"player": "A7", "dealer": "T6"}, {"player": "T33", "dealer": "T6"},
+                   {"player": ["8", "8"], "dealer": ["10", "K"]}]
+
+        def client(port):
+            client = StrategyClient(port=port)
+            try:
+                first, second = client.query_many([queries, queries[:1]])
+                self.assertEqual(first[0]["action"], result["strategy"]["A7", "16"])
+                self.assertTrue(isclose(first[0]["evs"]["D"], result["double"]["A7", "16"]))
+                self.assertEqual(set(first[1]["evs"]), {"S", "H"})
+                self.assertTrue(isclose(first[2]["evs"]["P"], result["split"]["88", "20"]))
+                self.assertEqual(second, first[:1])
+                self.assertRaises(ValueError, client.query, [{"player": "X"}])
+                other = client.query(queries[:1], rules={"surrender": False})
+                self.assertNotIn("R", other[0]["evs"])
+            finally:
+                client.close()
+
+        async def run():
+            server = await service.start(port=0)
+            async with server:
+                port = server.sockets[0].getsockname()[1]
+                await asyncio.get_running_loop().run_in_executor(None, client, port)
+
+        asyncio.run(run())
+        self.assertEqual(service.builds, 2)
+        self.assertEqual(list(service.tables), [Rules(surrender=False)])
+
+    def test_errors(self):
+        import asyncio
+        from unittest import mock
+        from service import StrategyService
+        service = StrategyService()
+        ask = lambda request: asyncio.run(service.handle_request(request))
+        for rules, error in [({"blackjack_pays": "x"}, "blackjack_pays must be a number"),
+                             ({"surrender": 1}, "surrender must be true or false"),
+                             ({"max_splits": 2.5}, "max_splits must be an integer"),
+                             ({"weights": [1, "x"]}, "weights must be null or a list"),
+                             ({"push22": True}, "unknown rule push22"),
+                             ({"max_splits": MAX_SPLITS + 1}, "max_splits must be from")]:
+            response = ask({"id": 3, "rules": rules, "queries": []})
+            self.assertEqual(response["id"], 3)
+            self.assertIn(error, response["error"])
+        self.assertIn("queries must be a list", ask({"id": 4})["error"])
+        for query, error in [({"player": "T6", "dealer": "T65"}, "got 21"),
+                             ({"player": "T6", "dealer": "T6T"}, "got bust"),
+                             ({"player": "T6"}, "dealer must be"),
+                             ("T6", "query must be an object")]:
+            self.assertIn(error, ask({"id": 5, "queries": [query]})["error"])
+        self.assertEqual(service.builds, 1)
+        with mock.patch("service.StrategyTables", side_effect=RuntimeError("no memory")):
+            response = ask({"id": 6, "rules": {"surrender": False}, "queries": []})
+        self.assertEqual(response, {"id": 6, "error": "RuntimeError: no memory"})
+
+class TestArtifact(unittest.TestCase):
+
+    def test_artifact(self):
+        import tempfile
+        import numpy as np
+        from artifact import Artifact, write_artifact
+        from simulate import load_strategy
+        rules = Rules(blackjack_pays=1.2, weights=(1,)*10)
+        result = calculate(rules)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "strategy.ezbj")
+            write_artifact(path, result)
+            artifact = Artifact(path)
+            self.assertEqual(artifact.rules, rules)
+            self.assertEqual(artifact["advantage"], result["advantage"])
+            for name in ("initial", "hit", "split", "strategy"):
+                self.assertEqual(artifact[name].ylabels, result[name].ylabels)
+                self.assertEqual(artifact[name].xlabels, result[name].xlabels)
+                for key in (("A7", "16"), ("16", "A2")):
+                    if key[0] in result[name].ylabels:
+                        self.assertEqual(artifact[name][key], result[name][key])
+            self.assertTrue(np.array_equal(artifact["resplit"][1].to_numpy(),
+                                           result["resplit"][1].to_numpy(), equal_nan=True))
+            self.assertEqual(artifact["initial"].unit, "%")
+            self.assertRaises(ValueError, artifact["stand"].__setitem__, ("16", "16"), 0.)
+            self.assertEqual(load_strategy(path)[PLAYER_CODE.index("A7"), 12],
+                             result["strategy"]["A7", "16"].upper())
+            stand = artifact["stand"]
+            self.assertRaises(BufferError, artifact.close) # stand still in use
+            del stand
+            artifact.close()
+            self.assertTrue(artifact.map.closed)
+            with Artifact(path) as artifact:
+                self.assertEqual(artifact.rules, rules)
+            self.assertTrue(artifact.map.closed)
+
+class TestParallelColumns(unittest.TestCase):
+
+    def test_columns(self):
+        self.assertEqual(sorted(sum(column_parts(4), [])), list(range(NUM_DEALER)))
+        self.assertEqual(column_parts(2, range(1, 5)), [[1, 3], [2, 4]])
+        self.assertEqual(parallel_workers(None), 1)
+        self.assertTrue(1 <= parallel_workers(NUM_DEALER + 1) <= NUM_DEALER)
+        self.assertEqual(parallel_workers(NUM_DEALER, tasks=1), 1)
+
+    def test_shoe_columns(self):
+        import numpy as np
+        import composition
+        shoe = composition.make_shoe(1)
+        stand, hit, double, split, resplit = composition.create_columns(
+            shoe, Rules(), None, [DEALER_CODE.index("A5")])
+        col = DEALER_CODE.index("A5")
+        self.assertTrue(np.isnan(np.delete(split, col, axis=1)).all())
+        self.assertFalse(np.isnan(split[list(SPLIT_STATE), col]).any())
+
+class TestExport(unittest.TestCase):
+
+    def test_formats(self):
+        import csv, json, tempfile
+        import numpy as np
+        import main
+        result = calculate()
+        with tempfile.TemporaryDirectory() as directory:
+            path = lambda ext: os.path.join(directory, "result." + ext)
+            for ext in ("json", "csv", "npz"):
+                argv = ["main.py", "strategy", "resplit", "dealer", "advantage",
+                        "--format", ext, "-o", path(ext)]
+                self.assertEqual(main.main(len(argv), argv), 0)
+            with open(path("json")) as f:
+                data = json.load(f)
+            self.assertEqual(list(data), ["strategy", "resplit", "dealer", "advantage"])
+            self.assertEqual(data["strategy"]["cells"][0], result["strategy"].to_numpy()[0].tolist())
+            self.assertEqual(data["resplit"][1]["cells"][0][0], result["resplit"][1]["22", "4"])
+            with open(path("csv"), newline="") as f:
+                records = list(csv.reader(f))
+            self.assertEqual(records[0], ["table", "row", "column", "value"])
+            self.assertIn(["strategy", "A7", "16", "Ds"], records)
+            self.assertIn(["advantage", "", "", repr(result["advantage"])], records)
+            with np.load(path("npz")) as data:
+                self.assertEqual(data["strategy"][PLAYER_CODE.index("A7"), 12], "Ds")
+                self.assertTrue(np.array_equal(data["resplit0"], result["resplit"][0].to_numpy(),
+                                               equal_nan=True))
+                self.assertEqual(float(data["advantage"]), result["advantage"])
+
+            # unknown names are reported on stderr, leaving the output valid
+            import contextlib, io
+            argv = ["main.py", "advantage", "missing", "--format", "json", "-o", path("json")]
+            with contextlib.redirect_stderr(io.StringIO()) as err:
+                self.assertEqual(main.main(len(argv), argv), 1)
+            self.assertIn("not found: missing", err.getvalue())
+            with open(path("json")) as f:
+                self.assertEqual(list(json.load(f)), ["advantage"])
+
+class TestInitialDeal(unittest.TestCase):
+
+    def test_finite(self):
+        import itertools
+        import numpy as np
+        shoe = (3, 2, 1, 2, 2, 1, 2, 1, 2, 6)
+        expect = np.zeros((NUM_STATES, NUM_DEALER + 1))
+        for i, j, x, y in itertools.product(range(NUM_CARDS), repeat=4):
+            comp, p = list(shoe), 1.
+            for k, card in enumerate((i, j, x, y)):
+                p *= max(comp[card], 0) / (sum(shoe) - k)
+                comp[card] -= 1
+            expect[PLAYER_PAIR_STATE[x][y], DEALER_PAIR_COL[i][j]] += p
+        initial = initial_deal(shoe, finite=True)
+        rows = list(INITIAL_STATE)
+        self.assertTrue(np.allclose(initial[rows], expect[rows], rtol=1e-12, atol=1e-15))
+        self.assertTrue(np.isnan(initial[BUST_STATE]).all())
+
+    def test_weights(self):
+        import numpy as np
+        weights = (1, 2, 3, 4, 5, 6, 7, 8, 9, 30)
+        initial = initial_deal(weights)
+        self.assertTrue(isclose(np.nansum(initial)))
+        p = np.array(weights) / sum(weights)
+        self.assertTrue(isclose(initial[STATE["AA"], DEALER_CODE.index("A5")],
+                                p[0]**2 * 2*p[0]*p[4]))
+        expect = np.zeros((NUM_STATES, NUM_DEALER + 1))
+        for i, j, x, y in np.ndindex(*(NUM_CARDS,) * 4):
+            expect[PLAYER_PAIR_STATE[x][y], DEALER_PAIR_COL[i][j]] += p[i]*p[j]*p[x]*p[y]
+        rows = list(INITIAL_STATE)
+        self.assertTrue(np.allclose(initial[rows], expect[rows], rtol=1e-12, atol=1e-15))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,292 @@
+#!/usr/bin/python3
+#
+# service.py
+#
+# Long-running strategy query service. The tables of each rule set are
+# computed (or loaded from the result cache) once and kept in memory, the
+# least recently used rule sets being dropped, and batched queries are
+# answered from them over a Unix or TCP socket.
+#
+# Protocol: one JSON request per line, answered by one JSON line. Requests
+# of a connection are answered in order, so clients may pipeline them:
+#   {"id": 1, "rules": {"surrender": false},
+#    "queries": [{"player": "A7", "dealer": "T6"}, ...]}
+#   {"id": 1, "results": [{"action": "Ds", "evs": {"S": ..., ...}}, ...]}
+# A request that cannot be answered gets {"id": ..., "error": message}.
+#
+# usage: service.py [--unix PATH | --host HOST --port PORT] [--rule-sets N]
+#
+
+import sys
+import json
+import math
+import socket
+import asyncio
+import argparse
+from collections import OrderedDict
+import numpy as np
+import easybj
+from easybj import *
+from vectorized import action_evs, ACTIONS
+
+
+
+###################
+##   CONSTANTS   ##
+###################
+
+RULE_SETS = 16 # rule sets kept in memory
+HOST, PORT = "127.0.0.1", 3260
+LIMIT = 2**24 # longest request line, in bytes
+PLAYER_ROW = {code: row for row, code in enumerate(PLAYER_CODE)}
+DEALER_COL = {code: col for col, code in enumerate(DEALER_CODE)}
+
+is_bool = lambda value: isinstance(value, bool)
+is_integer = lambda value: isinstance(value, int) and not is_bool(value)
+is_number = lambda value: (isinstance(value, (int, float)) and not is_bool(value)
+                           and math.isfinite(value))
+
+# Rules field: (check of its JSON value, description for errors)
+RULE_TYPES = {
+    'dealer_stand' : (is_integer, "an integer"),
+    'dealer_hits_soft' : (is_bool, "true or false"),
+    'weights' : (lambda value: value is None or isinstance(value, list)
+                               and all(map(is_number, value)),
+                 "null or a list of numbers"),
+    'blackjack_pays' : (is_number, "a number"),
+    'surrender' : (is_bool, "true or false"),
+    'max_splits' : (is_integer, "an integer"),
+    'double_after_split' : (is_bool, "true or false"),
+    'resplit_aces' : (is_bool, "true or false"),
+}
+
+
+
+###########################
+##   UTILITY FUNCTIONS   ##
+###########################
+
+def parse_rules(fields):
+    """ Returns Rules from a JSON object of Rules fields, defaults for the
+        fields left out """
+    if fields is None: return DEFAULT_RULES
+    if not isinstance(fields, dict):
+        raise ValueError("rules must be an object")
+    for name, value in fields.items():
+        if name not in RULE_TYPES:
+            raise ValueError("unknown rule %s"%name)
+        check, kind = RULE_TYPES[name]
+        if not check(value):
+            raise ValueError("rule %s must be %s"%(name, kind))
+    fields = dict(fields)
+    if fields.get('weights') is not None:
+        fields['weights'] = tuple(fields['weights'])
+    rules = DEFAULT_RULES._replace(**fields)
+    check_rules(rules)
+    return rules
+
+def parse_cards(cards, what):
+    """ Returns list of cards in DISTINCT from a string such as "T6" or a
+        list of cards, 10 and face cards counting as T """
+    cards = [{"10": "T", "J": "T", "Q": "T", "K": "T"}.get(card, card)
+             for card in (cards if isinstance(cards, list) else list(str(cards)))]
+    if len(cards) < 2 or any(card not in DISTINCT for card in cards):
+        raise ValueError("%s must be at least two cards of %s"%(what, "".join(DISTINCT)))
+    return cards
+
+
+
+########################
+##   STRATEGY TABLES  ##
+########################
+
+class StrategyTables:
+    """ EV of every action and the optimal strategy of one rule set, as
+        arrays indexed by strategy row or state and dealer column """
+
+    def __init__(self, rules=DEFAULT_RULES, cache_dir=None):
+        result = easybj.calculate(rules, cache_dir)
+        take = lambda name: result[name].take(DEALER_CODE, STATE_CODE)
+        self.rules = rules
+        self.stand, self.hit = take('stand'), take('hit')
+        self.evs = action_evs(self.stand, self.hit, take('double'),
+                              take('split'), rules)
+        self.strategy = result['strategy'].to_numpy()
+
+    def answer(self, query):
+        """ Returns {"action", "evs"} of a {"player", "dealer"} query, evs
+            holding the EV of every allowed action """
+        if not isinstance(query, dict):
+            raise ValueError("query must be an object")
+        dealer = cards2code(parse_cards(query.get('dealer'), "dealer"), dealer=True)
+        if dealer == "BJ":
+            raise ValueError("dealer blackjack ends the round")
+        if dealer not in DEALER_COL: # the dealer stood on 21 or busted
+            raise ValueError("dealer hand must still draw, got %s"
+                             %("bust" if dealer == BUST_CODE else dealer))
+        col = DEALER_COL[dealer]
+        cards = parse_cards(query.get('player'), "player")
+        code = cards2code(cards)
+        if code == "BJ":
+            return {"action": "BJ", "evs": {"S": self.rules.blackjack_pays}}
+        if code == BUST_CODE:
+            return {"action": None, "evs": {}}
+        if len(cards) == 2:
+            row = PLAYER_ROW[code]
+            evs = self.evs[:, row, col].tolist()
+            return {"action": self.strategy[row, col],
+                    "evs": {a: ev for a, ev in zip(ACTIONS, evs) if ev > -np.inf}}
+
+        # more cards: only stand or hit, 21 stands
+        s = STATE[code]
+        evs = {"S": float(self.stand[s, col])}
+        if s != TWENTYONE_STATE:
+            evs["H"] = float(self.hit[s, col])
+        return {"action": max(evs, key=evs.get), "evs": evs}
+
+
+
+#################
+##   SERVICE   ##
+#################
+
+class StrategyService:
+    """ Answers requests from the StrategyTables of their rule set, keeping
+        the rule_sets most recently used ones. Tables are built in an
+        executor, once even when several requests ask for them. """
+
+    def __init__(self, rule_sets=RULE_SETS, cache_dir=None):
+        self.rule_sets = rule_sets
+        self.cache_dir = cache_dir
+        self.tables = OrderedDict() # rules: StrategyTables, oldest first
+        self.pending = {} # rules: future of StrategyTables being built
+        self.builds = 0
+
+    async def get_tables(self, rules):
+        """ Returns StrategyTables of rules """
+        tables = self.tables.get(rules)
+        if tables is not None:
+            self.tables.move_to_end(rules)
+            return tables
+        if rules not in self.pending:
+            loop = asyncio.get_running_loop()
+            self.pending[rules] = loop.run_in_executor(
+                None, StrategyTables, rules, self.cache_dir)
+            self.builds += 1
+        try:
+            tables = await self.pending[rules]
+        finally:
+            self.pending.pop(rules, None)
+        self.tables[rules] = tables
+        while len(self.tables) > self.rule_sets:
+            self.tables.popitem(last=False)
+        return tables
+
+    async def handle_request(self, request):
+        """ Returns response to a decoded request """
+        ident = request.get('id') if isinstance(request, dict) else None
+        try:
+            if not isinstance(request, dict):
+                raise ValueError("request must be an object")
+            rules = parse_rules(request.get('rules'))
+            queries = request.get('queries')
+            if not isinstance(queries, list):
+                raise ValueError("queries must be a list")
+            tables = await self.get_tables(rules)
+            results = [tables.answer(query) for query in queries]
+        except Exception as e: # any failure is answered, the connection kept
+            return {"id": ident, "error": "%s: %s"%(type(e).__name__, e)}
+        return {"id": ident, "results": results}
+
+    async def handle_connection(self, reader, writer):
+        """ Answer the requests of a connection in order until it closes """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line: break
+                try:
+                    request = json.loads(line)
+                except ValueError as e:
+                    response = {"id": None, "error": "ValueError: %s"%e}
+                else:
+                    response = await self.handle_request(request)
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain() # only waits when the client lags behind
+        except (ConnectionError, ValueError): # including overlong lines
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, path=None, host=HOST, port=PORT):
+        """ Returns asyncio server listening on Unix socket path, or on
+            host and port when path is None (port 0 picks a free one) """
+        if path is not None:
+            return await asyncio.start_unix_server(self.handle_connection,
+                                                   path, limit=LIMIT)
+        return await asyncio.start_server(self.handle_connection, host, port,
+                                          limit=LIMIT)
+
+
+
+################
+##   CLIENT   ##
+################
+
+class StrategyClient:
+    """ Blocking client of the service, for tools that are not asynchronous """
+
+    def __init__(self, path=None, host=HOST, port=PORT):
+        if path is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(path)
+        else:
+            self.sock = socket.create_connection((host, port))
+        self.file = self.sock.makefile('rb')
+
+    def query_many(self, batches, rules=None):
+        """ Returns list of results of each batch of queries, sent pipelined
+            as one request per batch
+            rules: dict of Rules fields, None for the defaults """
+        lines = [json.dumps({"id": i, "rules": rules, "queries": batch})
+                 for i, batch in enumerate(batches)]
+        self.sock.sendall("".join(line + "\n" for line in lines).encode())
+        results = []
+        for _ in lines:
+            response = json.loads(self.file.readline())
+            if 'error' in response:
+                raise ValueError(response['error'])
+            results.append(response['results'])
+        return results
+
+    def query(self, queries, rules=None):
+        """ Returns results of one batch of queries """
+        return self.query_many([queries], rules)[0]
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+async def serve(args):
+    service = StrategyService(args.rule_sets, args.cache_dir)
+    server = await service.start(args.unix, args.host, args.port)
+    async with server:
+        await server.serve_forever()
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Easy Blackjack strategy service")
+    parser.add_argument("--unix", help="Unix socket path, instead of TCP")
+    parser.add_argument("--host", default=HOST, help="TCP host")
+    parser.add_argument("--port", type=int, default=PORT, help="TCP port")
+    parser.add_argument("--rule-sets", type=int, default=RULE_SETS,
+                        help="rule sets kept in memory")
+    parser.add_argument("--cache-dir", help="directory of saved results")
+    args = parser.parse_args(argv[1:])
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,402 @@
+#!/usr/bin/python3
+#
+# simulate.py
+#
+# Monte Carlo simulation of Easy Blackjack played with an asst1 strategy
+# file. Rounds are played in NumPy batches, one array element per hand, and
+# batches are spread over a process pool with independent seed streams.
+# With --compare, two strategies play the same cards, until the difference
+# of their advantage is significant or NUM rounds have been played.
+#
+# usage: simulate.py [-i SEED] [-j WORKERS] [-c FILE] FILE NUM
+#
+
+import os
+import sys
+import math
+import argparse
+from collections import namedtuple
+from statistics import NormalDist
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from easybj import *
+from artifact import Artifact, is_artifact
+
+
+
+###################
+##   CONSTANTS   ##
+###################
+
+# action codes of the lookup array, NULL when no letter of a cell applies
+NULL, STAND, HIT, DOUBLE, SPLIT, SURRENDER = -1, 0, 1, 2, 3, 4
+LETTERS = {"S": STAND, "H": HIT, "D": DOUBLE, "P": SPLIT, "R": SURRENDER}
+
+# allowed action bits of the lookup array, stand and hit are always allowed
+CAN_DOUBLE, CAN_SPLIT, CAN_SURRENDER = 1, 2, 4
+NEEDS = {DOUBLE: CAN_DOUBLE, SPLIT: CAN_SPLIT, SURRENDER: CAN_SURRENDER}
+NUM_MASKS = 8
+
+ACE = DISTINCT.index("A")
+VALUE = np.array([card_value(card) for card in DISTINCT])
+BATCH = 100000 # rounds per shard
+COMPARE_BATCH = 20000 # rounds between stopping checks of compare
+CONFIDENCE = 0.99 # of the interval compare stops on
+SHOE_WIDTH = 16 # cards of a round dealt at once by Shoe
+
+
+
+##########################
+##   STRATEGY LOADING   ##
+##########################
+
+def load_strategy(path):
+    """ Returns (PLAYER_CODE x DEALER_CODE) object array of the strategy
+        strings in an asst1 strategy file or an artifact, None for missing
+        cells """
+    if is_artifact(path):
+        with Artifact(path) as artifact:
+            cells = artifact['strategy'].to_numpy() # a copy of a str table
+        return np.array([[text.upper() if text else None for text in row]
+                         for row in cells], dtype=object)
+    cells = np.full((len(PLAYER_CODE), len(DEALER_CODE)), None, dtype=object)
+    with open(path) as f:
+        lines = f.read().splitlines()[1:len(PLAYER_CODE) + 1]
+    for row, line in enumerate(lines):
+        for col, text in enumerate(line.split()[1:len(DEALER_CODE) + 1]):
+            cells[row, col] = text.upper()
+    return cells
+
+def resolve(text, mask):
+    """ Returns action of the first letter of text allowed by mask """
+    for letter in text or "":
+        action = LETTERS.get(letter, NULL)
+        if action != NULL and NEEDS.get(action, 0) & ~mask == 0:
+            return action
+    return NULL
+
+def lookup_table(cells):
+    """ Returns (row x column x allowed mask) int8 array of actions """
+    table = np.full(cells.shape + (NUM_MASKS,), NULL, dtype=np.int8)
+    for (row, col), text in np.ndenumerate(cells):
+        for mask in range(NUM_MASKS):
+            table[row, col, mask] = resolve(text, mask)
+    return table
+
+
+
+###########################
+##   UTILITY FUNCTIONS   ##
+###########################
+
+def player_row(total, ace, ncards, first, second):
+    """ Returns strategy row of player hands, and the hard row of the same
+        points used when no letter of the row applies """
+    soft = ace & (total + 10 <= 21)
+    points = total + 10*soft
+    pair = (ncards == 2) & (first == second)
+    row = np.where(pair, np.where(first == ACE, PLAYER_CODE.index("AA"), 16 + first),
+                   np.where(soft, points + 14, points - 4))
+    return row, points - 4
+
+def dealer_col(total, ace):
+    """ Returns strategy column of two card dealer hands """
+    soft = ace & (total + 10 <= 21)
+    points = total + 10*soft
+    return np.where(soft & (points <= 17), points + 5, points - 4)
+
+def points(total, ace):
+    """ Returns best score of hands, above 21 when bust """
+    return total + 10*(ace & (total + 10 <= 21))
+
+def report(hands, balance):
+    """ Returns summary in the format of the asst1 simulator """
+    lines = ["Hands Played: %d"%hands]
+    if hands > 0:
+        money = "+$%.2f"%balance if balance > 0 else \
+                "-$%.2f"%-balance if balance < 0 else "$%.2f"%balance
+        lines.append("Final Balance: " + money)
+        lines.append("Player Advantage: %.4g%%"%(balance / hands * 100))
+    return "\n".join(lines)
+
+
+
+###################
+##   SIMULATOR   ##
+###################
+
+def play(table, rounds, rng, rules=DEFAULT_RULES):
+    """ Returns total profit of playing rounds with the lookup table """
+    prob = card_probabilities(rules)
+    draw = lambda rows: rng.choice(NUM_CARDS, size=len(rows), p=prob)
+    return float(play_rounds(table, rounds, draw, rules).sum())
+
+def play_rounds(table, rounds, draw, rules=DEFAULT_RULES):
+    """ Returns profit of each of rounds played with the lookup table.
+        draw(rows) returns the next card of each round in rows. Each round
+        has one slot per possible hand; the first open hand of every round
+        acts at each step, as hands are played in turn. """
+    slots = rules.max_splits + 1
+
+    everyone = np.arange(rounds)
+    cards = np.array([draw(everyone) for _ in range(4)])
+    d_total = VALUE[cards[0]] + VALUE[cards[1]]
+    d_ace = (cards[0] == ACE) | (cards[1] == ACE)
+    col = dealer_col(d_total, d_ace)
+
+    total = np.zeros((rounds, slots), dtype=int)
+    ace = np.zeros((rounds, slots), dtype=bool)
+    ncards = np.zeros((rounds, slots), dtype=int)
+    first = np.zeros((rounds, slots), dtype=int)
+    second = np.zeros((rounds, slots), dtype=int)
+    bet = np.ones((rounds, slots))
+    split_ace = np.zeros((rounds, slots), dtype=bool)
+    nhands = np.ones(rounds, dtype=int)
+    total[:, 0] = VALUE[cards[2]] + VALUE[cards[3]]
+    ace[:, 0] = (cards[2] == ACE) | (cards[3] == ACE)
+    ncards[:, 0], first[:, 0], second[:, 0] = 2, cards[2], cards[3]
+
+    # blackjacks settle the round at once
+    dealer_bj = points(d_total, d_ace) == 21
+    player_bj = points(total[:, 0], ace[:, 0]) == 21
+    settled = dealer_bj | player_bj
+    profit = np.where(player_bj, np.where(dealer_bj, 0., rules.blackjack_pays),
+                      np.where(dealer_bj, -1., 0.))
+    done = np.ones((rounds, slots), dtype=bool)
+    done[~settled, 0] = False
+
+    while True:
+        r = np.flatnonzero(~done.all(axis=1))
+        if len(r) == 0: break
+        s = np.argmax(~done[r], axis=1)
+
+        n, k1, k2 = ncards[r, s], first[r, s], second[r, s]
+        row, alt_row = player_row(total[r, s], ace[r, s], n, k1, k2)
+        initial = n == 2
+        pair = initial & (k1 == k2) & (nhands[r] <= rules.max_splits)
+        mask = (CAN_DOUBLE * (initial & ((nhands[r] == 1) | rules.double_after_split))
+                + CAN_SPLIT * pair
+                + CAN_SURRENDER * (initial & (nhands[r] == 1) & rules.surrender))
+        aces = split_ace[r, s] # may only resplit, see below
+        mask = np.where(aces, CAN_SPLIT * pair, mask)
+
+        action = table[row, col[r], mask]
+        missing = action == NULL
+        action[missing] = table[alt_row[missing], col[r][missing], mask[missing]]
+        action[(action == NULL) | (aces & (action != SPLIT))] = STAND
+
+        # stand, surrender
+        stop = action == STAND
+        done[r[stop], s[stop]] = True
+        give_up = action == SURRENDER
+        profit[r[give_up]] = -0.5
+        done[r[give_up], s[give_up]] = True
+        settled[r[give_up]] = True
+
+        # hit and double draw one card, double ends the hand
+        take = (action == HIT) | (action == DOUBLE)
+        tr, ts = r[take], s[take]
+        card = draw(tr)
+        total[tr, ts] += VALUE[card]
+        ace[tr, ts] |= card == ACE
+        ncards[tr, ts] += 1
+        doubled = action[take] == DOUBLE
+        bet[tr[doubled], ts[doubled]] = 2.
+        done[tr, ts] |= doubled | (points(total[tr, ts], ace[tr, ts]) >= 21)
+
+        # split moves the second card to a new slot, then both draw a card
+        sp = action == SPLIT
+        sr, ss = r[sp], s[sp]
+        new = nhands[sr]
+        nhands[sr] += 1
+        pair_card = first[sr, ss]
+        for slot, card in ((ss, draw(sr)), (new, draw(sr))):
+            total[sr, slot] = VALUE[pair_card] + VALUE[card]
+            ace[sr, slot] = (pair_card == ACE) | (card == ACE)
+            ncards[sr, slot] = 2
+            first[sr, slot], second[sr, slot] = pair_card, card
+            split_ace[sr, slot] = pair_card == ACE
+            resplit = (pair_card == ACE) & (card == ACE) & rules.resplit_aces
+            done[sr, slot] = ((pair_card == ACE) & ~resplit) | \
+                             (points(total[sr, slot], ace[sr, slot]) == 21)
+
+    # dealer draws to a standing total
+    open_rounds = ~settled
+    while True:
+        score = points(d_total, d_ace)
+        soft = d_ace & (d_total + 10 <= 21)
+        hit = open_rounds & ((score < rules.dealer_stand) |
+                             ((score == rules.dealer_stand) & soft & rules.dealer_hits_soft))
+        if not hit.any(): break
+        card = draw(np.flatnonzero(hit))
+        d_total[hit] += VALUE[card]
+        d_ace[hit] |= card == ACE
+
+    dealer = points(d_total, d_ace)[:, None]
+    player = points(total, ace)
+    used = np.arange(slots)[None, :] < nhands[:, None]
+    outcome = np.where(player > 21, -1., np.where(dealer > 21, 1., np.sign(player - dealer)))
+    hand_profit = (outcome * bet * used).sum(axis=1)
+    profit[open_rounds] = hand_profit[open_rounds]
+    return profit
+
+def play_shard(table, rounds, seed, rules=DEFAULT_RULES):
+    return play(table, rounds, np.random.default_rng(seed), rules)
+
+def simulate(strategy, hands, seed=0, workers=None, rules=DEFAULT_RULES, batch=BATCH):
+    """ Returns final balance of playing hands rounds with strategy (path of
+        an asst1 strategy file, or cells from load_strategy). The result
+        only depends on seed, hands and batch, not on workers (see
+        parallel_workers, None runs in process) """
+    cells = load_strategy(strategy) if isinstance(strategy, str) else strategy
+    check_rules(rules)
+    table = lookup_table(cells)
+    sizes = [min(batch, hands - start) for start in range(0, hands, batch)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    workers = parallel_workers(workers, len(sizes))
+    if workers == 1:
+        profits = list(map(play_shard, [table] * len(sizes), sizes, seeds,
+                           [rules] * len(sizes)))
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            profits = list(pool.map(play_shard, [table] * len(sizes), sizes, seeds,
+                                    [rules] * len(sizes)))
+    return sum(profits)
+
+
+
+###########################
+##   PAIRED COMPARISON   ##
+###########################
+
+class Shoe:
+    """ Cards of a batch of rounds, replayed for every strategy (common
+        random numbers): the n-th card drawn by a round only depends on
+        seed, whatever the strategy did with the cards before it """
+
+    def __init__(self, seed, rounds, rules=DEFAULT_RULES):
+        self.seed = seed # SeedSequence
+        self.rounds = rounds
+        self.prob = card_probabilities(rules)
+        self.cards = self.chunk(0)
+        self.next = np.zeros(rounds, dtype=int)
+
+    def chunk(self, index):
+        """ Returns index-th block of SHOE_WIDTH cards of every round """
+        seed = np.random.SeedSequence(self.seed.entropy,
+                                      spawn_key=self.seed.spawn_key + (index,))
+        return np.random.default_rng(seed).choice(
+            NUM_CARDS, size=(self.rounds, SHOE_WIDTH), p=self.prob)
+
+    def draw(self, rows):
+        """ Returns next card of each round in rows """
+        position = self.next[rows]
+        while len(rows) and position.max() >= self.cards.shape[1]:
+            self.cards = np.hstack([self.cards,
+                                    self.chunk(self.cards.shape[1] // SHOE_WIDTH)])
+        self.next[rows] += 1
+        return self.cards[rows, position]
+
+    def replay(self):
+        """ Deal the same cards again from the first one """
+        self.next[:] = 0
+
+class RunningStats:
+    """ Streaming count, mean and variance of values, merged a batch at a
+        time with Welford's update (Chan et al.), so nothing is stored """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0. # sum of squared deviations from the mean
+
+    def add(self, values):
+        n = len(values)
+        if n == 0: return
+        mean = float(values.mean())
+        delta = mean - self.mean
+        total = self.count + n
+        self.m2 += float(((values - mean)**2).sum()) + delta**2 * self.count * n / total
+        self.mean += delta * n / total
+        self.count = total
+
+    def variance(self):
+        """ Returns sample variance, 0 below two values """
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.
+
+    def half_width(self, z):
+        """ Returns half width of the z confidence interval of the mean """
+        return z * math.sqrt(self.variance() / self.count) if self.count else math.inf
+
+Comparison = namedtuple('Comparison', ['hands', 'first', 'second', 'difference',
+                                       'half_width', 'confidence', 'speedup'])
+
+def compare(first, second, hands, seed=0, rules=DEFAULT_RULES, batch=COMPARE_BATCH,
+            confidence=CONFIDENCE):
+    """ Returns Comparison of the advantage of strategies first and second
+        (see simulate), both playing the same cards, round by round. Stops
+        once the confidence interval of the difference (first - second)
+        excludes zero, checked after every batch, or after hands rounds.
+        speedup: rounds independent runs would need for the same interval
+        width, per paired round. The interval is checked repeatedly, so
+        its coverage is somewhat below confidence; raise it to compensate """
+    check_rules(rules)
+    tables = [lookup_table(load_strategy(strategy) if isinstance(strategy, str)
+                           else strategy) for strategy in (first, second)]
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    stats = [RunningStats() for _ in range(3)] # first, second, difference
+    seeds = np.random.SeedSequence(seed)
+    played = 0
+    while played < hands:
+        rounds = min(batch, hands - played)
+        shoe = Shoe(seeds.spawn(1)[0], rounds, rules)
+        profits = []
+        for table in tables:
+            shoe.replay()
+            profits.append(play_rounds(table, rounds, shoe.draw, rules))
+        for stat, values in zip(stats, profits + [profits[0] - profits[1]]):
+            stat.add(values)
+        played += rounds
+        if abs(stats[2].mean) > stats[2].half_width(z): break
+
+    first, second, difference = stats
+    independent = first.variance() + second.variance()
+    return Comparison(played, first.mean, second.mean, difference.mean,
+                      difference.half_width(z), confidence,
+                      independent / difference.variance() if difference.variance() else math.inf)
+
+def report_comparison(result):
+    """ Returns summary of a Comparison """
+    lines = ["Hands Played: %d"%result.hands,
+             "First Advantage: %.4f%%"%(result.first * 100),
+             "Second Advantage: %.4f%%"%(result.second * 100),
+             "Difference: %+.4f%% +/- %.4f%% (%g%% confidence)"%(
+                 result.difference * 100, result.half_width * 100, result.confidence * 100),
+             "Variance Reduction: " + ("%.1fx"%result.speedup
+                                       if math.isfinite(result.speedup) else "identical play")]
+    return "\n".join(lines)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Easy Blackjack simulator")
+    parser.add_argument("strategy", help="asst1 strategy file")
+    parser.add_argument("hands", type=int, help="number of rounds to play")
+    parser.add_argument("-i", "--seed", type=int, default=0, help="random seed")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(),
+                        help="number of processes, every core by default")
+    parser.add_argument("-c", "--compare", metavar="FILE",
+                        help="second strategy, played on the same cards; "
+                             "stops early once the difference is significant")
+    parser.add_argument("--confidence", type=float, default=CONFIDENCE,
+                        help="confidence of the interval of --compare")
+    args = parser.parse_args(argv[1:])
+    if args.compare:
+        print(report_comparison(compare(args.strategy, args.compare, args.hands,
+                                        args.seed, confidence=args.confidence)))
+        return
+    balance = simulate(args.strategy, args.hands, args.seed, args.workers)
+    print(report(args.hands, balance))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+#
+# sweep.py
+#
+# Evaluate many house rule variants on a process pool. Variants that only
+# differ in player-side rules share their initial, dealer, stand, hit and
+# double tables, which are computed once per dealer-side rule set.
+#
+
+import os
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from easybj import *
+from vectorized import (VectorCalculator, create_optimal_table,
+                        calculate_player_advantage, make_result, dealer_dict,
+                        outcome_result)
+
+
+
+###########################
+##   UTILITY FUNCTIONS   ##
+###########################
+
+def rule_variants(**options):
+    """ Returns Rules for every combination of options, e.g.
+        rule_variants(dealer_hits_soft=(True, False), max_splits=(1, 3)) """
+    names = list(options)
+    return [Rules(**dict(zip(names, values)))
+            for values in itertools.product(*options.values())]
+
+def table_rules(rules):
+    """ Returns the dealer-side part of rules. Variants with the same
+        table_rules share every stage before split """
+    return Rules(rules.dealer_stand, rules.dealer_hits_soft, rules.weights)
+
+def chunks(items, n):
+    """ Split items into at most n lists of nearly equal length """
+    size = -(-len(items) // n)
+    return [items[i:i+size] for i in range(0, len(items), size)]
+
+
+
+################
+##   STAGES   ##
+################
+
+def shared_stages(rules):
+    """ Returns initial, dealer, stand, hit and double arrays, which only
+        depend on table_rules(rules) """
+    calc = VectorCalculator(rules)
+    initial = calc.create_initial_table()
+    dealer = calc.create_dealer_table()
+    stand = calc.create_stand_table(dealer)
+    hit, _ = calc.create_hit_table(stand)
+    double = calc.create_double_table(stand)
+    return initial, dealer, stand, hit, double
+
+def variant_results(shared, variants):
+    """ Returns the calculate() dictionary of each variant, from the
+        shared stages of their table_rules """
+    initial, probs, stand, hit, double = shared
+    dealer = {STATE_CODE[s]: dealer_dict(probs[s])
+              for s in DEALER_STATE + DEALER_STAND_STATE if s != BUST_STATE}
+    results = []
+    for rules in variants:
+        split, resplit = VectorCalculator(rules).create_split_table(stand, hit, double)
+        optimal, strategy = create_optimal_table(stand, hit, double, split, rules)
+        advantage = calculate_player_advantage(initial, optimal, rules)
+        outcome = outcome_result(rules, initial, probs[list(DEALER_STATE)], stand,
+                                 hit, double, strategy)
+        results.append(make_result(rules, initial, dealer, stand, hit, double,
+                                   resplit, split, optimal, strategy, advantage,
+                                   outcome))
+    return results
+
+
+
+###############
+##   SWEEP   ##
+###############
+
+def sweep(variants, workers=None):
+    """ Returns the calculate() dictionary of every rule variant, in order
+        workers: number of processes, None or 1 runs in process, see
+                 parallel_workers """
+    variants = list(variants)
+    for rules in variants:
+        check_rules(rules)
+    workers = parallel_workers(workers, len(variants))
+
+    groups = {}
+    for index, rules in enumerate(variants):
+        groups.setdefault(table_rules(rules), []).append(index)
+    keys = list(groups)
+
+    # split each group so that every worker gets a share of the variants
+    tasks = [(key, part) for key in keys
+             for part in chunks(groups[key], max(1, workers // len(keys)))]
+
+    results = [None] * len(variants)
+    if workers == 1:
+        shared = dict(zip(keys, map(shared_stages, keys)))
+        outputs = [variant_results(shared[key], [variants[i] for i in part])
+                   for key, part in tasks]
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            shared = dict(zip(keys, pool.map(shared_stages, keys)))
+            outputs = list(pool.map(variant_results,
+                                    [shared[key] for key, _ in tasks],
+                                    [[variants[i] for i in part] for _, part in tasks]))
+    for (_, part), output in zip(tasks, outputs):
+        for index, result in zip(part, output):
+            results[index] = result
+    return results
+
+
+if __name__ == "__main__":
+    variants = rule_variants(dealer_hits_soft=(True, False),
+                             blackjack_pays=(1.5, 1.2),
+                             surrender=(True, False),
+                             max_splits=(1, 2, 3),
+                             double_after_split=(True, False))
+    print("H17   BJ    SURR  SPLITS  DAS   ADVANTAGE")
+    for rules, result in zip(variants, sweep(variants, os.cpu_count())):
+        print("%-5s %-5s %-5s %-7d %-5s %.6f" % (
+            "H17" if rules.dealer_hits_soft else "S17", rules.blackjack_pays,
+            rules.surrender, rules.max_splits, rules.double_after_split,
+            result["advantage"]))
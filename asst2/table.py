@@ -10,6 +10,10 @@
 from collections import defaultdict
 from collections.abc import Sized
 # Sized requires subclasses to implement __len__()
+import numpy as np
+
+# celltypes that can be stored in a dense array, and their array dtype
+DENSE_DTYPE = { float: np.float64, str: np.int32 }
 
 
 class Table:
@@ -20,21 +24,45 @@ class Table:
     # xlabels: labels of x-axis
     # ylables: labels of y-axis
     # unit: unit of each cell (printed as suffix)
+    # dense: store cells in a contiguous array instead of a dictionary,
+    #        float cells use NaN for None, str cells are stored as an
+    #        index into self.strings (-1 for None)
     #
-    def __init__(self, celltype, xlabels, ylabels, unit=""):
+    def __init__(self, celltype, xlabels, ylabels, unit="", dense=False):
         if not isinstance(celltype, type):
             raise TypeError("celltype must be a type (e.g. str, float)")
+        if dense and celltype not in DENSE_DTYPE:
+            raise TypeError("dense table must be of type float or str")
         self.celltype = celltype
         self.xlabels = tuple(xlabels)
         self.ylabels = tuple(ylabels)
         self.unit = unit
-        self.data = defaultdict(lambda: defaultdict(lambda: None))
-        # using defaultdict since no extra code for initialization
+        # label -> position, built once so lookups do not scan the labels
+        self.xindex = { x: i for i, x in enumerate(self.xlabels) }
+        self.yindex = { y: i for i, y in enumerate(self.ylabels) }
+        self.dense = dense
+        if dense:
+            shape = (len(self.ylabels), len(self.xlabels))
+            if celltype is float:
+                self.data = np.full(shape, np.nan)
+            else:
+                self.data = np.full(shape, -1, dtype=DENSE_DTYPE[str])
+                self.strings = []
+                self.stringindex = {}
+        else:
+            self.data = defaultdict(lambda: defaultdict(lambda: None))
+            # using defaultdict since no extra code for initialization
 
     #
     # "private" member function to validate key
     #
     def _validate_key(self, key):
+        if type(key) is tuple and len(key) == 2:
+            try:
+                if key[0] in self.yindex and key[1] in self.xindex:
+                    return key
+            except TypeError:
+                pass # unhashable label, checked below
         if not isinstance(key, Sized):
             raise TypeError("key must be a sized container")
         if len(key) != 2:
@@ -47,6 +75,30 @@ class Table:
             raise KeyError("%s is not a valid x-label"%str(col))
         return row, col
 
+    #
+    # "private" member function to find the array position of key, raising
+    # the same errors as _validate_key
+    #
+    def _locate(self, key):
+        if type(key) is tuple and len(key) == 2:
+            try:
+                return self.yindex[key[0]], self.xindex[key[1]]
+            except (KeyError, TypeError):
+                pass # let _validate_key report the error
+        row, col = self._validate_key(key)
+        return self.yindex[row], self.xindex[col]
+
+    #
+    # "private" member function to get the array code of a string
+    #
+    def _encode(self, value):
+        code = self.stringindex.get(value)
+        if code is None:
+            code = len(self.strings)
+            self.strings.append(value)
+            self.stringindex[value] = code
+        return code
+
     #
     # Overloads index operator for assigning to a cell
     #
@@ -56,6 +108,12 @@ class Table:
     def __setitem__(self, key, value):
         if not isinstance(value, self.celltype):
             raise TypeError("value must be of type %s"%(self.celltype.__name__))
+        if self.dense:
+            index = self._locate(key)
+            if self.celltype is str:
+                value = self._encode(value)
+            self.data[index] = value
+            return
         row, col = self._validate_key(key)
         self.data[row][col] = value
 
@@ -65,6 +123,11 @@ class Table:
     # key: key of the cell
     #
     def __getitem__(self, key):
+        if self.dense:
+            value = self.data.item(self._locate(key))
+            if self.celltype is str:
+                return self.strings[value] if value >= 0 else None
+            return value if value == value else None # NaN is None
         row, col = self._validate_key(key)
         return self.data[row][col]
 
@@ -75,5 +138,187 @@ class Table:
     # key: key of the cell
     #
     def __delitem__(self, key):
+        if self.dense:
+            self.data[self._locate(key)] = np.nan if self.celltype is float else -1
+            return
         row, col = self._validate_key(key)
         self.data[row][col] = None
+
+    #
+    # "private" member function to get the position of a label
+    #
+    def _position(self, index, label, axis):
+        try:
+            return index[label]
+        except (KeyError, TypeError):
+            raise KeyError("%s is not a valid %s-label"%(str(label), axis))
+
+    #
+    # "private" member function to convert values to what is stored in the
+    # dense array, checking that each value is None or of type 'celltype'
+    #
+    def _encode_array(self, values):
+        values = np.asarray(values, dtype=None if self.celltype is float else object)
+        if values.dtype.kind == 'f':
+            return values
+        codes = np.empty(values.shape, dtype=self.data.dtype)
+        for index, value in np.ndenumerate(values):
+            if value is None:
+                codes[index] = np.nan if self.celltype is float else -1
+            elif not isinstance(value, self.celltype):
+                raise TypeError("value must be of type %s"%(self.celltype.__name__))
+            else:
+                codes[index] = value if self.celltype is float else self._encode(value)
+        return codes
+
+    #
+    # "private" member function to assign values to the cells at keys,
+    # index is the matching position in the dense array
+    #
+    def _fill(self, keys, values, index):
+        if len(values) != len(keys):
+            raise ValueError("expected %d values, got %d"%(len(keys), len(values)))
+        if self.dense:
+            self.data[index] = self._encode_array(values)
+            return
+        for key, value in zip(keys, values):
+            if value is None:
+                del self[key]
+            else:
+                self[key] = value
+
+    #
+    # Returns all cells as an array of shape (len(ylabels), len(xlabels)).
+    # Float tables give a float64 array with NaN for None, which for a dense
+    # table is its storage (writes go to the table). Other tables give a new
+    # object array with None for empty cells.
+    #
+    def to_numpy(self):
+        if self.dense:
+            if self.celltype is float:
+                return self.data
+            strings = np.array(self.strings + [None], dtype=object)
+            return strings[self.data] # code -1 is the trailing None
+        shape = (len(self.ylabels), len(self.xlabels))
+        if self.celltype is float:
+            array = np.full(shape, np.nan)
+        else:
+            array = np.full(shape, None, dtype=object)
+        for row, cells in self.data.items():
+            for col, value in cells.items():
+                if value is not None:
+                    array[self.yindex[row], self.xindex[col]] = value
+        return array
+
+    #
+    # Creates a table from an array of shape (len(ylabels), len(xlabels)),
+    # NaN or None cells are left empty. Float and str tables are dense.
+    #
+    @classmethod
+    def from_numpy(cls, celltype, xlabels, ylabels, array, unit=""):
+        table = cls(celltype, xlabels, ylabels, unit=unit,
+                    dense=celltype in DENSE_DTYPE)
+        array = np.asarray(array, dtype=None if celltype is float else object)
+        shape = (len(table.ylabels), len(table.xlabels))
+        if array.shape != shape:
+            raise ValueError("array must be of shape %s"%str(shape))
+        for row, values in zip(table.ylabels, array):
+            table.fill_row(row, values)
+        return table
+
+    #
+    # Creates a dense table whose storage is an existing array, without
+    # copying it (e.g. a read-only view of a memory-mapped file)
+    #
+    # data: float64 array of shape (len(ylabels), len(xlabels)) for float
+    #       tables, int32 indices into strings (-1 for None) for str tables
+    #
+    @classmethod
+    def from_buffer(cls, celltype, xlabels, ylabels, data, strings=(), unit=""):
+        table = cls(celltype, xlabels, ylabels, unit=unit, dense=True)
+        shape = (len(table.ylabels), len(table.xlabels))
+        if data.shape != shape or data.dtype != DENSE_DTYPE[celltype]:
+            raise ValueError("data must be a %s array of shape %s"
+                             %(np.dtype(DENSE_DTYPE[celltype]), str(shape)))
+        table.data = data
+        if celltype is str:
+            table.strings = list(strings)
+            table.stringindex = { v: i for i, v in enumerate(table.strings) }
+        return table
+
+    #
+    # Returns the cells of a row as an array, a view into the table for
+    # dense float tables
+    #
+    # row: y-label of the row
+    #
+    def row(self, row):
+        return self.to_numpy()[self._position(self.yindex, row, 'y')]
+
+    #
+    # Returns the cells of a column as an array, a view into the table for
+    # dense float tables
+    #
+    # col: x-label of the column
+    #
+    def column(self, col):
+        return self.to_numpy()[:, self._position(self.xindex, col, 'x')]
+
+    #
+    # Assigns a value (or None) to every cell of a row, in xlabels order
+    #
+    def fill_row(self, row, values):
+        i = self._position(self.yindex, row, 'y')
+        self._fill([ (row, x) for x in self.xlabels ], values, (i, slice(None)))
+
+    #
+    # Assigns a value (or None) to every cell of a column, in ylabels order
+    #
+    def fill_column(self, col, values):
+        j = self._position(self.xindex, col, 'x')
+        self._fill([ (y, col) for y in self.ylabels ], values, (slice(None), j))
+
+    #
+    # Returns a new table with func applied to every cell that is not None.
+    # A numpy ufunc is applied to the whole array of a float table at once.
+    #
+    # celltype: type of the new cells, defaults to the current celltype
+    #
+    def apply(self, func, celltype=None):
+        values = self.to_numpy()
+        if isinstance(func, np.ufunc) and values.dtype.kind == 'f':
+            result = func(values)
+        else:
+            result = np.full(values.shape, None, dtype=object)
+            for index, value in np.ndenumerate(values):
+                if value is not None and value == value:
+                    result[index] = func(value)
+        return Table.from_numpy(celltype or self.celltype, self.xlabels,
+                                self.ylabels, result, unit=self.unit)
+
+    #
+    # Returns float array of the cells at the given labels, NaN for labels
+    # that are not in this table
+    #
+    def take(self, xlabels, ylabels):
+        values = np.asarray(self.to_numpy(), dtype=float)
+        rows = np.array([ self.yindex.get(y, -1) for y in ylabels ], dtype=int)
+        cols = np.array([ self.xindex.get(x, -1) for x in xlabels ], dtype=int)
+        result = values[np.ix_(rows, cols)] # -1 picks the last label, masked
+        result[rows < 0, :] = np.nan
+        result[:, cols < 0] = np.nan
+        return result
+
+    #
+    # Returns (values, indices) arrays over the given labels: the largest
+    # value of each cell across tables, and the index of the first table
+    # holding it. Tables missing a cell are skipped, and cells missing from
+    # every table are NaN with index -1.
+    #
+    @staticmethod
+    def argmax(tables, xlabels, ylabels):
+        stacked = np.stack([ table.take(xlabels, ylabels) for table in tables ])
+        indices = np.argmax(np.where(np.isnan(stacked), -np.inf, stacked), axis=0)
+        values = np.take_along_axis(stacked, indices[None], axis=0)[0]
+        indices[np.isnan(values)] = -1
+        return values, indices
@@ -0,0 +1,410 @@
+#!/usr/bin/python3
+#
+# vectorized.py
+#
+# NumPy engine for the Easy Blackjack calculator. Every table is computed as
+# whole-column array operations across all dealer codes at once, on top of
+# the integer hand states from easybj.
+#
+
+from fractions import Fraction
+from math import gcd
+import numpy as np
+import easybj
+from easybj import *
+
+
+
+###################
+##   CONSTANTS   ##
+###################
+
+SPLIT_CARDS = [SPLIT_CARD[s] for s in SPLIT_STATE] # card index of SPLIT_CODE
+ACE = DISTINCT.index("A")
+ACTIONS = ["R", "S", "H", "D", "P"] # order of action_evs, ties go to the first
+
+
+
+###########################
+##   UTILITY FUNCTIONS   ##
+###########################
+
+def transition_matrix(next_state, prob, states):
+    """ Returns (state x state) matrix of probabilities of going from one
+        state to another in a single draw. Only given states may draw. """
+    matrix = np.zeros((NUM_STATES, NUM_STATES))
+    for s in states:
+        for card, n in enumerate(next_state[s]):
+            matrix[s, n] += prob[card]
+    return matrix
+
+def hit_order():
+    """ Returns non-split states, ordered so that every state comes after
+        all the states it can reach by hitting """
+    order, seen = [], set()
+    def visit(s):
+        if s in seen: return
+        seen.add(s)
+        if s not in (TWENTYONE_STATE, BUST_STATE):
+            for n in PLAYER_NEXT[s]: visit(n)
+        order.append(s)
+    for s in NON_SPLIT_STATE: visit(s)
+    return [s for s in order if s in NON_SPLIT_STATE]
+
+HIT_ORDER = hit_order()
+
+def payoff_matrix():
+    """ Returns (final dealer score x state) matrix of stand payoffs """
+    matrix = np.zeros((NUM_SCORES, NUM_STATES))
+    for s in STAND_STATE:
+        for dealer_score in range(NUM_SCORES):
+            if dealer_score == BUST or dealer_score < SCORE[s]:
+                matrix[dealer_score, s] = 1.
+            elif dealer_score > SCORE[s]:
+                matrix[dealer_score, s] = -1.
+    return matrix
+
+def fill_table(table, array, rows):
+    """ Copy array into table, rows are the states of table.ylabels """
+    table.to_numpy()[:] = array[list(rows)]
+
+def sign_matrix():
+    """ Returns (player final score x dealer final score) result of a hand
+        that stood or busted: 1 for a win, 0 for a push, -1 for a loss """
+    player = np.arange(NUM_SCORES)[:, None]
+    dealer = np.arange(NUM_SCORES)[None, :]
+    sign = np.where(dealer == BUST, 1, np.sign(player - dealer))
+    sign[BUST] = -1
+    return sign
+
+SIGN = sign_matrix()
+
+def dealer_dict(probs):
+    """ Convert a row of the dealer matrix to {score: probability} """
+    return {score: float(p) for score, p in enumerate(probs) if p > 0.}
+
+
+
+#######################
+##   VECTOR ENGINE   ##
+#######################
+
+class VectorCalculator:
+    """ Computes the same results as easybj.Calculator, using (state x dealer
+        column) arrays. Cells that do not apply to a state are NaN. """
+
+    def __init__(self, rules=DEFAULT_RULES):
+        check_rules(rules)
+        self.rules = rules
+        self.prob = np.array(card_probabilities(rules))
+        self.hit_matrix = transition_matrix(PLAYER_NEXT, self.prob, NON_SPLIT_STATE)
+
+    def create_initial_table(self):
+        """ Returns (state x dealer column + BJ) initial probabilities """
+        return initial_deal(self.prob)
+
+    def create_dealer_table(self):
+        """ Returns (state x final score) dealer outcome probabilities """
+        states = DEALER_STATE + DEALER_STAND_STATE
+        probs = np.zeros((NUM_STATES, NUM_SCORES))
+        probs[list(states)] = dealer_matrix(self.rules, [STATE_CODE[s] for s in states])
+        return probs
+
+    def create_stand_table(self, dealer):
+        """ Returns (state x dealer column) stand EVs """
+        stand = np.full((NUM_STATES, NUM_DEALER), np.nan)
+        payoff = (dealer[list(DEALER_STATE)] @ payoff_matrix()).T
+        stand[list(STAND_STATE)] = payoff[list(STAND_STATE)]
+        return stand
+
+    def create_hit_table(self, stand):
+        """ Returns hit EVs, and the EV of hitting then playing optimally
+            (stand or hit) """
+        middle = np.zeros((NUM_STATES, NUM_DEALER))
+        middle[TWENTYONE_STATE] = stand[TWENTYONE_STATE]
+        middle[BUST_STATE] = -1.
+        for s in HIT_ORDER:
+            hit = self.prob @ middle[list(PLAYER_NEXT[s])]
+            middle[s] = np.maximum(stand[s], hit)
+
+        hit = np.full((NUM_STATES, NUM_DEALER), np.nan)
+        hit[list(NON_SPLIT_STATE)] = (self.hit_matrix @ middle)[list(NON_SPLIT_STATE)]
+        return hit, middle
+
+    def create_double_table(self, stand):
+        """ Returns (state x dealer column) double EVs """
+        outcome = np.nan_to_num(2*stand)
+        outcome[BUST_STATE] = -2.
+        double = np.full((NUM_STATES, NUM_DEALER), np.nan)
+        double[list(NON_SPLIT_STATE)] = (self.hit_matrix @ outcome)[list(NON_SPLIT_STATE)]
+        return double
+
+    def create_split_table(self, stand, hit, double):
+        """ Returns split EVs and the resplit tables (see
+            Calculator.get_0split_outcome and get_split_outcome) """
+        rules = self.rules
+        resplit0 = np.fmax(stand, hit)
+        if rules.double_after_split:
+            resplit0 = np.fmax(resplit0, double)
+        resplit0[TWENTYONE_STATE] = stand[TWENTYONE_STATE]
+        resplit0[BJ_STATE] = stand[TWENTYONE_STATE]
+        resplit0[BUST_STATE] = -1.
+
+        # (split card x drawn card x dealer column) outcome of each split hand,
+        # split aces receive exactly one card each and must stand
+        cards = SPLIT_CARDS
+        f0 = resplit0[np.array(PAIR_STATE)[cards]]
+        f0[cards.index(ACE)] = stand[[TWENTYONE_STATE if s == BJ_STATE else NOSPLIT_STATE[s]
+                                      for s in PAIR_STATE[ACE]]]
+        q = self.prob[cards][:, None] # probability of drawing the split card
+        own = f0[np.arange(len(cards)), cards] # drawn split card
+        other = np.einsum('c,kcd->kd', self.prob, f0) - q*own # all other cards
+        can_resplit = np.array([c != ACE or rules.resplit_aces for c in cards])[:, None]
+
+        # values[n]: split EV with at most n splits, computed from fewer splits
+        values = [own]
+        for splits in range(1, rules.max_splits + 1):
+            values.append(split_payoff(other, q,
+                lambda n: np.where(can_resplit, values[n], own), splits))
+
+        split = np.full((NUM_STATES, NUM_DEALER), np.nan)
+        split[list(SPLIT_STATE)] = values[rules.max_splits]
+        rows = SPLIT_STATE if rules.resplit_aces else SPLIT_STATE[:-1]
+        resplit = [resplit0]
+        for splits in range(1, rules.max_splits):
+            resplit.append(np.full_like(split, np.nan))
+            resplit[-1][list(rows)] = values[splits][:len(rows)]
+        return split, resplit
+
+
+
+########################
+##   SHARED RESULTS   ##
+########################
+
+def action_evs(stand, hit, double, split, rules=DEFAULT_RULES):
+    """ Returns (action x PLAYER_STATE x dealer column) EV of each of ACTIONS,
+        -inf where the action is not allowed """
+    rows = list(PLAYER_STATE)
+    play = [NOSPLIT_STATE[s] for s in rows]
+    surrender = -0.5 if rules.surrender else -np.inf
+    return np.stack([np.full((len(rows), NUM_DEALER), surrender),
+                     stand[play], hit[play], double[play],
+                     np.nan_to_num(split[rows], nan=-np.inf)])
+
+def create_optimal_table(stand, hit, double, split, rules=DEFAULT_RULES):
+    """ Returns (state x dealer column) optimal EVs and strategy codes """
+    rows = list(PLAYER_STATE)
+    evs = action_evs(stand, hit, double, split, rules)
+    best = np.argmax(evs, axis=0) # first maximum, as in max()
+    second = np.where(evs[2] > evs[1], "h", "s")
+
+    actions = np.array(ACTIONS, dtype=object)[best]
+    secondary = (best == 0) | (best == 3)
+    actions[secondary] = actions[secondary] + second[secondary]
+
+    optimal = np.full((NUM_STATES, NUM_DEALER), np.nan)
+    strategy = np.full((NUM_STATES, NUM_DEALER), "", dtype=object)
+    optimal[rows] = np.take_along_axis(evs, best[None], axis=0)[0]
+    strategy[rows] = actions
+    return optimal, strategy
+
+def calculate_player_advantage(initial, optimal, rules=DEFAULT_RULES):
+    """ Returns the expected payoff of a hand under optimal play """
+    payoff = np.zeros((NUM_STATES, NUM_DEALER + 1))
+    payoff[:, :NUM_DEALER] = np.nan_to_num(optimal)
+    payoff[BJ_STATE, :NUM_DEALER] = rules.blackjack_pays
+    payoff[:, NUM_DEALER] = -1.
+    payoff[BJ_STATE, NUM_DEALER] = 0.
+    return float(np.nansum(initial * payoff))
+
+
+
+
+##############################
+##   OUTCOME DISTRIBUTION   ##
+##############################
+
+def final_score_table(prob, stand, hit):
+    """ Returns (state x dealer column x final score) probabilities of the
+        final score of a hand that hits while hitting beats standing, as
+        the middle values of create_hit_table """
+    final = np.zeros((NUM_STATES, NUM_DEALER, NUM_SCORES))
+    for s in STAND_STATE:
+        final[s, :, SCORE[s]] = 1.
+    final[BUST_STATE, :, BUST] = 1.
+    for s in HIT_ORDER:
+        drawn = np.tensordot(prob, final[list(PLAYER_NEXT[s])], axes=1)
+        final[s] = np.where((hit[s] > stand[s])[:, None], drawn, final[s])
+    return final
+
+def outcome_unit(rules=DEFAULT_RULES):
+    """ Returns the step between net outcomes of a hand as a Fraction: half
+        a bet, or less when the blackjack payout is not a multiple of it
+        (1/10 for 6:5) """
+    pays = Fraction(rules.blackjack_pays).limit_denominator(1000)
+    return Fraction(gcd(pays.numerator * 2, pays.denominator), pays.denominator * 2)
+
+def spread(results, bet, bins):
+    """ Returns (... x bins) distribution of the net outcome of a bet, in
+        whole bets, from (... x 3) probabilities of losing, pushing and
+        winning it """
+    outcomes = np.zeros(results.shape[:-1] + (bins,))
+    for i, sign in enumerate((-1, 0, 1)):
+        outcomes[..., bins//2 + sign*bet] += results[..., i]
+    return outcomes
+
+def outcome_distribution(rules, initial, dealer, stand, hit, double, strategy):
+    """ Returns (outcomes, probabilities) arrays of the net outcome of a hand
+        under optimal play, counting splits and doubles, on a grid of
+        outcome_unit(rules).
+        initial, stand, hit, double: (state x dealer column) arrays
+        dealer: (dealer column x final score) probabilities
+        strategy: (state x dealer column) strategy codes """
+    prob = np.array(card_probabilities(rules))
+    bins = 4 * (rules.max_splits + 1) + 1 # whole bets, every hand doubled
+    scores = np.flatnonzero(dealer.any(axis=0)) # dealer final scores that occur
+    dealer = dealer[:, scores]
+    signs = np.stack([SIGN[:, scores] == sign for sign in (-1, 0, 1)], axis=-1).astype(float)
+    by_dealer = np.einsum('cz,fzk->cfk', dealer, signs) # dealer column x final score
+
+    # final score probabilities of standing, hitting and doubling each state
+    stand_final = np.zeros((NUM_STATES, NUM_DEALER, NUM_SCORES))
+    for s in STAND_STATE + (BUST_STATE,):
+        stand_final[s, :, SCORE[s]] = 1.
+    stand_final[BJ_STATE, :, 21] = 1. # split hands of 21
+    draws = np.array(PLAYER_NEXT)
+    hit_final = np.tensordot(prob, final_score_table(prob, stand, hit)[draws], axes=([0], [1]))
+    double_final = np.tensordot(prob, stand_final[draws], axes=([0], [1]))
+    finals = {"S": (stand_final, 1), "H": (hit_final, 1), "D": (double_final, 2)}
+    evs = {"S": stand, "H": hit, "D": double}
+
+    # (own/other x split card x dealer column x dealer score x bins) split
+    # hands, played as in create_split_table, that draw the split card
+    # again or any other card
+    states = np.array(PLAYER_PAIR_STATE)[SPLIT_CARDS]
+    play = np.array(NOSPLIT_STATE)[states]
+    allowed = "SHD" if rules.double_after_split else "SH"
+    choice = np.argmax(np.stack([evs[a][play] for a in allowed]), axis=0)
+    choice[(states == BJ_STATE) | (np.array(SPLIT_CARDS) == ACE)[:, None]] = 0 # stand
+    index = np.arange(len(SPLIT_CARDS))
+    q = prob[SPLIT_CARDS].reshape(-1, 1, 1)
+    hands = 0.
+    for i, a in enumerate(allowed):
+        final, bet = finals[a]
+        taken = np.where((choice == i)[..., None], final[play], 0.)
+        own = taken[index, SPLIT_CARDS]
+        drawn = np.stack((own, np.tensordot(prob, taken, axes=([0], [1])) - q*own))
+        results = drawn @ signs.reshape(NUM_SCORES, -1)
+        hands = hands + spread(results.reshape(drawn.shape[:-1] + signs.shape[1:]), bet, bins)
+
+    # given the dealer's final score the split hands are independent, so
+    # their distributions multiply in the Fourier domain, where the bins
+    # wrap around without overlapping
+    own, other = np.fft.rfft(np.fft.ifftshift(hands, axes=-1), axis=-1)
+    q = q[..., None]
+    can_resplit = np.array([k != ACE or rules.resplit_aces for k in SPLIT_CARDS])
+    values = [own]
+    for splits in range(1, rules.max_splits + 1):
+        value = lambda n: np.where(can_resplit.reshape(-1, 1, 1, 1), values[n], own)
+        values.append(other*other + 2*q*other*value(splits - 1)
+                      + q*q*value(splits // 2)*value((splits - 1) // 2))
+    outcomes = np.fft.fftshift(np.fft.irfft(values[-1], bins, axis=-1), axes=-1)
+    split = np.zeros((NUM_STATES, NUM_DEALER, bins))
+    split[states[index, SPLIT_CARDS]] = (dealer[:, None] @ outcomes)[..., 0, :]
+
+    # (action x PLAYER_STATE x dealer column x bins) outcome of each action,
+    # surrender is counted apart as it is not a whole bet
+    rows = list(PLAYER_STATE)
+    play = [NOSPLIT_STATE[s] for s in rows]
+    options = np.zeros((len(ACTIONS), len(rows), NUM_DEALER, bins))
+    for a, (final, bet) in finals.items():
+        results = (final[play].transpose(1, 0, 2) @ by_dealer).transpose(1, 0, 2)
+        options[ACTIONS.index(a)] = spread(results, bet, bins)
+    options[ACTIONS.index("P")] = split[rows]
+    action = np.array([[ACTIONS.index(code[0]) for code in strategy[s][:NUM_DEALER]]
+                       for s in rows])
+    chosen = np.take_along_axis(options, action[None, :, :, None], axis=0)[0]
+
+    # weigh every starting hand by its probability, blackjacks last
+    weights = np.nan_to_num(initial)
+    hand = np.maximum(np.tensordot(weights[rows, :NUM_DEALER], chosen, axes=2), 0.)
+    unit = outcome_unit(rules)
+    steps = lambda value: int(round(value / unit))
+    total = np.zeros(2 * steps(bins // 2) + 1)
+    center = len(total) // 2
+    total[center + steps(1) * (np.arange(bins) - bins // 2)] = hand
+    total[center - steps(0.5)] += weights[rows, :NUM_DEALER][action == ACTIONS.index("R")].sum()
+    total[center + steps(rules.blackjack_pays)] += weights[BJ_STATE, :NUM_DEALER].sum()
+    total[center] += weights[BJ_STATE, NUM_DEALER]
+    total[center - steps(1)] += weights[:, NUM_DEALER].sum() - weights[BJ_STATE, NUM_DEALER]
+    return (np.arange(len(total)) - center) * unit.numerator / unit.denominator, total
+
+def outcome_result(rules, initial, dealer, stand, hit, double, strategy):
+    """ Returns the 'outcome' ({net outcome: probability}) and 'variance'
+        results of calculate(), see outcome_distribution """
+    outcomes, probs = outcome_distribution(rules, initial, dealer, stand, hit,
+                                           double, strategy)
+    mean = probs @ outcomes
+    return ({float(x): float(p) for x, p in zip(outcomes, probs) if p > 0.},
+            float(probs @ outcomes**2 - mean**2))
+
+def bankroll_distribution(outcome, hands):
+    """ Returns (bankroll, probabilities) arrays of the net result of hands
+        independent hands, from the {net outcome: probability} of one hand,
+        e.g. calculate()["outcome"]. The hands-fold convolution is a single
+        power in the Fourier domain. """
+    steps = [Fraction(x).limit_denominator(1000) for x in outcome]
+    denominator = np.lcm.reduce([x.denominator for x in steps])
+    unit = Fraction(int(np.gcd.reduce([int(x * denominator) for x in steps])),
+                    int(denominator))
+    index = [int(x / unit) for x in steps]
+    probs = np.zeros(max(index) - min(index) + 1)
+    probs[np.array(index) - min(index)] = list(outcome.values())
+
+    size = hands * (len(probs) - 1) + 1
+    n = 1 << (size - 1).bit_length() # zero padding, no wrap around
+    result = np.fft.irfft(np.fft.rfft(probs, n) ** hands, n)[:size]
+    result[result < 1e-14 * result.max()] = 0. # round-off
+    return (np.arange(size) + hands * min(index)) * unit.numerator / unit.denominator, result
+
+def make_result(rules, initial, dealer, stand, hit, double, resplit, split,
+                optimal, strategy, advantage, outcome):
+    """ Returns the easybj.calculate() dictionary from (state x dealer column)
+        arrays, dealer is already {code: {score: probability}} and outcome
+        comes from outcome_result """
+    tables = easybj.Calculator(rules)
+    fill_table(tables.initprob, initial, INITIAL_STATE)
+    fill_table(tables.stand_ev, stand, STAND_STATE)
+    fill_table(tables.hit_ev, hit, NON_SPLIT_STATE)
+    fill_table(tables.double_ev, double, NON_SPLIT_STATE)
+    for table, array in zip(tables.resplit_ev, resplit):
+        fill_table(table, array, [STATE[code] for code in table.ylabels])
+    fill_table(tables.split_ev, split, SPLIT_STATE)
+    fill_table(tables.optimal_ev, optimal, PLAYER_STATE)
+    for code, s in zip(PLAYER_CODE, PLAYER_STATE):
+        tables.strategy.fill_row(code, strategy[s])
+    tables.dealprob = dealer
+    tables.advantage = advantage
+    tables.outcome, tables.variance = outcome
+    return tables.result()
+
+
+def calculate(rules=DEFAULT_RULES):
+    """ Returns the same dictionary as easybj.calculate() """
+    calc = VectorCalculator(rules)
+    initial = calc.create_initial_table()
+    dealer = calc.create_dealer_table()
+    stand = calc.create_stand_table(dealer)
+    hit, _ = calc.create_hit_table(stand)
+    double = calc.create_double_table(stand)
+    split, resplit = calc.create_split_table(stand, hit, double)
+    optimal, strategy = create_optimal_table(stand, hit, double, split, rules)
+    advantage = calculate_player_advantage(initial, optimal, rules)
+    outcome = outcome_result(rules, initial, dealer[list(DEALER_STATE)], stand,
+                             hit, double, strategy)
+
+    dealer = {STATE_CODE[s]: dealer_dict(dealer[s])
+              for s in DEALER_STATE + DEALER_STAND_STATE if s != BUST_STATE}
+    return make_result(rules, initial, dealer, stand, hit, double, resplit,
+                       split, optimal, strategy, advantage, outcome)
@@ -5,6 +5,7 @@
 
 import tester
 import pickle
+import numpy as np
 
 # may need to tweak rel_tol and abs_tol
 def isclose(a, b, rel_tol=1e-09, abs_tol=1e-15):
@@ -17,28 +18,42 @@ def similarity(ans, ref, verbose):
     if sorted(ans.ylabels) != sorted(ref[0].keys()):
         print("ERROR: ylabels mismatch")
         return 0.
-    count = 0
-    good = 0 
-    for x in ans.xlabels:
-        for y in ans.ylabels:
-            count += 1
-            try:
-                refval = ref[0][y][ref[1].index(x)]
-            except (IndexError, KeyError):
-                print("({},{}) does not exist on instructor's solution".format(
-                    y, x))
-                continue
-            if ans[y,x] is None:
-                if verbose:
-                    print("empty cell on ({},{})".format(y, x))
-            elif ans.celltype is float and isclose(ans[y,x], float(refval)):
-                good += 1
-            elif ans.celltype is str and ans[y,x] == str(refval):
-                good += 1    
-            elif verbose:
-                print("mismatch on ({},{}): {} vs {}".format(
-                    y, x, ans[y,x], refval))
-    return good/count
+    values = ans.to_numpy()
+    shape = values.shape
+    # reference values aligned to the answer, rows may be short
+    expect = np.full(shape, None, dtype=object)
+    present = np.zeros(shape, dtype=bool)
+    for i, y in enumerate(ans.ylabels):
+        row = list(ref[0][y])[:shape[1]]
+        expect[i, :len(row)] = row
+        present[i, :len(row)] = True
+    if ans.celltype is float:
+        a = np.asarray(values, dtype=float)
+        b = np.where(present, expect, np.nan).astype(float)
+        empty = np.isnan(a)
+        with np.errstate(invalid='ignore'):
+            good = np.abs(a-b) <= np.maximum(1e-09*np.maximum(abs(a), abs(b)), 1e-15)
+    else:
+        empty = np.equal(values, None)
+        if ans.celltype is str:
+            good = np.equal(values, np.vectorize(str, otypes=[object])(expect))
+        else:
+            good = np.zeros(shape, dtype=bool)
+    good &= present & ~empty
+    # report problems in column order
+    for j, i in np.argwhere(~good.T):
+        x, y = ans.xlabels[j], ans.ylabels[i]
+        if not present[i, j]:
+            print("({},{}) does not exist on instructor's solution".format(
+                y, x))
+        elif not verbose:
+            continue
+        elif empty[i, j]:
+            print("empty cell on ({},{})".format(y, x))
+        else:
+            print("mismatch on ({},{}): {} vs {}".format(
+                y, x, values[i, j], expect[i, j]))
+    return float(good.sum())/good.size
 
 def load_result(name):
     mark = 5